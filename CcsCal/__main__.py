@@ -5,19 +5,63 @@
             This is the execution path to follow if this program is called directly through
             the command line.
 
-            The following argument is required:
+            The following argument is required (unless converting an external feature table, see below):
                 -i, --input         full path to ccscal_input.txt
+
+            The following argument is optional:
+                -j, --jobs          number of worker processes to extract compound drift times with
+                --estimator         drift time estimator: fit (always fit a gaussian) or tiered (use closed form
+                                    moment estimates for clean peaks and only fit the rest)
+                --figures           which gaussian fit figures to generate: none, failed (only failed or low
+                                    quality fits), or all
+                --contact-sheet     also write a single HTML contact sheet with a thumbnail of every fit
+                --no-fit-cache      do not load or store compound drift times in the fit cache
+                --baseline          subtract a baseline from the drift time profiles before fitting
+                --normalize         normalize the drift time profiles before fitting
+                --intervals         confidence intervals for the calibration and calibrated CCS from resampling
+                                    the calibrants: none, bootstrap, or jackknife
+                --resamples         number of bootstrap resamples
+                --sweep-edc         sweep the EDC parameter over N evenly spaced values from MIN to MAX, and use
+                                    the value that gives the lowest residual CCS of the calibrants
+
+            Drift times extracted by other software can be converted to calibrated CCS without an input file:
+                --ext-calibrants    CSV of calibrant m/z, drift time, and literature CCS
+                --ext-features      CSV feature table (m/z and drift time in the first two columns by default,
+                                    may be compressed) which is streamed in chunks, so it can be any size
+                --ext-output        output CSV, the feature table with calibrated CCS and their uncertainties
+                                    appended (default: <feature table>_ccs.csv)
+                --ext-columns       indices of the m/z and drift time columns of the feature table
+                --ext-edc           edc delay coefficient for the external calibration
+
+            If the input file has a cal parameter (a saved calibration, .json or .npz) then the calibration is
+            loaded from it instead of being performed again, or saved to it if it does not exist yet (or the
+            calibrant data file or any of the settings the calibration depends on have changed: mwn, edc, the
+            calibrants, sgw, sgp, --baseline, --normalize, --estimator, and --sweep-edc).
+
+            The drift time profiles are smoothed with a Savitsky-Golay filter using the window (sgw) and
+            polynomial order (sgp) from the input file, a window of 0 turns smoothing off. The conditioning
+            that was applied is written in the header of the report.
 """
 
 
-from CcsCal.input.RawData import RawData
+from CcsCal import globals
 from CcsCal.processing.Report import Report
-from CcsCal.processing.GaussFit import GaussFit
 from CcsCal.input.ParseInputFile import ParseInputFile
-from CcsCal.processing.CcsCalibration import CcsCalibration
+from CcsCal.input.CompressedFile import compressionExtension
+from CcsCal.processing.BatchProcessor import BatchProcessor
+from CcsCal.processing.BatchGaussFit import ESTIMATORS
+from CcsCal.processing.CalibrationBootstrap import CalibrationBootstrap, RESAMPLING_METHODS
+from CcsCal.processing.CcsCalibration import CcsCalibration, calibrationSettings, loadCalibration
+from CcsCal.processing.ContactSheet import ContactSheet
+from CcsCal.processing.ExternalConversion import calibrateFromCsv, convertFeatureCsv
+from CcsCal.processing.FigureRenderer import FIGURE_POLICIES, getRenderer
+from CcsCal.processing.GaussFit import isPoorFit
+from CcsCal.processing.ProfileConditioner import ProfileConditioner
 
 
 import argparse
+import numpy
+import os
 import time
 
 
@@ -41,6 +85,109 @@ results of the calibration and CCS of all compounds"""
                         help='full path to ccscal_input.txt',
                         dest="path_to_input",
                         metavar='"/full/path/to/ccscal_input.txt"')
+    parser.add_argument('-j',
+                        '--jobs',
+                        required=False,
+                        help='number of worker processes to extract compound drift times with',
+                        dest='jobs',
+                        type=int,
+                        default=globals.DEFAULT_JOBS,
+                        metavar='N')
+    parser.add_argument('--estimator',
+                        required=False,
+                        help='drift time estimator: fit (always fit a gaussian) or tiered (use closed form ' +
+                             'moment estimates for clean peaks and only fit the rest)',
+                        dest='estimator',
+                        choices=ESTIMATORS,
+                        default=globals.GAUSS_ESTIMATOR)
+    parser.add_argument('--figures',
+                        required=False,
+                        help='which gaussian fit figures to generate: none, failed (only failed or low quality ' +
+                             'fits), or all',
+                        dest='figures',
+                        choices=FIGURE_POLICIES,
+                        default=globals.FIGURE_POLICY)
+    parser.add_argument('--contact-sheet',
+                        required=False,
+                        help='also write a single HTML contact sheet with a thumbnail of every gaussian fit',
+                        dest='contact_sheet',
+                        action='store_true')
+    parser.add_argument('--no-fit-cache',
+                        required=False,
+                        help='do not load or store compound drift times in the fit cache',
+                        dest='fit_cache',
+                        action='store_false',
+                        default=globals.USE_FIT_CACHE)
+    parser.add_argument('--baseline',
+                        required=False,
+                        help='subtract a baseline from the drift time profiles before fitting',
+                        dest='baseline',
+                        action='store_true',
+                        default=globals.CONDITION_BASELINE)
+    parser.add_argument('--normalize',
+                        required=False,
+                        help='normalize the drift time profiles before fitting',
+                        dest='normalize',
+                        action='store_true',
+                        default=globals.CONDITION_NORMALIZE)
+    parser.add_argument('--intervals',
+                        required=False,
+                        help='confidence intervals for the calibration and calibrated CCS from resampling the ' +
+                             'calibrants: none, bootstrap, or jackknife',
+                        dest='intervals',
+                        choices=("none",) + RESAMPLING_METHODS,
+                        default="none")
+    parser.add_argument('--resamples',
+                        required=False,
+                        help='number of bootstrap resamples',
+                        dest='resamples',
+                        type=int,
+                        default=globals.BOOTSTRAP_RESAMPLES,
+                        metavar='N')
+    parser.add_argument('--sweep-edc',
+                        required=False,
+                        help='sweep the EDC parameter over N evenly spaced values from MIN to MAX, and use the ' +
+                             'value that gives the lowest residual CCS of the calibrants',
+                        dest='sweep_edc',
+                        type=float,
+                        nargs=3,
+                        default=None,
+                        metavar=('MIN', 'MAX', 'N'))
+    parser.add_argument('--ext-calibrants',
+                        required=False,
+                        help='CSV of calibrant m/z, drift time, and literature CCS to calibrate an external ' +
+                             'feature table with',
+                        dest='ext_calibrants',
+                        default=None,
+                        metavar='"/full/path/to/calibrants.csv"')
+    parser.add_argument('--ext-features',
+                        required=False,
+                        help='CSV feature table with m/z and drift times to convert to calibrated CCS',
+                        dest='ext_features',
+                        default=None,
+                        metavar='"/full/path/to/features.csv"')
+    parser.add_argument('--ext-output',
+                        required=False,
+                        help='output CSV for the feature table with calibrated CCS (default: ' +
+                             '<feature table>_ccs.csv)',
+                        dest='ext_output',
+                        default=None,
+                        metavar='"/full/path/to/features_ccs.csv"')
+    parser.add_argument('--ext-columns',
+                        required=False,
+                        help='indices of the m/z and drift time columns of the feature table',
+                        dest='ext_columns',
+                        type=int,
+                        nargs=2,
+                        default=[0, 1],
+                        metavar=('MZ', 'DT'))
+    parser.add_argument('--ext-edc',
+                        required=False,
+                        help='edc delay coefficient for the external calibration',
+                        dest='ext_edc',
+                        type=float,
+                        default=globals.DEFAULT_EDC,
+                        metavar='EDC')
     parser.add_argument('--test',
                         required=False,
                         help='runs the included test suite',
@@ -53,6 +200,31 @@ results of the calibration and CCS of all compounds"""
         from CcsCal.tests import all_tests
         all_tests.run()
         exit()
+    # convert an external feature table, and do nothing else
+    elif args.ext_calibrants or args.ext_features:
+        if not (args.ext_calibrants and args.ext_features):
+            print("\n--ext-calibrants and --ext-features must be provided together, exiting...")
+            exit(1)
+        print("Performing CCS Calibration from:", args.ext_calibrants, "...")
+        calibration = calibrateFromCsv(args.ext_calibrants, edc=args.ext_edc)
+        if calibration.fit_failed:
+            exit(1)
+        print("\tcorrected ccs = A * ((corrected drift time) + t0) ** B")
+        for name, value in zip(["A", "t0", "B"], calibration.optparams):
+            print("\t\t" + name + " =", value)
+        output = args.ext_output
+        if output is None:
+            # the output is written uncompressed next to the feature table
+            features = args.ext_features
+            if compressionExtension(features) is not None:
+                features = features[:-len(compressionExtension(features))]
+            output = os.path.splitext(features)[0] + "_ccs.csv"
+        print("Converting feature table:", args.ext_features, "...")
+        n_rows, n_failed = convertFeatureCsv(calibration, args.ext_features, output, mz_column=args.ext_columns[0],
+                                             dt_column=args.ext_columns[1])
+        print("\twrote", n_rows, "rows (" + str(n_failed), "without a calibrated CCS) to:", output)
+        print("\ntotal time: ", round((time.time() - start_time)), "s")
+        exit()
         # no path to input provided
     elif not args.path_to_input:
         parser.print_help()
@@ -65,45 +237,159 @@ results of the calibration and CCS of all compounds"""
     # PARSE THE INPUT FILE
     #
     input_data = ParseInputFile(args.path_to_input)
+    # the drift time profiles are conditioned with the smoothing parameters from the input file
+    conditioner = ProfileConditioner(window=input_data.savgolWindow,
+                                     order=input_data.savgolPoly,
+                                     baseline=args.baseline,
+                                     normalize=args.normalize)
+    if conditioner.window == 0 and not (conditioner.baseline or conditioner.normalize):
+        conditioner = None
     #
     # INITIALIZE THE REPORT GENERATOR
     #
-    report = Report(input_data.reportFileName)
+    report = Report(input_data.reportFileName, conditioner=conditioner)
+    # the contact sheet is written next to the report
+    sheet = None
+    if args.contact_sheet:
+        sheet = ContactSheet(os.path.splitext(input_data.reportFileName)[0] + "_contact_sheet.html")
     #
     # PERFORM CCS CALIBRATION
     #
-    print("\nPerforming CCS Calibration...")
-    # create CcsCalibration object
-    calibration = CcsCalibration(input_data.calDataFile,
-                                 input_data.calibrantData[0],
-                                 input_data.calibrantData[1],
-                                 mass_window=input_data.massWindow,
-                                 edc=input_data.edc)
+    calibration = None
+    save = False
+    # everything that affects the calibration, a saved calibration is only reused if these have not changed
+    has_calibrants = len(input_data.calibrantData[0]) > 0
+    settings = calibrationSettings(input_data.massWindow,
+                                   input_data.edc,
+                                   cal_masses=input_data.calibrantData[0] if has_calibrants else None,
+                                   cal_lit_ccs=input_data.calibrantData[1] if has_calibrants else None,
+                                   conditioner=conditioner,
+                                   estimator=args.estimator,
+                                   edc_sweep=args.sweep_edc)
+    if input_data.calibrationFile is not None and os.path.isfile(input_data.calibrationFile):
+        # reuse a saved calibration, unless the calibrant data file it came from or the settings have changed
+        print("\nLoading CCS Calibration from:", input_data.calibrationFile, "...")
+        source_file = input_data.calDataFile
+        try:
+            calibration = loadCalibration(input_data.calibrationFile,
+                                          source_file=source_file if source_file and os.path.isfile(source_file)
+                                          else None,
+                                          settings=settings)
+        except ValueError as e:
+            print("\t", e, ", performing the calibration again", sep="")
+    if calibration is None:
+        # without a saved calibration that can be reused, the calibrant data file and calibrants are required
+        if input_data.calDataFile is None or not has_calibrants:
+            print("\nNo saved calibration could be loaded (cal) and the input file does not have a calibration " +
+                  "data file (cdf) and calibrants to perform the calibration with, exiting...")
+            exit(1)
+        print("\nPerforming CCS Calibration...")
+        # create CcsCalibration object
+        calibration = CcsCalibration(input_data.calDataFile,
+                                     input_data.calibrantData[0],
+                                     input_data.calibrantData[1],
+                                     mass_window=input_data.massWindow,
+                                     edc=input_data.edc,
+                                     gauss_figs=args.figures,
+                                     estimator=args.estimator,
+                                     conditioner=conditioner)
+        save = True
+        if sheet is not None:
+            for mass, dt, tier, r2, data in zip(calibration.calMasses, calibration.calDriftTimes,
+                                                calibration.calTiers, calibration.calR2,
+                                                calibration.calRawAndFitData):
+                sheet.add("calibrant " + os.path.split(str(input_data.calDataFile))[1], mass, data, drift_time=dt,
+                          tier=tier, r2=r2, flagged=isPoorFit(tier, r2))
+    # try a grid of EDC parameters with the calibrant drift times that were already extracted, keep the best one
+    sweep = None
+    if args.sweep_edc is not None:
+        sweep = calibration.sweepEdc(numpy.linspace(args.sweep_edc[0], args.sweep_edc[1], int(args.sweep_edc[2])),
+                                     apply=False)
+        if sweep.bestIndex is None:
+            print("\tEDC parameter sweep FAILED, keeping EDC =", calibration.edc)
+        else:
+            sweep.apply()
+            print("\tEDC parameter sweep: best EDC =", calibration.edc)
+            save = True
+    # save the calibration so that later runs can reuse it
+    if save and input_data.calibrationFile is not None:
+        calibration.saveCalibration(input_data.calibrationFile, settings=settings)
+        print("\tsaved the calibration to:", input_data.calibrationFile)
     # save a graph of the fitted calibration curve
-    calibration.saveCalCurveFig(figure_file_name=input_data.calCurveFileName)
+    if input_data.calCurveFileName is not None:
+        calibration.saveCalCurveFig(figure_file_name=input_data.calCurveFileName)
+    # confidence intervals from refitting resamples of the calibrants
+    bootstrap = None
+    if args.intervals != "none":
+        bootstrap = CalibrationBootstrap(calibration, method=args.intervals, n_resamples=args.resamples)
+        print("\tcomputed", args.intervals, "intervals from", bootstrap.nUsed, "resamples")
     # write the calibration statistics to the report file
-    report.writeCalibrationReport(calibration)
+    report.writeCalibrationReport(calibration, bootstrap=bootstrap, sweep=sweep)
     print("...DONE")
     #
     # EXTRACT DRIFT TIMES OF COMPOUNDS AND GET THEIR CALIBRATED CCS
     #
     # write the header for the compound data table in the report
-    report.writeCompoundDataTableHeader()
-    # cycle through each compound input filename/mass pair and perform drift time extraction
-    for n in range(len(input_data.compoundFileNames)):
-        print("Extracting Drift Time for Mass:", input_data.compoundMasses[n],
-                "from Data File:", input_data.compoundFileNames[n], "(" + str(n + 1),
+    report.writeCompoundDataTableHeader(intervals=bootstrap is not None)
+    # extract the drift times for all of the compound input filename/mass pairs, using multiple worker processes
+    # if requested, results come back in the same order as the input
+    batch = BatchProcessor(input_data.compoundFileNames,
+                           input_data.compoundDataDir,
+                           input_data.compoundMasses,
+                           input_data.massWindow,
+                           jobs=args.jobs,
+                           gen_fig=args.figures,
+                           estimator=args.estimator,
+                           cache=args.fit_cache,
+                           conditioner=conditioner)
+    # the calibrated ccs values are computed for all of the compounds at once after the extraction, so the report
+    # lines are kept (in input order) until then
+    rows = []
+    for n, result in enumerate(batch.results()):
+        print("Extracted Drift Time for Mass:", result.mass,
+                "from Data File:", result.dataFileName, "(" + str(n + 1),
                 "of", str(len(input_data.compoundFileNames)) + ")...")
-        # extract drift time and get calibrated CCS for the filename/mass pair
-        driftTime = GaussFit(RawData((input_data.compoundDataDir + input_data.compoundFileNames[n]),
-                                        input_data.compoundMasses[n],
-                                        input_data.massWindow)).getDriftTime()
-        print("Getting Calibrated CCS...")
-        ccs =  calibration.getCalibratedCcs(input_data.compoundMasses[n], driftTime)
-        report.writeCompoundDataTableLine(input_data.compoundFileNames[n], input_data.compoundMasses[n], driftTime, ccs)
+        if result.error is not None:
+            # an error with one filename/mass pair does not stop the others from being processed
+            print("\tFAILED:", result.error)
+            rows.append((result.dataFileName, result.mass, None, None, None, result.error))
+            continue
+        if result.cached:
+            print("\t(loaded from the fit cache)")
+        rows.append((result.dataFileName, result.mass, result.driftTime, result.tier, result.cached, None))
+        if sheet is not None:
+            sheet.add(result.dataFileName, result.mass, result.rawAndFitData, drift_time=result.driftTime,
+                      tier=result.tier, r2=result.r2, flagged=isPoorFit(result.tier, result.r2))
+    print("Getting Calibrated CCS...")
+    extracted = [row for row in rows if row[5] is None]
+    masses = numpy.array([row[1] for row in extracted], dtype=float)
+    drift_times = numpy.array([row[2] for row in extracted], dtype=float)
+    ccs_values = calibration.getCalibratedCcsBulk(masses, drift_times)[0]
+    ccs_intervals = None
+    if bootstrap is not None:
+        ccs_intervals = bootstrap.ccsIntervals(masses, drift_times)
+    i = 0
+    for data_file_name, mass, drift_time, tier, cached, error in rows:
+        if error is not None:
+            report.writeCompoundDataTableErrorLine(data_file_name, mass, error)
+            continue
+        ccs_interval = ccs_intervals[i] if ccs_intervals is not None else None
+        report.writeCompoundDataTableLine(data_file_name, mass, drift_time, ccs_values[i], tier=tier, cached=cached,
+                                          ccs_interval=ccs_interval)
+        i += 1
+    print("...DONE")
     #
     # CLOSE THE REPORT FILE
     report.finish()
+    if sheet is not None:
+        sheet.write()
+        print("\nWrote contact sheet:", sheet.sheetFileName)
+    #
+    # WAIT FOR THE FIGURES TO FINISH RENDERING
+    #
+    print("\nWaiting for figures to finish rendering...")
+    getRenderer().shutdown()
+    print("...DONE")
     #
     print("\nCcsCal Complete.")
     #
@@ -6,36 +6,178 @@ you really know what you are doing.
 
 """
 
+# backend used to parse raw data text files (genfromtxt, loadtxt, fromstring, or pandas if installed)
+TEXT_PARSER = "genfromtxt"
+
+# approximate size (in bytes) of the chunks tokenized at a time by the fromstring text parser backend
+TEXT_PARSER_CHUNK_SIZE = 16777216
+
+# number of worker processes used to parse a single large raw data text file
+PARSE_JOBS = 1
+
+# minimum size (in bytes) of a raw data text file for it to be parsed using multiple worker processes
+PARALLEL_PARSE_MIN_SIZE = 67108864
+
+# number of byte ranges per worker process that a raw data text file is split into for parallel parsing
+PARALLEL_PARSE_RANGES_PER_JOB = 4
+
 # the factor by which to scale the mass window in text pre-processing
 PP_MASS_WIN_SCALE = 2.0
 
-# path to the pre-processing executable
-PP_EXE_PATH = "/Users/DRoss/Desktop/Documents/GitHub/ccscal/CcsCal/input/PreProcessTxt.exe"
+# approximate size (in bytes) of the chunks of lines read at a time in text pre-processing
+PP_CHUNK_SIZE = 1048576
+
+# whether to use a sidecar index of byte offsets to seek to the mass windows in text pre-processing
+USE_MZ_INDEX = True
+
+# number of lines between entries in the sidecar index of byte offsets
+MZ_INDEX_STRIDE = 10000
+
+# maximum number of characters in the m/z values that are converted all at once when building the sidecar index,
+# longer values are converted one at a time
+MZ_INDEX_MAX_TOKEN = 32
+
+# whether to cache parsed raw data files as memory-mapped binary columns
+USE_DATA_CACHE = True
+
+# directory to store the raw data cache in (None to store it in a .ccscal_cache directory next to each raw data file)
+DATA_CACHE_DIR = None
+
+# maximum total size (in bytes) of a raw data cache directory before least recently used entries are evicted
+DATA_CACHE_MAX_SIZE = 4294967296
 
-# initial gaussian function sigma parameter
+# size (in bytes) of the blocks at the start and end of a raw data file that are hashed to detect changes
+DATA_CACHE_HASH_BLOCK = 1048576
+
+# version of the contents of the raw data cache entries, must be incremented whenever a change to how the columns
+# are loaded would change what is stored (i.e. they are now always sorted by mass) so that stale entries are not used
+DATA_CACHE_VERSION = 2
+
+# whether to cache the results of drift time extraction (RawData -> GaussFit) for data file/mass pairs
+USE_FIT_CACHE = True
+
+# directory to store the fit cache in (None to store it in a .ccscal_cache directory next to each raw data file)
+FIT_CACHE_DIR = None
+
+# maximum total size (in bytes) of the fit cache entries in a directory before least recently used ones are evicted
+FIT_CACHE_MAX_SIZE = 268435456
+
+# version of the drift time extraction, part of the fit cache keys, must be incremented whenever a change to the
+# extraction or fitting would change its results so that stale cache entries are not used
+FITTER_VERSION = 5
+
+# (minimum) number of dt bins in the extracted drift time data
+N_DTBINS = 200
+
+# default number of worker processes for processing compounds
+DEFAULT_JOBS = 1
+
+# number of data file/mass pairs that are processed together (and whose profiles are conditioned as one stack)
+# by each task of a BatchProcessor
+BATCH_CHUNK_SIZE = 16
+
+# initial gaussian function sigma parameter (only used if it cannot be estimated from the data)
 INIT_GAUSS_SIGMA = 10.0
 
+# fraction of the apex intensity above which the points around the apex are used to estimate the initial gaussian
+# function parameters
+GAUSS_SEED_FRACTION = 0.2
+
+# half width (in multiples of the initial sigma parameter) of the region of interest around the apex of a profile
+# that is used when fitting it with a gaussian function, 0 to fit the whole profile
+GAUSS_ROI_WIDTHS = 5.0
+
+# drift time estimator, "fit" to always fit the profiles with gaussian functions or "tiered" to use closed form moment
+# estimates (centroid, FWHM) for profiles that pass the quality thresholds below and only fit the rest
+GAUSS_ESTIMATOR = "fit"
+
+# minimum R^2 of the gaussian implied by the moment estimates and minimum signal to noise ratio for a profile to use
+# the moment estimates in the tiered drift time estimator
+MOMENT_MIN_R2 = 0.98
+MOMENT_MIN_SNR = 20.0
+
 # Savitsky-Golay filter parameters
 SG_SMOOTH_WINDOW = 5
 SG_SMOOTH_ORDER = 3
 
+# whether to subtract a baseline (a low percentile of the intensities) from the drift time profiles before fitting
+CONDITION_BASELINE = False
+
+# percentile of the intensities of a drift time profile that is used as its baseline
+CONDITION_BASELINE_PERCENTILE = 10.0
+
+# whether to normalize the drift time profiles (to a maximum intensity of 1) before fitting
+CONDITION_NORMALIZE = False
+
 # the maximum number of iterations for curve_fit to reach convergence
 CURVE_FIT_MAXFEV = 5000
 
+# Levenberg-Marquardt (batch fitting) maximum number of iterations, relative tolerances on the sum of squared
+# residuals and on the parameters, initial damping parameter, and damping parameter above which a fit has stalled
+LM_MAX_ITER = 200
+LM_FTOL = 1.49012e-08
+LM_XTOL = 1.49012e-08
+LM_INIT_LAMBDA = 0.001
+LM_MAX_LAMBDA = 1e+16
+
 # conversion factor used to convert dt bins to dt in milliseconds
 DEFAULT_DTBIN_TO_DT = 0.110
 
+# number of resamples of the calibrants used for bootstrap confidence intervals of the CCS calibration
+BOOTSTRAP_RESAMPLES = 2000
+
+# confidence level of the bootstrap/jackknife intervals of the CCS calibration
+BOOTSTRAP_CONFIDENCE = 0.95
+
+# random seed for drawing the bootstrap resamples (fixed so that the intervals are reproducible), None for a
+# different seed every time
+BOOTSTRAP_SEED = 0
+
+# maximum number of calibrated CCS values (resamples x compounds) computed at once for bootstrap intervals
+BOOTSTRAP_CHUNK_SIZE = 4194304
+
+# number of rows of an external feature table (CSV) read, converted to calibrated CCS, and written at a time
+EXT_CHUNK_ROWS = 65536
+
 # default EDC parameter
 DEFAULT_EDC = 1.35
 
+# residual statistic used to pick the best setting in a sweep of the EDC parameter (see CalibrationSweep): "rms",
+# "mean" (mean absolute), or "max" (maximum absolute) residual CCS of the calibrants (%)
+SWEEP_CRITERION = "rms"
+
 # nitrogen and helium mass
 N2_MASS = 28.0134
 HE_MASS = 4.0026
 
-# CCS Calibration power function initial parameters A, t0, and B
-INIT_A = 0.0
+# CCS Calibration power function initial parameters A, t0, and B, only used if they cannot be estimated from the
+# calibrants (see BatchCalCurveFit.seedCalCurve)
+INIT_A = 500.0
 INIT_T0 = 0.0
-INIT_B = 1.0
+INIT_B = 0.5
+
+# the initial t0 for the CCS calibration power function is picked from a scan of CAL_SEED_T0_STEPS values between
+# -CAL_SEED_T0_RANGE and +CAL_SEED_T0_RANGE times the shortest corrected drift time of the calibrants
+CAL_SEED_T0_RANGE = 0.9
+CAL_SEED_T0_STEPS = 37
+
+# which gaussian fit figures to generate: "none", "failed" (only failed or low quality fits), or "all"
+FIGURE_POLICY = "all"
+
+# minimum R^2 of a gaussian fit for it not to be considered low quality (for the "failed" figure policy)
+FIGURE_MIN_R2 = 0.9
+
+# (width, height) in pixels of the drift time profile thumbnails in the contact sheet
+CONTACT_SHEET_THUMBNAIL_SIZE = (160, 100)
+
+# number of worker threads that render figures in the background (0 to render figures as soon as they are requested)
+FIGURE_JOBS = 2
+
+# maximum number of figures waiting to be rendered in the background
+FIGURE_QUEUE_SIZE = 64
+
+# resolution of the rendered figures
+FIGURE_DPI = 500
 
 # height ratios for subplots in calibration curve figure
 HEIGHT_RATIO_1 = 5
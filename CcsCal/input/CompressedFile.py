@@ -0,0 +1,100 @@
+"""
+    CcsCal/input/CompressedFile.py
+    Dylan H. Ross
+        description:
+            Transparent reading of compressed raw data text files. Files ending in .gz (gzip), .xz (xz/lzma), or
+            .zst (zstd, only if the zstandard module is installed) are decompressed as a stream while they are
+            read, so they can be parsed or pre-processed without first writing a decompressed copy to disk.
+            Compressed files cannot be memory-mapped or seeked into efficiently, so anything that relies on
+            that (the fromstring text parser backend, MzIndex, and parallel parsing over byte ranges) falls back
+            to reading the stream from the beginning.
+"""
+
+
+import gzip
+import lzma
+from io import BufferedReader
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def openZstd(data_filename, mode="rb"):
+    """
+CompressedFile.openZstd
+
+Opens a zstd compressed file for reading as a stream of decompressed bytes (the same call signature as
+gzip.open and lzma.open)
+
+Input(s):
+    data_filename       - file name of the compressed file (string)
+    [mode               - only "rb" is supported (string), optional default="rb"]
+
+Returns:
+    f                   - decompressed stream, supports readline and readlines (io.BufferedReader)
+"""
+    return BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(data_filename, "rb"), closefd=True))
+
+
+# functions for opening each supported compressed file extension (in binary mode)
+OPENERS = {".gz": gzip.open, ".xz": lzma.open}
+if zstandard is not None:
+    OPENERS[".zst"] = openZstd
+
+
+def compressionExtension(data_filename):
+    """
+CompressedFile.compressionExtension
+
+Determines the compressed file extension of a file name
+
+Input(s):
+    data_filename       - file name of the raw data file (string)
+
+Returns:
+    extension           - compressed file extension (i.e. ".gz"), or None if the file name does not have one
+                            (string)
+"""
+    name = str(data_filename).lower()
+    for extension in (".gz", ".xz", ".zst"):
+        if name.endswith(extension):
+            return extension
+    return None
+
+
+def isCompressed(data_filename):
+    """
+CompressedFile.isCompressed
+
+Determines whether a raw data file is compressed (from its file name)
+
+Input(s):
+    data_filename       - file name of the raw data file (string)
+
+Returns:
+    compressed          - whether the file is compressed (bool)
+"""
+    return compressionExtension(data_filename) is not None
+
+
+def openDataFile(data_filename):
+    """
+CompressedFile.openDataFile
+
+Opens a raw data file for reading in binary mode, decompressing it as a stream if it is compressed. Raises
+a ValueError for .zst files if the zstandard module is not installed.
+
+Input(s):
+    data_filename       - file name of the raw data file (string)
+
+Returns:
+    f                   - raw data file, or stream of decompressed bytes (file)
+"""
+    extension = compressionExtension(data_filename)
+    if extension is None:
+        return open(data_filename, "rb")
+    if extension not in OPENERS:
+        raise ValueError("CompressedFile: openDataFile: the zstandard module is required to read " +
+                         extension + " files ('" + str(data_filename) + "')")
+    return OPENERS[extension](data_filename, "rb")
@@ -0,0 +1,235 @@
+"""
+    CcsCal/input/DataCache.py
+    Dylan H. Ross
+        description:
+            Persistent binary columnar cache for raw data text files. The m/z, dtbin, and intensity columns
+            of a parsed raw data file are written to binary files (float64, int16, and float64 respectively)
+            that are memory-mapped on later loads, so the text file does not need to be parsed again.
+"""
+
+
+from CcsCal import globals
+
+
+from os import getpid, listdir, makedirs, remove, replace, stat, utime
+from os.path import abspath, basename, dirname, getsize, isfile, join, splitext
+from hashlib import sha1
+from json import dump, load
+from numpy import memmap, zeros
+
+
+# column names and the types they are stored with, the intensities are kept as float64 so that cached data gives
+# the same drift time profiles as parsing the text file
+COLUMNS = (("mz", "float64"), ("dt", "int16"), ("int", "float64"))
+
+
+def fileFingerprint(data_filename, hash_block=globals.DATA_CACHE_HASH_BLOCK):
+    """
+DataCache.fileFingerprint
+
+Identifies the contents of a file using its size, modification time, and a hash of its first
+and last blocks (hashing the entire file would take about as long as parsing it)
+
+Input(s):
+    data_filename       - file name of the raw data file (string)
+    [hash_block         - size of the blocks at the start and end of the file to hash (in bytes)
+                            (int), optional default=globals.DATA_CACHE_HASH_BLOCK]
+
+Returns:
+    fingerprint         - size, mtime, and hash of the file (dict)
+"""
+    st = stat(data_filename)
+    h = sha1()
+    with open(data_filename, "rb") as f:
+        h.update(f.read(hash_block))
+        if st.st_size > hash_block:
+            f.seek(max(hash_block, st.st_size - hash_block))
+            h.update(f.read(hash_block))
+    return {"size": st.st_size, "mtime": st.st_mtime, "hash": h.hexdigest()}
+
+
+class DataCache:
+
+    def __init__(self, cache_dir=globals.DATA_CACHE_DIR, max_size=globals.DATA_CACHE_MAX_SIZE):
+        """
+DataCache.__init__
+
+Initializes a new DataCache object. Each cache entry consists of one binary file per column and a
+.json file with the fingerprint of the source file (used to invalidate the entry if the source file
+changes). The modification time of the .json file records when the entry was last used, and the
+least recently used entries are evicted when the total size of a cache directory exceeds max_size.
+
+Input(s):
+    [cache_dir          - directory to store the cache entries in, if None then the entries are
+                            stored in a .ccscal_cache directory next to each source file (string),
+                            optional default=globals.DATA_CACHE_DIR]
+    [max_size           - maximum total size of the entries in a cache directory (in bytes) (int),
+                            optional default=globals.DATA_CACHE_MAX_SIZE]
+"""
+        self.cacheDir = cache_dir
+        self.maxSize = max_size
+
+    def entryPaths(self, data_filename):
+        """
+DataCache.entryPaths
+
+Determines the paths of the files making up the cache entry for a source file
+
+Input(s):
+    data_filename       - file name of the raw data file (string)
+
+Returns:
+    meta_path           - path to the .json file with the source file fingerprint (string)
+    column_paths        - paths to the binary column files (list(string))
+"""
+        path = abspath(data_filename)
+        cache_dir = self.cacheDir if self.cacheDir is not None else join(dirname(path), ".ccscal_cache")
+        key = sha1(path.encode()).hexdigest()[:16]
+        stem = join(cache_dir, splitext(basename(path))[0] + "." + key)
+        return stem + ".json", [stem + "." + name for name, _ in COLUMNS]
+
+    def load(self, data_filename):
+        """
+DataCache.load
+
+Memory-maps the cached columns for a source file, if there is a valid cache entry for it
+
+Input(s):
+    data_filename       - file name of the raw data file (string)
+
+Returns:
+    data                - mass, dtbin, and intensity columns, or None if there is no valid cache
+                            entry (list(numpy.memmap))
+"""
+        meta_path, column_paths = self.entryPaths(data_filename)
+        if not isfile(meta_path):
+            return None
+        try:
+            with open(meta_path, "r") as f:
+                meta = load(f)
+            if meta["fingerprint"] != fileFingerprint(data_filename) or \
+                    meta.get("columns") != [list(column) for column in COLUMNS] or \
+                    meta.get("version") != globals.DATA_CACHE_VERSION:
+                # the source file has changed since the entry was written, or the entry was written with
+                # different column types or by a different version
+                self.removeEntry(meta_path)
+                return None
+            n_rows = meta["n_rows"]
+            if n_rows == 0:
+                data = [zeros(0, dtype=dt) for _, dt in COLUMNS]
+            else:
+                data = [memmap(path, dtype=dt, mode="r", shape=(n_rows,))
+                        for path, (_, dt) in zip(column_paths, COLUMNS)]
+            # mark the entry as recently used
+            utime(meta_path)
+            return data
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def store(self, data_filename, data):
+        """
+DataCache.store
+
+Writes a cache entry with the columns of a parsed source file, then evicts the least recently used
+entries if the cache directory has grown larger than the maximum size. Entries that cannot be written
+(i.e. in a read-only directory) are skipped.
+
+Input(s):
+    data_filename       - file name of the raw data file (string)
+    data                - array with the mass, dtbin, and intensity values (numpy.array)
+
+Returns:
+    stored              - whether the entry was written (bool)
+"""
+        meta_path, column_paths = self.entryPaths(data_filename)
+        # files are written under temporary names first so that other processes never load partially written files
+        tmp = "." + str(getpid()) + ".tmp"
+        try:
+            makedirs(dirname(meta_path), exist_ok=True)
+            for column, path, (_, dt) in zip(data, column_paths, COLUMNS):
+                column.astype(dt).tofile(path + tmp)
+                replace(path + tmp, path)
+            # the .json file is written last so that only complete entries are ever loaded
+            with open(meta_path + tmp, "w") as f:
+                dump({"source": abspath(data_filename),
+                      "fingerprint": fileFingerprint(data_filename),
+                      "n_rows": int(len(data[0])),
+                      "columns": [list(column) for column in COLUMNS],
+                      "version": globals.DATA_CACHE_VERSION}, f)
+            replace(meta_path + tmp, meta_path)
+        except OSError:
+            return False
+        self.evict(dirname(meta_path), keep=meta_path)
+        return True
+
+    def loadOrParse(self, data_filename, parse):
+        """
+DataCache.loadOrParse
+
+Loads the columns for a source file from the cache, or parses the source file and stores the result
+in the cache if there is no valid cache entry
+
+Input(s):
+    data_filename       - file name of the raw data file (string)
+    parse               - function that parses the raw data file into an array with the mass, dtbin,
+                            and intensity values (callable)
+
+Returns:
+    data                - mass, dtbin, and intensity columns (list(numpy.array))
+"""
+        data = self.load(data_filename)
+        if data is None:
+            data = parse(data_filename)
+            if self.store(data_filename, data):
+                # use the memory-mapped columns so that the data is the same whether or not it was cached
+                cached = self.load(data_filename)
+                if cached is not None:
+                    data = cached
+        return data
+
+    def removeEntry(self, meta_path):
+        """
+DataCache.removeEntry
+
+Removes all of the files belonging to a cache entry
+
+Input(s):
+    meta_path           - path to the .json file of the cache entry (string)
+"""
+        stem = splitext(meta_path)[0]
+        for path in [meta_path] + [stem + "." + name for name, _ in COLUMNS]:
+            try:
+                remove(path)
+            except OSError:
+                pass
+
+    def evict(self, cache_dir, keep=None):
+        """
+DataCache.evict
+
+Removes the least recently used entries from a cache directory until its total size is below the
+maximum size
+
+Input(s):
+    cache_dir           - cache directory to evict entries from (string)
+    [keep               - path to the .json file of an entry to never evict (string), optional
+                            default=None]
+"""
+        entries = []
+        for name in listdir(cache_dir):
+            if name.endswith(".json"):
+                meta_path = join(cache_dir, name)
+                stem = splitext(meta_path)[0]
+                try:
+                    size = sum([getsize(p) for p in [meta_path] + [stem + "." + c for c, _ in COLUMNS] if isfile(p)])
+                    entries.append((stat(meta_path).st_mtime, size, meta_path))
+                except OSError:
+                    # the entry was removed while the directory was being listed
+                    pass
+        total = sum([size for _, size, _ in entries])
+        for _, size, meta_path in sorted(entries):
+            if total <= self.maxSize:
+                break
+            if meta_path != keep:
+                self.removeEntry(meta_path)
+                total -= size
@@ -0,0 +1,80 @@
+"""
+    CcsCal/input/IMMatrix.py
+    Dylan H. Ross
+        description:
+            Sparse m/z x dtbin matrix representation of a raw data file. The file is loaded a single time, then
+            the drift time profile for any mass window is obtained by summing a contiguous range of rows, so one
+            IMMatrix can serve any number of extractions without parsing the file again.
+"""
+
+
+from CcsCal import globals
+
+
+from numpy import array, arange, amax, append, bincount, nonzero, diff, searchsorted
+from scipy.sparse import csr_matrix
+
+
+class IMMatrix:
+
+    def __init__(self, data_filename, n_dtbins=globals.N_DTBINS, cache=globals.USE_DATA_CACHE):
+        """
+IMMatrix.__init__
+
+Initializes a new IMMatrix object, loading the entire raw data file (see RawData.loadData) into a compressed
+sparse row matrix with one row per unique m/z value (in sorted order), one column per dtbin, and the
+intensities as the values (rows with a dtbin less than 1 are left out):
+    IMMatrix.mz             - m/z value of each row (numpy.array)
+    IMMatrix.matrix         - m/z x dtbin intensity matrix (scipy.sparse.csr_matrix)
+
+The IMMatrix can be used in place of a raw data file name in RawData, MultiMassExtractor, and
+CcsCalibration.
+
+Input(s):
+    data_filename       - file name of the raw data file (string)
+    [n_dtbins           - minimum number of dtbins (columns), more are used if the data contains larger
+                            dtbins (int), optional default=globals.N_DTBINS]
+    [cache              - whether to load the data through the DataCache (bool), optional
+                            default=globals.USE_DATA_CACHE]
+"""
+        # imported here because RawData imports IMMatrix
+        from CcsCal.input.RawData import loadData
+        self.dataFileName = data_filename
+        # the columns are loaded the same way as for RawData (sorted by mass, and through the same DataCache entry)
+        data = loadData(data_filename, cache=cache)
+        mz, dtbin, intensity = array(data[0]), array(data[1]).astype(int), array(data[2], dtype=float)
+        # dtbins start at 1, anything below that has no column to go in (the same as RawData.fineFilterForMass)
+        valid = dtbin >= 1
+        mz, dtbin, intensity = mz[valid], dtbin[valid], intensity[valid]
+        self.nDtBins = n_dtbins
+        if len(dtbin) > 0:
+            self.nDtBins = max(n_dtbins, int(amax(dtbin)))
+        # loadData sorts the data by m/z, so each row starts where the m/z value changes
+        starts = append([0], nonzero(diff(mz))[0] + 1) if len(mz) > 0 else array([], dtype=int)
+        self.mz = mz[starts]
+        self.matrix = csr_matrix((intensity, dtbin - 1, append(starts, len(mz))),
+                                 shape=(len(self.mz), self.nDtBins))
+
+    def driftProfile(self, specified_mass, mass_window):
+        """
+IMMatrix.driftProfile
+
+Sums the rows with m/z values within a mass window into a 2D array of dtbin and intensity values (the same
+as RawData.dtBinAndIntensity). The rows within the window are found with a binary search on the sorted m/z
+values, then the values stored for that contiguous range of rows are summed into their dtbins.
+
+Input(s):
+    specified_mass      - mass to extract data for (float)
+    mass_window         - window of masses to bin data together for (float)
+
+Returns:
+    dt_bin_and_intensity    - array with dtbin and intensity values (numpy.array)
+"""
+        first = searchsorted(self.mz, specified_mass - mass_window, side="left")
+        last = searchsorted(self.mz, specified_mass + mass_window, side="right")
+        start, stop = self.matrix.indptr[first], self.matrix.indptr[last]
+        return array([arange(1, self.nDtBins + 1),
+                      bincount(self.matrix.indices[start:stop], weights=self.matrix.data[start:stop],
+                               minlength=self.nDtBins)],
+                     dtype=float)
+
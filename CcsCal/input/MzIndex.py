@@ -0,0 +1,206 @@
+"""
+    CcsCal/input/MzIndex.py
+    Dylan H. Ross
+        description:
+            Sparse index of a raw data text file (sorted by m/z) that maps m/z values to byte offsets every N
+            lines. The index is stored in a sidecar file next to the raw data file so that it only needs to be
+            built once, and lets the pre-processing seek directly to the part of the file containing a mass
+            window instead of reading the file from the beginning.
+"""
+
+
+from CcsCal import globals
+from CcsCal.input.DataCache import fileFingerprint
+
+
+from os import getpid, replace
+from zipfile import BadZipFile
+from json import dumps, loads
+from numpy import (amax, any, arange, argmax, concatenate, diff, frombuffer, full, load, nan, nonzero, ones, savez,
+                   searchsorted, zeros)
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+class MzIndex:
+
+    def __init__(self, data_filename, stride=globals.MZ_INDEX_STRIDE):
+        """
+MzIndex.__init__
+
+Initializes a new MzIndex object, loading the index from its sidecar file if the sidecar file exists and
+matches the current raw data file, or building the index (and writing the sidecar file) otherwise. The
+index is kept in memory only if the sidecar file cannot be written.
+
+The index consists of two arrays, and whether the file is sorted by m/z:
+    MzIndex.mz          - m/z value of every stride-th line (numpy.array)
+    MzIndex.offsets     - byte offset of the start of every stride-th line (numpy.array)
+    MzIndex.sorted      - whether every line of the file is in order of m/z, if not then the index cannot be
+                            used to find the lines within a mass window (bool)
+
+Input(s):
+    data_filename       - file name of the raw data file (string)
+    [stride             - number of lines between index entries (int), optional
+                            default=globals.MZ_INDEX_STRIDE]
+"""
+        self.dataFileName = data_filename
+        self.stride = stride
+        # the whole file name is kept (i.e. run.txt and run.txt.gz do not share a sidecar file)
+        self.sidecarFileName = data_filename + ".mzidx.npz"
+        self.mz, self.offsets, self.sorted = None, None, True
+        if not self.loadSidecar():
+            self.build()
+            self.saveSidecar()
+
+    def loadSidecar(self):
+        """
+MzIndex.loadSidecar
+
+Loads the index from the sidecar file, as long as it was built from the current raw data file with the
+same stride
+
+Input(s):
+    none
+
+Returns:
+    loaded              - whether the index was loaded (bool)
+"""
+        try:
+            with load(self.sidecarFileName) as sidecar:
+                if int(sidecar["stride"]) != self.stride or \
+                        loads(str(sidecar["fingerprint"])) != fileFingerprint(self.dataFileName):
+                    return False
+                self.mz, self.offsets, self.sorted = sidecar["mz"], sidecar["offsets"], bool(sidecar["sorted"])
+            return True
+        except (OSError, ValueError, KeyError, BadZipFile):
+            return False
+
+    def saveSidecar(self):
+        """
+MzIndex.saveSidecar
+
+Writes the index to the sidecar file, does nothing if the sidecar file cannot be written (i.e. in a
+read-only directory)
+
+Input(s):
+    none
+"""
+        # write to a temporary file first so that other processes never load a partially written sidecar file
+        tmp_file_name = self.sidecarFileName + "." + str(getpid()) + ".tmp"
+        try:
+            with open(tmp_file_name, "wb") as f:
+                savez(f, mz=self.mz, offsets=self.offsets, sorted=self.sorted, stride=self.stride,
+                      fingerprint=dumps(fileFingerprint(self.dataFileName)))
+            replace(tmp_file_name, self.sidecarFileName)
+        except OSError:
+            pass
+
+    def build(self, chunk_size=globals.TEXT_PARSER_CHUNK_SIZE):
+        """
+MzIndex.build
+
+Builds the index by reading through the raw data file once in chunks of lines, recording the m/z value and
+byte offset of every stride-th line, and checking that all of the lines are in order of m/z. The line
+offsets and m/z values of each chunk are found from the positions of its newlines and whitespace (see
+MzIndex.chunkLines), rather than going through the file one line at a time.
+
+Input(s):
+    [chunk_size         - approximate size (in bytes) of the chunks of lines read at a time (int), optional
+                            default=globals.TEXT_PARSER_CHUNK_SIZE]
+"""
+        mz, offsets = [], []
+        # byte offset of the start of the chunk, number of (non-blank) lines before it, and the last m/z value
+        offset, n_lines, last_mz = 0, 0, None
+        self.sorted = True
+        with open(self.dataFileName, "rb") as f:
+            remainder = b""
+            while True:
+                block = f.read(chunk_size)
+                chunk = remainder + block
+                if not block:
+                    remainder = b""
+                else:
+                    # only complete lines are indexed, the rest is carried over to the next chunk
+                    end = chunk.rfind(b"\n") + 1
+                    chunk, remainder = chunk[:end], chunk[end:]
+                if chunk:
+                    chunk_mz, starts = self.chunkLines(chunk)
+                    if len(chunk_mz) > 0:
+                        if (last_mz is not None and chunk_mz[0] < last_mz) or any(diff(chunk_mz) < 0):
+                            self.sorted = False
+                        last_mz = chunk_mz[-1]
+                        sampled = arange((-n_lines) % self.stride, len(chunk_mz), self.stride)
+                        mz.append(chunk_mz[sampled])
+                        offsets.append(offset + starts[sampled])
+                        n_lines += len(chunk_mz)
+                    offset += len(chunk)
+                if not block:
+                    break
+        self.mz = concatenate(mz).astype(float) if mz else zeros(0)
+        self.offsets = concatenate(offsets).astype("int64") if offsets else zeros(0, dtype="int64")
+
+    def chunkLines(self, chunk):
+        """
+MzIndex.chunkLines
+
+Finds the m/z value (the first value) and byte offset of each non-blank line in a chunk of complete lines of
+the raw data file. The m/z values of all of the lines are sliced out of the chunk at once and converted to
+numbers in a single call, only lines that start with whitespace (or have a very long first value) are handled
+one at a time.
+
+Input(s):
+    chunk               - complete lines of the raw data file (bytes)
+
+Returns:
+    mz                  - m/z value of each non-blank line (numpy.array)
+    starts              - byte offset of the start of each non-blank line, relative to the start of the chunk
+                            (numpy.array)
+"""
+        # padded so that there is a full window of bytes after the start of every line
+        buf = frombuffer(chunk + b" " * (globals.MZ_INDEX_MAX_TOKEN + 1), dtype="uint8")
+        starts = concatenate([[0], nonzero(buf[:len(chunk)] == ord("\n"))[0] + 1])
+        starts = starts[starts < len(chunk)]
+        # the first bytes of every line, the m/z value ends at the first whitespace (or line ending)
+        windows = sliding_window_view(buf, globals.MZ_INDEX_MAX_TOKEN + 1)[starts]
+        lengths = argmax(windows <= ord(" "), axis=1)
+        # lines that start with whitespace (or are blank) or have a very long first value have a length of 0
+        simple = lengths > 0
+        mz = full(len(starts), nan)
+        if any(simple):
+            width = int(amax(lengths[simple]))
+            tokens = windows[simple, :width].copy()
+            # the bytes after the end of each value are nulls, which are dropped from fixed width byte strings
+            tokens[arange(width) >= lengths[simple, None]] = 0
+            mz[simple] = tokens.view("S{}".format(width)).ravel().astype(float)
+        non_blank = ones(len(starts), dtype=bool)
+        for i in nonzero(~simple)[0]:
+            stop = chunk.find(b"\n", starts[i])
+            fields = chunk[starts[i]:(len(chunk) if stop < 0 else stop)].split(None, 1)
+            if fields:
+                mz[i] = float(fields[0])
+            else:
+                non_blank[i] = False
+        return mz[non_blank], starts[non_blank]
+
+    def byteRange(self, min_mass, max_mass):
+        """
+MzIndex.byteRange
+
+Determines the range of bytes in the raw data file that contains all of the lines with m/z values
+within a mass window
+
+Input(s):
+    min_mass            - minimum mass of the window (float)
+    max_mass            - maximum mass of the window (float)
+
+Returns:
+    start               - byte offset to start reading from (int)
+    stop                - byte offset to stop reading at, or None to read to the end of the file (int)
+"""
+        # the lines within the window could be anywhere in a file that is not sorted by m/z
+        if len(self.mz) == 0 or not self.sorted:
+            return 0, None
+        # the last index entry below the window, all lines within the window come after it
+        start = searchsorted(self.mz, min_mass, side="left") - 1
+        # the first index entry above the window, all lines within the window come before it
+        stop = searchsorted(self.mz, max_mass, side="right")
+        return int(self.offsets[max(start, 0)]), (int(self.offsets[stop]) if stop < len(self.offsets) else None)
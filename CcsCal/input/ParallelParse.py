@@ -0,0 +1,123 @@
+"""
+    CcsCal/input/ParallelParse.py
+    Dylan H. Ross
+        description:
+            Parses a single large raw data text file using multiple worker processes. The file is split into byte
+            ranges that start and end on line boundaries, each range is parsed by a worker, and the resulting rows
+            are concatenated in order. Since the file is sorted by m/z, when only some mass windows are needed a
+            worker skips its range entirely (without parsing it) if the range does not overlap any of them.
+"""
+
+
+from CcsCal import globals
+from CcsCal.input.CompressedFile import isCompressed
+from CcsCal.input.TextParser import checkBackend, parseLines, parseText
+from CcsCal.input.PreProcessTxt import mergeMassWindows, preProcessTxt
+
+
+from concurrent.futures import ProcessPoolExecutor
+from os.path import getsize
+from numpy import concatenate, searchsorted, zeros
+
+
+def splitByteRanges(data_filename, n_ranges):
+    """
+ParallelParse.splitByteRanges
+
+Splits a file into (approximately) equally sized byte ranges, moving the boundaries between ranges forward
+to the start of the next line so that no line is split between two ranges
+
+Input(s):
+    data_filename       - file name of the raw data file (string)
+    n_ranges            - number of byte ranges to split the file into (int)
+
+Returns:
+    byte_ranges         - (start, stop) byte offsets of each range (list(tuple(int, int)))
+"""
+    size = getsize(data_filename)
+    boundaries = [0]
+    with open(data_filename, "rb") as f:
+        for n in range(1, n_ranges):
+            offset = max(boundaries[-1], (size * n) // n_ranges)
+            if offset >= size:
+                break
+            f.seek(offset)
+            # move forward to the start of the next line
+            f.readline()
+            offset = f.tell()
+            if offset > boundaries[-1] and offset < size:
+                boundaries.append(offset)
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def parseByteRange(data_filename, start, stop, mass_windows=None, backend=None):
+    """
+ParallelParse.parseByteRange
+
+Parses the lines within a byte range of a raw data file, keeping only rows within a set of mass windows if
+provided. If none of the mass windows overlap the range of m/z values in the byte range (determined from its
+first and last lines) then it is not parsed at all. This is a module-level function so that it can be sent
+to worker processes.
+
+Input(s):
+    data_filename       - file name of the raw data file (string)
+    start               - byte offset of the start of the range (int)
+    stop                - byte offset of the end of the range (int)
+    [mass_windows       - (minimum mass, maximum mass) windows to keep rows for, or None to keep all rows
+                            (list(tuple(float, float))), optional default=None]
+    [backend            - name of the TextParser backend to use (string), optional default=None]
+
+Returns:
+    rows                - array of rows (numpy.array)
+"""
+    with open(data_filename, "rb") as f:
+        f.seek(start)
+        lines = f.read(stop - start).splitlines(True)
+    lines = [line for line in lines if line.strip()]
+    if not lines:
+        return zeros([0, 3])
+    if mass_windows is None:
+        return parseLines(lines, backend=backend)
+    min_masses, max_masses = mergeMassWindows(mass_windows)
+    first, last = float(lines[0].split()[0]), float(lines[-1].split()[0])
+    # the first window that ends at or above the first m/z value must start at or below the last m/z value
+    window = searchsorted(max_masses, first, side="left")
+    if window >= len(min_masses) or min_masses[window] > last:
+        return zeros([0, 3])
+    rows = parseLines(lines, backend=backend)
+    window = searchsorted(min_masses, rows[:, 0], side="right") - 1
+    return rows[(window >= 0) & (rows[:, 0] <= max_masses[window])]
+
+
+def parallelParseText(data_filename, jobs=globals.PARSE_JOBS, mass_windows=None, backend=None):
+    """
+ParallelParse.parallelParseText
+
+Parses a raw data text file into columns (the same as genfromtxt(filename, unpack=True)) using multiple
+worker processes, optionally keeping only the rows within a set of mass windows. Compressed files cannot be
+split into byte ranges, so they are decompressed as a stream and parsed (or pre-processed) in this process.
+
+Input(s):
+    data_filename       - file name of the raw data file (string)
+    [jobs               - number of worker processes (int), optional default=globals.PARSE_JOBS]
+    [mass_windows       - (minimum mass, maximum mass) windows to keep rows for, or None to keep all rows
+                            (list(tuple(float, float))), optional default=None]
+    [backend            - name of the TextParser backend to use (string), optional default=None]
+
+Returns:
+    columns             - array with the mass, dtbin, and intensity values (numpy.array)
+"""
+    # resolve the backend here so that all of the workers use the same one
+    backend = checkBackend(backend)
+    if isCompressed(data_filename):
+        if mass_windows is None:
+            return parseText(data_filename, backend=backend)
+        return preProcessTxt(data_filename, mass_windows)
+    byte_ranges = splitByteRanges(data_filename, jobs * globals.PARALLEL_PARSE_RANGES_PER_JOB)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(parseByteRange, data_filename, start, stop, mass_windows=mass_windows,
+                                   backend=backend)
+                   for start, stop in byte_ranges]
+        rows = [future.result() for future in futures]
+    return concatenate(rows).T if rows else zeros([3, 0])
@@ -8,6 +8,8 @@ from numpy import genfromtxt, array
 class ParseInputFile:
 
     def __init__(self, input_filename):
+        # optional saved calibration artifact (cal), set by getInputParams if it is in the input file
+        self.calibrationFile = None
         # take in the input parameters
         self.rawData = self.getInputParams(input_filename)
         # unpack the single parameters into easy to access fields
@@ -30,12 +32,16 @@ params contents by index:
     params[0][3]            - TOF pusher interval
     params[0][4]            - Savitsky-Golay smooth window
     params[0][5]            - Savitsky-Golay smooth polynomial order
-    params[1][0]            - full path and name to save calibration curve file under
-    params[1][1]            - full path and name of the CCS calibration data file
+    params[1][0]            - full path and name to save calibration curve file under (None if omitted)
+    params[1][1]            - full path and name of the CCS calibration data file (None if omitted)
     params[2][0]            - full path to the directory containing the compound data files
     params[3]               - array containing the list data (calibrant masses and lit ccs
                                 values, compound data file names and masses)
 
+The optional cal parameter (a saved calibration artifact, see CcsCalibration.saveCalibration)
+can appear anywhere before crd and is stored directly in self.calibrationFile. When it is
+present the cff and cdf parameters and the calibrant list may be omitted.
+
 ### TODO:   FIX THIS CRAP, this system is terrible because it breaks if any of the
 ###         keywords are omitted or out of order
 
@@ -48,7 +54,8 @@ Returns:
 """
         ### TODO:   FIX THIS CRAP, this system is terrible because it breaks if any of the
         ###         keywords are omitted
-        params = [[],[],[]]
+        # cff and cdf are optional, so they are stored by key rather than appended in order
+        params = [[],[None, None],[]]
         with open(filename) as input:
             done = False
             for line in input:
@@ -66,14 +73,18 @@ Returns:
                     elif line.split()[0] == ";sgp":
                         params[0].append(line.split()[2])
                     elif line.split()[0] == ";cff":
-                        params[1].append(line.split()[2])
+                        params[1][0] = line.split()[2]
                     elif line.split()[0] == ";cdf":
-                        params[1].append(line.split()[2])
+                        params[1][1] = line.split()[2]
+                    elif line.split()[0] == ";cal":
+                        self.calibrationFile = line.split()[2]
                     elif line.split()[0] == ";crd":
                         params[2].append(line.split()[2])
                         done = True
                 else:
                     break
+        # the list data mix numbers with words (the compound keyword and the compound data file names) so they are
+        # read as strings, which the numeric backends in TextParser cannot do
         params.append(genfromtxt(filename, dtype=str, comments=";"))
         return params
 
@@ -96,6 +107,7 @@ unpacked parameters:
     self.calCurveFileName   <- cff
     self.calDataFile        <- cdf
     self.compoundDataDir    <- crd
+    (self.calCurveFileName and self.calDataFile are None if they were omitted)
 
     TODO:   FIX THIS CRAP, this system is terrible because it breaks if any of the
             keywords are omitted
@@ -168,6 +180,7 @@ unpacked parameters:
     self.calCurveFileName   <- cff
     self.calDataFile        <- cdf
     self.compoundDataDir    <- crd
+    self.calibrationFile    <- cal
 
     parameters:
         none
@@ -180,7 +193,8 @@ unpacked parameters:
         out += "TOFPusherInt     (tpi) = {: 6.3f}\n".format(self.TOFPusherInt)
         out += "savgolWindow     (sgw) = {: 3d}\n".format(self.savgolWindow)
         out += "savgolPoly       (sgp) = {: 3d}\n".format(self.savgolPoly)
-        out += "calCurveFileName (cff) = '{:s}'\n".format(self.calCurveFileName)
-        out += "calDataFile      (cdf) = '{:s}'\n".format(self.calDataFile)
+        out += "calCurveFileName (cff) = '{:s}'\n".format(str(self.calCurveFileName))
+        out += "calDataFile      (cdf) = '{:s}'\n".format(str(self.calDataFile))
         out += "compoundDataDir  (crd) = '{:s}'\n".format(self.compoundDataDir)
+        out += "calibrationFile  (cal) = '{:s}'\n".format(str(self.calibrationFile))
         return out
@@ -0,0 +1,140 @@
+"""
+    CcsCal/input/ParserBenchmark.py
+    Dylan H. Ross
+        description:
+            Benchmarks each of the available TextParser backends on a synthetic raw data file, reporting the
+            parsing rate (rows/sec) and peak memory use (RSS) of each. Each backend is run in its own process so
+            that the peak memory use of one does not affect the others. Run with:
+                python -m CcsCal.input.ParserBenchmark [--rows N] [--repeats N]
+"""
+
+
+from CcsCal.input.TextParser import BACKENDS, parseText
+
+
+import argparse
+import time
+from multiprocessing import Process, Queue
+from os import close, remove
+from tempfile import mkstemp
+from numpy import argsort, column_stack, savetxt
+from numpy.random import RandomState
+try:
+    from resource import getrusage, RUSAGE_SELF
+except ImportError:
+    # peak memory use is not reported where the resource module is not available (i.e. Windows)
+    getrusage = None
+
+
+def writeSyntheticData(filename, n_rows, seed=1234):
+    """
+ParserBenchmark.writeSyntheticData
+
+Writes a synthetic raw data file (m/z, dtbin, intensity sorted by m/z) with a given number of rows
+
+Input(s):
+    filename            - name of the file to write (string)
+    n_rows              - number of rows (int)
+    [seed               - random seed (int), optional default=1234]
+"""
+    rs = RandomState(seed)
+    mz = rs.uniform(50., 1500., n_rows)
+    data = column_stack([mz, rs.randint(1, 201, n_rows), rs.uniform(0., 1000., n_rows)])[argsort(mz)]
+    savetxt(filename, data, fmt=["%.4f", "%d", "%.1f"])
+
+
+def peakRss():
+    """
+ParserBenchmark.peakRss
+
+Returns the peak resident set size of this process in MB, or None if it cannot be determined
+
+Input(s):
+    none
+
+Returns:
+    peak_rss            - peak resident set size in MB (float)
+"""
+    if getrusage is None:
+        return None
+    # ru_maxrss is reported in kB on Linux (it is in bytes on macOS, but the difference is not worth the bother)
+    return getrusage(RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def benchmarkBackend(filename, backend, repeats, queue):
+    """
+ParserBenchmark.benchmarkBackend
+
+Parses a file with a backend a number of times and puts the best time, number of rows, and peak RSS
+(before and after parsing) on a queue. Runs in a separate process.
+
+Input(s):
+    filename            - name of the file to parse (string)
+    backend             - name of the TextParser backend (string)
+    repeats             - number of times to parse the file (int)
+    queue               - queue to put the results on (multiprocessing.Queue)
+"""
+    try:
+        baseline = peakRss()
+        best, n_rows = None, 0
+        for _ in range(repeats):
+            start = time.perf_counter()
+            n_rows = parseText(filename, backend=backend).shape[1]
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        queue.put((backend, best, n_rows, baseline, peakRss(), None))
+    except Exception as e:
+        queue.put((backend, None, 0, None, None, "{}: {}".format(type(e).__name__, e)))
+
+
+def runBenchmark(n_rows, repeats):
+    """
+ParserBenchmark.runBenchmark
+
+Writes a synthetic raw data file, benchmarks each available backend on it, and prints a table of the
+results
+
+Input(s):
+    n_rows              - number of rows in the synthetic raw data file (int)
+    repeats             - number of times to parse the file with each backend (int)
+"""
+    fd, filename = mkstemp(suffix=".txt", prefix="IM_benchmark_")
+    close(fd)
+    try:
+        print("writing synthetic raw data file with", n_rows, "rows...")
+        writeSyntheticData(filename, n_rows)
+        print()
+        print("backend         rows/sec        peak RSS (MB)   parsing RSS (MB)")
+        print("------------------------------------------------------------------")
+        for backend in BACKENDS:
+            queue = Queue()
+            p = Process(target=benchmarkBackend, args=(filename, backend, repeats, queue))
+            p.start()
+            backend, best, rows, baseline, peak, error = queue.get()
+            p.join()
+            if error is not None:
+                print("{:15s} FAILED: {:s}".format(backend, error))
+            elif peak is None:
+                print("{:15s} {:12.0f}    {:>13s}   {:>16s}".format(backend, rows / best, "n/a", "n/a"))
+            else:
+                print("{:15s} {:12.0f}    {:13.1f}   {:16.1f}".format(backend, rows / best, peak, peak - baseline))
+    finally:
+        remove(filename)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="benchmarks the TextParser backends on a synthetic raw data file")
+    parser.add_argument('--rows',
+                        required=False,
+                        help='number of rows in the synthetic raw data file',
+                        dest='rows',
+                        type=int,
+                        default=1000000)
+    parser.add_argument('--repeats',
+                        required=False,
+                        help='number of times to parse the file with each backend (the best time is reported)',
+                        dest='repeats',
+                        type=int,
+                        default=3)
+    args = parser.parse_args()
+    runBenchmark(args.rows, args.repeats)
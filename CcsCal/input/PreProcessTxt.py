@@ -0,0 +1,162 @@
+"""
+    CcsCal/input/PreProcessTxt.py
+    Dylan H. Ross
+        description:
+            In-process replacement for PreProcessTxt.exe. Reads a raw data text file (sorted by m/z) in
+            chunks and returns only the rows with masses within one or more mass windows, without writing
+            a pre-processed file to disk.
+"""
+
+
+from CcsCal import globals
+from CcsCal.input.CompressedFile import isCompressed, openDataFile
+from CcsCal.input.TextParser import parseLines
+
+
+from numpy import array, zeros, searchsorted, argsort, concatenate
+
+
+def mergeMassWindows(mass_windows):
+    """
+PreProcessTxt.mergeMassWindows
+
+Sorts a list of (minimum mass, maximum mass) windows and merges any that overlap, so that
+the resulting windows are disjoint and in increasing order
+
+Input(s):
+    mass_windows        - (minimum mass, maximum mass) windows (list(tuple(float, float)))
+
+Returns:
+    min_masses          - minimum masses of the merged windows (numpy.array)
+    max_masses          - maximum masses of the merged windows (numpy.array)
+"""
+    windows = array(mass_windows, dtype=float).reshape(-1, 2)
+    windows = windows[argsort(windows[:, 0], kind="mergesort")]
+    merged = []
+    for min_mass, max_mass in windows:
+        if merged and min_mass <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], max_mass)
+        else:
+            merged.append([min_mass, max_mass])
+    merged = array(merged, dtype=float).reshape(-1, 2)
+    return merged[:, 0], merged[:, 1]
+
+
+def streamMassWindows(f, min_masses, max_masses, chunk_size):
+    """
+PreProcessTxt.streamMassWindows
+
+Reads lines from the current position of a raw data text file (sorted by m/z) in chunks, skipping
+chunks that lie entirely outside of the mass windows without parsing them and stopping as soon as
+the m/z values pass the last mass window
+
+Input(s):
+    f                   - raw data file, opened in binary mode (file)
+    min_masses          - minimum masses of the (merged) mass windows (numpy.array)
+    max_masses          - maximum masses of the (merged) mass windows (numpy.array)
+    chunk_size          - approximate size of the chunks of lines to read (in bytes) (int)
+
+Returns:
+    kept                - arrays with the rows within the mass windows (list(numpy.array))
+"""
+    kept = []
+    while True:
+        lines = f.readlines(chunk_size)
+        if not lines:
+            break
+        # the file is sorted by m/z, so if the first and last lines in the chunk fall in the same gap
+        # between (or below) the mass windows then the whole chunk can be skipped without parsing it
+        first, last = lines[0].split(), lines[-1].split()
+        if first and last:
+            # stop reading once the m/z values have passed the last mass window
+            if float(first[0]) > max_masses[-1]:
+                break
+            first_window = searchsorted(min_masses, float(first[0]), side="right") - 1
+            last_window = searchsorted(min_masses, float(last[0]), side="right") - 1
+            if first_window == last_window and (first_window < 0 or
+                                                float(first[0]) > max_masses[first_window]):
+                continue
+        chunk = parseLines(lines)
+        if chunk.shape[0] == 0:
+            continue
+        # keep only the rows that fall within one of the mass windows
+        window = searchsorted(min_masses, chunk[:, 0], side="right") - 1
+        in_window = (window >= 0) & (chunk[:, 0] <= max_masses[window])
+        kept.append(chunk[in_window])
+        # stop reading once the m/z values have passed the last mass window
+        if chunk[-1, 0] > max_masses[-1]:
+            break
+    return kept
+
+
+def preProcessTxt(data_filename, mass_windows, chunk_size=globals.PP_CHUNK_SIZE, index=None):
+    """
+PreProcessTxt.preProcessTxt
+
+Does what PreProcessTxt.exe does, but in-process: reads the raw data text file in chunks of
+lines, skipping chunks that lie entirely outside of the mass windows without parsing them and
+stopping as soon as the m/z values pass the last mass window. Only the chunks that overlap the
+mass windows are parsed, and only the rows within the mass windows are kept. The raw data file
+must be sorted by m/z.
+
+If an MzIndex is provided, then instead of reading from the start of the file, the file is read
+starting at the indexed byte offset just below each mass window, so only the region of the file
+around each mass window is read.
+
+Compressed raw data files (see CompressedFile) are decompressed as a stream, which still stops as soon
+as the m/z values pass the last mass window. A compressed stream cannot be seeked into, so the MzIndex
+is ignored for them.
+
+Input(s):
+    data_filename       - file name of the raw data file (string)
+    mass_windows        - (minimum mass, maximum mass) windows to keep rows for
+                            (list(tuple(float, float)))
+    [chunk_size         - approximate size of the chunks of lines to read (in bytes) (int),
+                            optional default=globals.PP_CHUNK_SIZE]
+    [index              - index of byte offsets for the raw data file, ignored if the file is compressed
+                            (MzIndex), optional default=None]
+
+Returns:
+    data                - array with the mass, dtbin, and intensity values for rows within the mass
+                            windows, same layout as genfromtxt(..., unpack=True) (numpy.array)
+"""
+    min_masses, max_masses = mergeMassWindows(mass_windows)
+    kept = []
+    with openDataFile(data_filename) as f:
+        if index is None or isCompressed(data_filename):
+            kept += streamMassWindows(f, min_masses, max_masses, chunk_size)
+        else:
+            for min_mass, max_mass in zip(min_masses, max_masses):
+                start, stop = index.byteRange(min_mass, max_mass)
+                f.seek(start)
+                # do not read much more than the indexed range containing the mass window at a time
+                size = chunk_size if stop is None else max(1, min(chunk_size, stop - start))
+                kept += streamMassWindows(f, array([min_mass]), array([max_mass]), size)
+    if not kept:
+        return zeros([3, 0])
+    return concatenate(kept).T
+
+
+def selectMassWindows(data, mass_windows):
+    """
+PreProcessTxt.selectMassWindows
+
+Does the same thing as preProcessTxt, but for data that has already been loaded into memory (i.e.
+memory-mapped from a DataCache). The data must be sorted by m/z, so the rows within each mass window
+are found with a binary search and sliced out without looking at the rest of the data.
+
+Input(s):
+    data                - mass, dtbin, and intensity columns (list(numpy.array))
+    mass_windows        - (minimum mass, maximum mass) windows to keep rows for
+                            (list(tuple(float, float)))
+
+Returns:
+    data                - mass, dtbin, and intensity columns for rows within the mass windows
+                            (list(numpy.array))
+"""
+    min_masses, max_masses = mergeMassWindows(mass_windows)
+    starts = searchsorted(data[0], min_masses, side="left")
+    stops = searchsorted(data[0], max_masses, side="right")
+    if len(starts) == 1:
+        return [column[starts[0]:stops[0]] for column in data]
+    return [concatenate([column[start:stop] for start, stop in zip(starts, stops)]) for column in data]
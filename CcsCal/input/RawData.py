@@ -1,102 +1,253 @@
+"""
+    CcsCal/input/RawData.py
+    Dylan H. Ross
+        description:
+            Loads the mass, dtbin, and intensity values from raw data files (parsed, pre-processed, or from the
+            DataCache) and extracts the drift time profile for a mass, either one mass at a time (RawData) or
+            for many masses from a single read of the file (MultiMassExtractor).
+"""
 
 
 from CcsCal import globals
 
 
-from os.path import splitext, exists
-from numpy import genfromtxt, zeros, abs
-from subprocess import run
+from CcsCal.input.CompressedFile import isCompressed
+from CcsCal.input.DataCache import DataCache
+from CcsCal.input.IMMatrix import IMMatrix
+from CcsCal.input.MzIndex import MzIndex
+from CcsCal.input.PreProcessTxt import preProcessTxt, selectMassWindows
+from CcsCal.input.TextParser import parseText
+from CcsCal.input.ParallelParse import parallelParseText
+
+
+from os.path import getsize
+from numpy import all, array, arange, amax, argsort, bincount, diff, searchsorted
+
+
+def sortByMass(data):
+    """
+RawData.sortByMass
+
+Makes sure that the mass, dtbin, and intensity columns are sorted by mass, which RawData.fineFilterForMass
+relies on to find the masses within a window with a binary search. Raw data files are normally written in
+order of m/z so the columns are only sorted (with a stable sort) if they are not already in order.
+
+Input(s):
+    data                - mass, dtbin, and intensity columns (numpy.array or list(numpy.array))
+
+Returns:
+    data                - mass, dtbin, and intensity columns sorted by mass, the same object if they were
+                            already sorted (numpy.array or list(numpy.array))
+"""
+    if len(data[0]) < 2 or all(diff(data[0]) >= 0):
+        return data
+    order = argsort(data[0], kind="stable")
+    return array([column[order] for column in data])
+
+
+def loadData(data_filename, mass_windows=None, cache=globals.USE_DATA_CACHE, index=globals.USE_MZ_INDEX,
+             jobs=globals.PARSE_JOBS):
+    """
+RawData.loadData
+
+Loads the mass, dtbin, and intensity values from a raw data file. If a valid DataCache entry exists for
+the file then its memory-mapped columns are used instead of parsing the text file (with the TextParser
+backend set by globals.TEXT_PARSER). Otherwise, if mass windows are given the file is pre-processed (only
+the rows within the mass windows are read, seeking to them using the MzIndex of the file), and if not the
+entire file is parsed, sorted by mass, and stored in the DataCache. Pre-processing relies on the file being
+sorted by m/z, so if the MzIndex shows that it is not then the entire file is read instead. Files larger
+than globals.PARALLEL_PARSE_MIN_SIZE are parsed (or pre-processed, if not using an MzIndex) by multiple
+worker processes if jobs is more than 1. Compressed raw data files are decompressed as a stream in a single
+process, without an MzIndex.
+
+Input(s):
+    data_filename       - file name of the raw data file (string)
+    [mass_windows       - (minimum mass, maximum mass) windows to pre-process the file with, or None to
+                            read the entire file (list(tuple(float, float))), optional default=None]
+    [cache              - whether to use the DataCache (bool), optional default=globals.USE_DATA_CACHE]
+    [index              - whether to use an MzIndex when pre-processing (bool), optional
+                            default=globals.USE_MZ_INDEX]
+    [jobs               - number of worker processes to parse large files with (int), optional
+                            default=globals.PARSE_JOBS]
+
+Returns:
+    data                - mass, dtbin, and intensity columns (numpy.array or list(numpy.array))
+"""
+    # compressed files can only be read from the beginning, so they cannot be indexed or split into byte ranges
+    compressed = isCompressed(data_filename)
+    parallel = jobs > 1 and not compressed and getsize(data_filename) >= globals.PARALLEL_PARSE_MIN_SIZE
+    if mass_windows is not None:
+        cached = DataCache().load(data_filename) if cache else None
+        if cached is not None:
+            return selectMassWindows(cached, mass_windows)
+        # pre-processing only reads part of the file, so there is nothing to store in the cache
+        if index and not compressed:
+            mz_index = MzIndex(data_filename)
+            if mz_index.sorted:
+                return preProcessTxt(data_filename, mass_windows, index=mz_index)
+            # the rows within the mass windows could be anywhere in a file that is not sorted by m/z
+            return selectMassWindows(loadData(data_filename, cache=cache, jobs=jobs), mass_windows)
+        if parallel:
+            return parallelParseText(data_filename, jobs=jobs, mass_windows=mass_windows)
+        return preProcessTxt(data_filename, mass_windows)
+    # the columns are sorted by mass before they are stored in the cache
+    if parallel:
+        parse = lambda filename: sortByMass(parallelParseText(filename, jobs=jobs))
+    else:
+        parse = lambda filename: sortByMass(parseText(filename))
+    return DataCache().loadOrParse(data_filename, parse) if cache else parse(data_filename)
 
 
 class RawData:
 
-    def __init__ (self, data_filename, specified_mass, mass_window, pp=True):
+    def __init__ (self, data_filename, specified_mass, mass_window, pp=True, data=None,
+                  n_dtbins=globals.N_DTBINS, cache=globals.USE_DATA_CACHE):
         """
 RawData.__init__
 
 Initializes a new RawData object
 
 Input(s):
-    data_filename       - file name of the raw data file (string)
+    data_filename       - file name of the raw data file, or an IMMatrix that has already been loaded
+                            from the raw data file (string or IMMatrix)
     specified_mass      - mass to extract data for (float)
     mass_window         - window of masses to bin data together for (float)
-    [pp                 - whether to pre-process the text file (bool), optional default=True]
+    [pp                 - whether to pre-process the text file, if so then only the rows within a
+                            rough mass window of the specified mass are read (bool), optional default=True]
+    [data               - array with the mass, dtbin, and intensity values that has already been
+                            loaded from data_filename, if provided the file is not read again and pp
+                            is ignored (numpy.array), optional default=None]
+    [n_dtbins           - minimum number of dtbins in the extracted data, more are used if the
+                            data contains larger dtbins (int), optional default=globals.N_DTBINS]
+    [cache              - whether to load the data through the DataCache (bool), optional
+                            default=globals.USE_DATA_CACHE]
 """
-        if pp:
-            # create the pre-processed data file
-            self.callPreProcessTxt(data_filename, specified_mass, mass_window)
-            # store the file name of the pre-processed file
-            self.ppFileName = splitext(data_filename)[0] + ".pp-" + str(specified_mass) + ".txt"
-            # check if pre-processing was successful
-            if not exists(self.ppFileName):
-                raise RuntimeError("pre-processing for file " + data_filename + " failed!")
-            # generate an array with the mass, dtbin, and intensity values from the pre-processed
-            # data file
-            self.data = genfromtxt(self.ppFileName, unpack=True)
+        # this is set if the data comes from an IMMatrix
+        self.imMatrix = None
+        if isinstance(data_filename, IMMatrix):
+            # the drift time profile is summed directly from the matrix in fineFilterForMass
+            self.imMatrix = data_filename
+            self.data = None
+            self.ppFileName = data_filename.dataFileName
+        elif data is not None:
+            # the data has already been read from the file (i.e. by a MultiMassExtractor), just
+            # keep a reference to it
+            self.data = sortByMass(data)
+            self.ppFileName = data_filename
+        elif pp:
+            # pre-process the data file, only the rows within a rough mass window (i.e. double the mass window)
+            # around the specified mass are read into the array with the mass, dtbin, and intensity values
+            use_window = globals.PP_MASS_WIN_SCALE * mass_window
+            self.data = sortByMass(loadData(data_filename,
+                                            mass_windows=[(specified_mass - use_window, specified_mass + use_window)],
+                                            cache=cache))
+            # other objects that use RawData objects expect to use the ppFileName attribute, a pre-processed file
+            # is no longer written so this is just the original data file name
+            self.ppFileName = data_filename
         else:
-            self.data = genfromtxt(data_filename, unpack=True)
+            self.data = sortByMass(loadData(data_filename, cache=cache))
             # other objects that use RawData objects expect to use the ppFileName attribute, in this case we do not
             # generate a pre-processed file so we just set the ppFileName to the original data file name
             self.ppFileName = data_filename
         # this is set by fineFilterForMass
         self.dtBinAndIntensity = None
+        self.nDtBins = n_dtbins
         # fine filter extracted data for mass and mass window
         self.fineFilterForMass(specified_mass, mass_window)
         # store the specified mass
         self.specifiedMass = specified_mass
 
-    def callPreProcessTxt(self, data_filename, specified_mass, mass_window):
+    def fineFilterForMass(self, specified_mass, mass_window):
         """
-RawData.callPreProcessTxt
-
-Calls PreProcessTxt.o (or PreProcessTxt.exe on Windows) using the specified mass and mass window
-provided as parameters. The mass window it actually uses is a rough mass window (i.e. double the
-mass window provided)
+RawData.fineFilterForMass
 
-*** This function is not very portable, needs some major improvements ***
+Looks through the data array from the pre-processed data file for masses within the
+fine mass window and sums their intensities into a 2D array of dtbin and intensity
+values (to deal with possibly sparse input data). The data are sorted by m/z (see
+sortByMass), so the masses within the window are found with a binary search and summed
+into their dtbins with a single weighted bincount. Rows with a dtbin less than 1 are
+left out. The number of dtbins is the larger of self.nDtBins and the largest dtbin
+present in the data. If the data comes from an IMMatrix then the drift time profile is
+summed from the matrix instead.
 
 Input(s):
-    data_filename       - file name of the raw data file (string)
     specified_mass      - mass to extract data for (float)
     mass_window         - window of masses to bin data together for (float)
 """
-        # pre-process data with rough mass_window (i.e. double the original mass window)
-        useWindow = globals.PP_MASS_WIN_SCALE * mass_window
-        # generate this string for logging purposes, but it isn't used for the actual
-        # function call
-        functionCallLine = globals.PP_EXE_PATH + " " +\
-                            data_filename + " " +\
-                            str(specified_mass) + " " + \
-                            str(useWindow)
-        # had to use shell=True flag here... not sure if I had to do that with RawToTxt
-        # but eventually I may need to figure something else out since I am sure sure how
-        # well it will work with this flag on Windows.
-        print("\tCalling PreProcessTxt.exe...")
-        print("\t~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
-        print("\t" + functionCallLine)
-        print("\t~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
-        # NOTE: call the executable with each of the params as separate args, this way we do not
-        #       need the shell=True flag. Still haven't quite fixed the portability issue though.
-        run(globals.PP_EXE_PATH, data_filename, specified_mass, mass_window)
-        print("\t...Done\n")
-
-
-    def fineFilterForMass(self, specified_mass, mass_window):
+        if self.imMatrix is not None:
+            self.dtBinAndIntensity = self.imMatrix.driftProfile(specified_mass, mass_window)
+            return
+        # size the histogram using the data so that dtbins beyond the configured number are not lost
+        n_dtbins = self.nDtBins
+        if len(self.data[1]) > 0:
+            n_dtbins = max(n_dtbins, int(amax(self.data[1])))
+        # the data are sorted by m/z, so all of the masses within the window are in one contiguous slice
+        start = searchsorted(self.data[0], specified_mass - mass_window, side="left")
+        stop = searchsorted(self.data[0], specified_mass + mass_window, side="right")
+        # dtbins start at 1, anything below that has no bin to go in (and bincount cannot take negative bins)
+        dtbins = self.data[1][start:stop].astype(int)
+        valid = dtbins >= 1
+        # prepare an array with dtbin and intensity values, adding the intensities to their corresponding bins
+        self.dtBinAndIntensity = array([arange(1, n_dtbins + 1),
+                                        bincount(dtbins[valid] - 1,
+                                                 weights=self.data[2][start:stop][valid],
+                                                 minlength=n_dtbins)],
+                                       dtype=float)
+
+
+class MultiMassExtractor:
+
+    def __init__(self, data_filename, masses, mass_window, pp=True, n_dtbins=globals.N_DTBINS,
+                 cache=globals.USE_DATA_CACHE):
         """
-RawData.fineFilterForMass
+MultiMassExtractor.__init__
 
-Looks through the data array from the pre-processed data file for masses within the
-fine mass window, uses a zeroed 2D array to deal with possibly sparse input data
+Initializes a new MultiMassExtractor object, which reads a raw data file a single time and
+then extracts the dtbin and intensity values for each of a list of masses from it. This
+avoids re-reading (and re-parsing) the same raw data file for every mass, which is the case
+when a separate RawData object is created for each mass.
+
+The extracted data for each mass is stored in a RawData object, so the results can be used
+anywhere a RawData object is expected (i.e. GaussFit):
+    MultiMassExtractor.rawData  - RawData objects, in the same order as masses (list(RawData))
 
 Input(s):
-    specified_mass      - mass to extract data for (float)
+    data_filename       - file name of the raw data file, or an IMMatrix that has already been loaded
+                            from the raw data file (string or IMMatrix)
+    masses              - masses to extract data for (list(float))
     mass_window         - window of masses to bin data together for (float)
+    [pp                 - whether to pre-process the text file, if so then only the rows within the
+                            rough mass windows of the masses are read (bool), optional default=True]
+    [n_dtbins           - minimum number of dtbins in the extracted data (int), optional
+                            default=globals.N_DTBINS]
+    [cache              - whether to load the data through the DataCache (bool), optional
+                            default=globals.USE_DATA_CACHE]
 """
-        # prepare an array with dtbin and intensity values
-        self.dtBinAndIntensity = zeros([2, 200])
-        for n in range(1, 201):
-            self.dtBinAndIntensity[0][n - 1] = n
-        for n in range(len(self.data[0])):
-            if abs(specified_mass - self.data[0][n]) <= mass_window:
-                # add the intensity to its corresponding bin
-                self.dtBinAndIntensity[1][int(self.data[1][n]) - 1] += self.data[2][n]
+        self.dataFileName = data_filename
+        self.masses = list(masses)
+        self.massWindow = mass_window
+        # read the raw data file only once
+        if isinstance(data_filename, IMMatrix):
+            # the IMMatrix has already read the raw data file
+            self.data = None
+        elif pp:
+            use_window = globals.PP_MASS_WIN_SCALE * mass_window
+            mass_windows = [(mass - use_window, mass + use_window) for mass in self.masses]
+            self.data = loadData(data_filename, mass_windows=mass_windows, cache=cache)
+        else:
+            self.data = loadData(data_filename, cache=cache)
+        # sorted once here rather than by each of the RawData objects
+        if self.data is not None:
+            self.data = sortByMass(self.data)
+        # fine filter the data for each of the masses
+        self.rawData = [RawData(data_filename, mass, mass_window, data=self.data, n_dtbins=n_dtbins)
+                        for mass in self.masses]
+
+    def __len__(self):
+        return len(self.rawData)
+
+    def __getitem__(self, index):
+        return self.rawData[index]
+
+    def __iter__(self):
+        return iter(self.rawData)
@@ -0,0 +1,170 @@
+"""
+    CcsCal/input/TextParser.py
+    Dylan H. Ross
+        description:
+            Interchangeable backends for parsing whitespace-separated numeric text (i.e. raw data files) into
+            columns. The backend is selected with globals.TEXT_PARSER or per call:
+                genfromtxt      numpy.genfromtxt (slowest, but handles comments and missing values, the default)
+                loadtxt         numpy.loadtxt (raises a ValueError on lines with missing or extra fields)
+                fromstring      reads a memory-mapped file in chunks of lines, each chunk is copied, decoded,
+                                and tokenized with numpy.fromstring (no comments allowed, raises a ValueError
+                                if the number of values is not a multiple of the number of columns)
+                pandas          pandas.read_csv with the C engine (only if pandas is installed)
+            Compressed files (see CompressedFile) are decompressed as a stream and parsed with any backend.
+"""
+
+
+from CcsCal import globals
+from CcsCal.input.CompressedFile import isCompressed, openDataFile
+
+
+from io import BytesIO
+from mmap import mmap, ACCESS_READ
+from numpy import genfromtxt, loadtxt, fromstring, concatenate, zeros, atleast_2d
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
+
+# names of the available backends
+BACKENDS = ("genfromtxt", "loadtxt", "fromstring") + (("pandas",) if pandas is not None else ())
+
+
+def checkBackend(backend):
+    """
+TextParser.checkBackend
+
+Resolves the backend to use, raising a ValueError if it is not available
+
+Input(s):
+    backend             - name of the backend, or None to use globals.TEXT_PARSER (string)
+
+Returns:
+    backend             - name of the backend (string)
+"""
+    if backend is None:
+        backend = globals.TEXT_PARSER
+    if backend not in BACKENDS:
+        raise ValueError("TextParser: checkBackend: backend must be one of " + str(BACKENDS) +
+                         " (got '" + str(backend) + "')")
+    return backend
+
+
+def tokenize(buffer, n_columns):
+    """
+TextParser.tokenize
+
+Converts a buffer of whitespace-separated numeric text into an array of rows
+
+Input(s):
+    buffer              - text to convert, must end at the end of a line (bytes)
+    n_columns           - number of columns (int)
+
+Returns:
+    rows                - array of rows (numpy.array)
+"""
+    values = fromstring(buffer.decode("ascii"), sep=" ")
+    if len(values) % n_columns:
+        raise ValueError("TextParser: tokenize: number of values ({}) is not a multiple of ".format(len(values)) +
+                         "the number of columns ({}), the text has missing fields".format(n_columns))
+    return values.reshape(-1, n_columns)
+
+
+def parseText(filename, backend=None, n_columns=3, chunk_size=globals.TEXT_PARSER_CHUNK_SIZE):
+    """
+TextParser.parseText
+
+Parses a whitespace-separated numeric text file into columns, the same as genfromtxt(filename, unpack=True)
+
+Input(s):
+    filename            - name of the text file (string)
+    [backend            - name of the backend to use, or None to use globals.TEXT_PARSER (string), optional
+                            default=None]
+    [n_columns          - number of columns in the file (int), optional default=3]
+    [chunk_size         - approximate size (in bytes) of the chunks tokenized at a time by the fromstring
+                            backend (int), optional default=globals.TEXT_PARSER_CHUNK_SIZE]
+
+Returns:
+    columns             - array with one row per column of the text file (numpy.array)
+"""
+    backend = checkBackend(backend)
+    if isCompressed(filename):
+        with openDataFile(filename) as f:
+            return parseStream(f, backend, n_columns, chunk_size)
+    if backend == "genfromtxt":
+        return genfromtxt(filename, unpack=True)
+    if backend == "loadtxt":
+        return loadtxt(filename, unpack=True, ndmin=2)
+    if backend == "pandas":
+        return pandas.read_csv(filename, sep=r"\s+", header=None, dtype=float, engine="c").to_numpy().T
+    # fromstring: tokenize the memory-mapped file a chunk at a time, each chunk ending at the end of a line
+    with open(filename, "rb") as f:
+        if f.seek(0, 2) == 0:
+            return zeros([n_columns, 0])
+        with mmap(f.fileno(), 0, access=ACCESS_READ) as buf:
+            chunks = []
+            start = 0
+            while start < len(buf):
+                stop = buf.find(b"\n", min(start + chunk_size, len(buf) - 1))
+                stop = len(buf) if stop < 0 else stop + 1
+                chunks.append(tokenize(buf[start:stop], n_columns))
+                start = stop
+    return concatenate(chunks).T
+
+
+def parseStream(f, backend, n_columns, chunk_size):
+    """
+TextParser.parseStream
+
+Parses a stream of whitespace-separated numeric text (i.e. a decompressed raw data file) into columns. The
+stream cannot be memory-mapped, so the fromstring backend tokenizes it a chunk of lines at a time instead.
+
+Input(s):
+    f                   - stream to parse, opened in binary mode (file)
+    backend             - name of the backend to use (string)
+    n_columns           - number of columns (int)
+    chunk_size          - approximate size (in bytes) of the chunks of lines tokenized at a time by the
+                            fromstring backend (int)
+
+Returns:
+    columns             - array with one row per column of the text (numpy.array)
+"""
+    if backend == "genfromtxt":
+        return genfromtxt(f, unpack=True)
+    if backend == "loadtxt":
+        return loadtxt(f, unpack=True, ndmin=2)
+    if backend == "pandas":
+        return pandas.read_csv(f, sep=r"\s+", header=None, dtype=float, engine="c").to_numpy().T
+    chunks = []
+    lines = f.readlines(chunk_size)
+    while lines:
+        chunks.append(tokenize(b"".join(lines), n_columns))
+        lines = f.readlines(chunk_size)
+    return concatenate(chunks).T if chunks else zeros([n_columns, 0])
+
+
+def parseLines(lines, backend=None, n_columns=3):
+    """
+TextParser.parseLines
+
+Parses lines of whitespace-separated numeric text into an array of rows
+
+Input(s):
+    lines               - lines of text (list(bytes))
+    [backend            - name of the backend to use, or None to use globals.TEXT_PARSER (string), optional
+                            default=None]
+    [n_columns          - number of columns (int), optional default=3]
+
+Returns:
+    rows                - array of rows (numpy.array)
+"""
+    backend = checkBackend(backend)
+    if backend == "genfromtxt":
+        return atleast_2d(genfromtxt(lines)) if lines else zeros([0, n_columns])
+    if backend == "loadtxt":
+        return loadtxt(lines, ndmin=2)
+    if backend == "pandas":
+        return pandas.read_csv(BytesIO(b"".join(lines)), sep=r"\s+", header=None, dtype=float,
+                               engine="c").to_numpy()
+    return tokenize(b"".join(lines), n_columns)
@@ -0,0 +1,173 @@
+"""
+    CcsCal/processing/BatchCalCurveFit.py
+    Dylan H. Ross
+        description:
+            Fits the CCS calibration curve (corrected ccs = A * (corrected drift time + t0) ** B, see
+            CcsCalibration.baseCalCurve) to many sets of calibrant data at once using the vectorized
+            Levenberg-Marquardt fitting in BatchLeastSquares, i.e. for resampling the calibrants or for trying
+            many different settings with the same calibrants. The initial parameters are estimated in closed form
+            from a linearized (log-log) fit of the calibration curve.
+"""
+
+
+from CcsCal import globals
+from CcsCal.processing.BatchLeastSquares import batchLevenbergMarquardt
+
+
+from numpy import (argmin, array, atleast_2d, broadcast_arrays, broadcast_to, errstate, exp, inf, isfinite,
+                   linspace, log, min, sum, take_along_axis, where, zeros)
+
+
+def calCurveFunc(x, params):
+    """
+BatchCalCurveFit.calCurveFunc
+
+Calibration curve power function evaluated for each row of a batch
+
+Input(s):
+    x                   - corrected drift times with shape (n_rows, n_points) (numpy.array)
+    params              - A, t0, and B parameters with shape (n_rows, 3) (numpy.array)
+
+Returns:
+    ccs                 - corrected ccs with shape (n_rows, n_points) (numpy.array)
+"""
+    A, t0, B = params[:, 0:1], params[:, 1:2], params[:, 2:3]
+    return A * (x + t0)**B
+
+
+def calCurveJac(x, params):
+    """
+BatchCalCurveFit.calCurveJac
+
+Analytic Jacobian of the calibration curve power function with respect to its parameters, evaluated for each
+row of a batch
+
+Input(s):
+    x                   - corrected drift times with shape (n_rows, n_points) (numpy.array)
+    params              - A, t0, and B parameters with shape (n_rows, 3) (numpy.array)
+
+Returns:
+    jac                 - derivatives with respect to A, t0, and B with shape (n_rows, n_points, 3)
+                            (numpy.array)
+"""
+    A, t0, B = params[:, 0:1], params[:, 1:2], params[:, 2:3]
+    xt = x + t0
+    jac = zeros(x.shape + (3,))
+    with errstate(all="ignore"):
+        xt_B = xt**B
+        jac[:, :, 0] = xt_B
+        jac[:, :, 1] = A * B * xt**(B - 1.)
+        jac[:, :, 2] = A * xt_B * log(xt)
+    return jac
+
+
+def seedCalCurve(corrected_dt, corrected_ccs, weights=None, t0_range=globals.CAL_SEED_T0_RANGE,
+                 t0_steps=globals.CAL_SEED_T0_STEPS):
+    """
+BatchCalCurveFit.seedCalCurve
+
+Estimates initial calibration curve parameters for each row of a batch in closed form. For a fixed t0 the
+calibration curve is linear in log space (log(ccs) = log(A) + B * log(dt + t0)), so log(A) and B are found by
+linear least squares for every t0 in a coarse scan (between -t0_range and +t0_range times the shortest
+corrected drift time in each row, all at once), and the t0 with the lowest sum of squared residuals in log space
+is picked. The scan is then repeated once between the neighbors of the picked t0. The log space residuals are
+weighted by the squared ccs, so that the estimates are close to the (unweighted) least squares fit of the
+calibration curve. Rows where this is not possible (fewer than 2 calibrants with positive ccs and drift time) get
+globals.INIT_A, globals.INIT_T0, and globals.INIT_B.
+
+Input(s):
+    corrected_dt        - corrected drift times of the calibrants, with shape (n_points,) if they are shared by
+                            all of the rows or (n_rows, n_points) (numpy.array)
+    corrected_ccs       - corrected literature ccs of the calibrants, with shape (n_points,) if they are shared
+                            by all of the rows or (n_rows, n_points) (numpy.array)
+    [weights            - weight of each calibrant with shape (n_rows, n_points), 0 to leave it out
+                            (numpy.array), optional default=None]
+    [t0_range           - extent of the scan of t0, relative to the shortest corrected drift time (float),
+                            optional default=globals.CAL_SEED_T0_RANGE]
+    [t0_steps           - number of t0 values in the scan (int), optional default=globals.CAL_SEED_T0_STEPS]
+
+Returns:
+    init_params         - initial A, t0, and B parameters with shape (n_rows, 3) (numpy.array)
+"""
+    x, y, w = broadcast_arrays(atleast_2d(array(corrected_dt, dtype=float)),
+                               atleast_2d(array(corrected_ccs, dtype=float)),
+                               atleast_2d(array(1. if weights is None else weights, dtype=float)))
+    w = where((x > 0) & (y > 0), w, 0.)
+    ly = where(w > 0, log(where(w > 0, y, 1.)), 0.)[:, None, :]
+    # the residuals in log space are relative residuals, weighting them by the squared ccs makes the fit close to
+    # a least squares fit of the ccs themselves
+    wt = (w * where(w > 0, y, 0.)**2)[:, None, :]
+    sw = sum(wt, axis=2)
+    # t0 values to scan for each row, with shape (n_rows, t0_steps)
+    with errstate(all="ignore"):
+        x_min = min(where(w > 0, x, inf), axis=1)
+        t0 = x_min[:, None] * linspace(-t0_range, t0_range, t0_steps)[None, :]
+    # the coarse scan is refined once, with the same number of steps, between the neighbors of the best t0
+    for refine in range(2):
+        with errstate(all="ignore"):
+            # weighted linear regression of log(y) on log(x + t0) for every row and t0 at once, the arrays have
+            # shape (n_rows, t0_steps, n_points)
+            lx = log(x[:, None, :] + t0[:, :, None])
+            mx, my = sum(wt * lx, axis=2) / sw, sum(wt * ly, axis=2) / sw
+            dx, dy = where(wt > 0, lx - mx[:, :, None], 0.), ly - my[:, :, None]
+            B = sum(wt * dx * dy, axis=2) / sum(wt * dx**2, axis=2)
+            log_A = my - B * mx
+            ssr = sum(wt * (dy - B[:, :, None] * dx)**2, axis=2)
+        ssr = where(isfinite(ssr) & isfinite(B) & isfinite(log_A) & (sw > 0), ssr, inf)
+        best = argmin(ssr, axis=1)[:, None]
+        if refine == 0:
+            step = x_min * 2. * t0_range / max(t0_steps - 1, 1)
+            with errstate(all="ignore"):
+                fine = take_along_axis(t0, best, axis=1) + step[:, None] * linspace(-1., 1., t0_steps)[None, :]
+            # keep the coarse t0 values for rows that have no usable fit, so they fall back to the defaults
+            t0 = where(isfinite(take_along_axis(ssr, best, axis=1)), fine, t0)
+    init_params = zeros((x.shape[0], 3))
+    init_params[:, 0] = exp(take_along_axis(log_A, best, axis=1)[:, 0])
+    init_params[:, 1] = take_along_axis(t0, best, axis=1)[:, 0]
+    init_params[:, 2] = take_along_axis(B, best, axis=1)[:, 0]
+    ok = (sum(w > 0, axis=1) >= 2) & isfinite(take_along_axis(ssr, best, axis=1)[:, 0]) & \
+        isfinite(init_params[:, 0])
+    init_params[~ok] = [globals.INIT_A, globals.INIT_T0, globals.INIT_B]
+    return init_params
+
+
+def batchFitCalCurve(corrected_dt, corrected_ccs, init_params=None, weights=None,
+                     max_iter=globals.CURVE_FIT_MAXFEV):
+    """
+BatchCalCurveFit.batchFitCalCurve
+
+Fits the calibration curve to each row of a batch of calibrant data
+
+Input(s):
+    corrected_dt        - corrected drift times of the calibrants, with shape (n_points,) if they are shared by
+                            all of the rows or (n_rows, n_points) (numpy.array)
+    corrected_ccs       - corrected literature ccs of the calibrants, with shape (n_points,) if they are shared
+                            by all of the rows or (n_rows, n_points) (numpy.array)
+    [init_params        - initial A, t0, and B parameters, with shape (3,) if they are shared by all of the
+                            rows or (n_rows, 3), if None then they are estimated for each row (see
+                            seedCalCurve) (numpy.array), optional default=None]
+    [weights            - weight of each calibrant with shape (n_rows, n_points), i.e. the number of times each
+                            calibrant was drawn in a bootstrap resample or 0 to leave it out (numpy.array),
+                            optional default=None]
+    [max_iter           - maximum number of iterations, the parameters of the calibration curve are strongly
+                            correlated so some fits take many small steps to converge (int), optional
+                            default=globals.CURVE_FIT_MAXFEV]
+
+Returns:
+    params              - optimized A, t0, and B parameters with shape (n_rows, 3) (numpy.array)
+    covars              - covariance of the optimized parameters with shape (n_rows, 3, 3) (numpy.array)
+    converged           - whether the fit of each row converged (numpy.array(bool))
+    stalled             - whether the fit of each row stalled (see BatchLeastSquares.batchLevenbergMarquardt),
+                            these fits failed and have not converged (numpy.array(bool))
+"""
+    corrected_dt, corrected_ccs = array(corrected_dt, dtype=float), array(corrected_ccs, dtype=float)
+    if init_params is None:
+        init_params = seedCalCurve(corrected_dt, corrected_ccs, weights=weights)
+    shapes = [corrected_dt.shape, corrected_ccs.shape] + ([] if weights is None else [array(weights).shape])
+    n_rows = max([shape[0] if len(shape) == 2 else 1 for shape in shapes] +
+                 [array(init_params).reshape(-1, 3).shape[0]])
+    n_points = corrected_dt.shape[-1]
+    y = broadcast_to(corrected_ccs, (n_rows, n_points))
+    p0 = broadcast_to(array(init_params, dtype=float).reshape(-1, 3), (n_rows, 3))
+    return batchLevenbergMarquardt(calCurveFunc, corrected_dt, y, p0, jac=calCurveJac, weights=weights,
+                                   max_iter=max_iter)
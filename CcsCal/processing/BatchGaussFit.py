@@ -0,0 +1,476 @@
+"""
+    CcsCal/processing/BatchGaussFit.py
+    Dylan H. Ross
+        description:
+            Fits a 2D stack of dtbin vs. intensity profiles (one row per mass) with gaussian functions all at
+            once, using the vectorized Levenberg-Marquardt fitting in BatchLeastSquares. GaussFit uses this to
+            fit a single profile (a stack with one row).
+"""
+
+
+from CcsCal import globals
+from CcsCal.processing.BatchLeastSquares import batchLevenbergMarquardt
+
+
+from math import erf, exp as scalar_exp, log, pi, sqrt as scalar_sqrt
+from numpy import (abs, amax, arange, argmax, argmin, array, errstate, exp, full, inf, isfinite, log as array_log,
+                   maximum, minimum, nan, nanmedian, nonzero, ones, sqrt, sum, take_along_axis, where, zeros)
+from numpy.linalg import LinAlgError, solve
+
+
+# names of the drift time estimators:
+#   fit         always fit the profiles with gaussian functions (iterative)
+#   tiered      use the closed form moment estimates (see momentEstimates) for profiles where the implied gaussian is
+#               good enough, and only fit the rest
+ESTIMATORS = ("fit", "tiered")
+
+# ratio of the FWHM of a gaussian to its sigma, 2 sqrt(2 ln(2))
+FWHM_TO_SIGMA = 2. * scalar_sqrt(2. * log(2.))
+
+
+def checkEstimator(estimator):
+    """
+BatchGaussFit.checkEstimator
+
+Resolves the drift time estimator to use, raising a ValueError if it is not one of ESTIMATORS
+
+Input(s):
+    estimator           - name of the estimator, or None to use globals.GAUSS_ESTIMATOR (string)
+
+Returns:
+    estimator           - name of the estimator (string)
+"""
+    if estimator is None:
+        estimator = globals.GAUSS_ESTIMATOR
+    if estimator not in ESTIMATORS:
+        raise ValueError("BatchGaussFit: checkEstimator: estimator must be one of " + str(ESTIMATORS) +
+                         " (got '" + str(estimator) + "')")
+    return estimator
+
+
+def gaussFunc(x, params):
+    """
+BatchGaussFit.gaussFunc
+
+Gaussian function evaluated for each row of a batch
+
+Input(s):
+    x                   - dtbins with shape (n_rows, n_points) (numpy.array)
+    params              - amplitude, mu, and sigma parameters with shape (n_rows, 3) (numpy.array)
+
+Returns:
+    intensity           - intensities with shape (n_rows, n_points) (numpy.array)
+"""
+    A, mu, sigma = params[:, 0:1], params[:, 1:2], params[:, 2:3]
+    return A * exp(-(x - mu)**2 / (2. * sigma**2))
+
+
+def gaussJac(x, params):
+    """
+BatchGaussFit.gaussJac
+
+Analytic Jacobian of the gaussian function with respect to its parameters, evaluated for each row of a batch
+
+Input(s):
+    x                   - dtbins with shape (n_rows, n_points) (numpy.array)
+    params              - amplitude, mu, and sigma parameters with shape (n_rows, 3) (numpy.array)
+
+Returns:
+    jac                 - derivatives with respect to amplitude, mu, and sigma with shape (n_rows, n_points, 3)
+                            (numpy.array)
+"""
+    A, mu, sigma = params[:, 0:1], params[:, 1:2], params[:, 2:3]
+    d = x - mu
+    e = exp(-d**2 / (2. * sigma**2))
+    jac = zeros(x.shape + (3,))
+    jac[:, :, 0] = e
+    jac[:, :, 1] = A * e * d / sigma**2
+    jac[:, :, 2] = A * e * d**2 / sigma**3
+    return jac
+
+
+def apexRegion(intensities, fraction):
+    """
+BatchGaussFit.apexRegion
+
+Finds the apex of each row of a batch and the points around it: the contiguous run of points with
+intensities of at least a fraction of the apex intensity, and always the points on either side of the apex
+
+Input(s):
+    intensities         - intensities with shape (n_rows, n_points) (numpy.array)
+    fraction            - fraction of the apex intensity that defines the points around the apex (float)
+
+Returns:
+    apex                - index of the apex of each row with shape (n_rows, 1) (numpy.array)
+    height              - apex intensity of each row with shape (n_rows, 1) (numpy.array)
+    region              - whether each point is around the apex with shape (n_rows, n_points)
+                            (numpy.array(bool))
+"""
+    n_points = intensities.shape[1]
+    idx = arange(n_points)[None, :]
+    apex = argmax(intensities, axis=1)[:, None]
+    height = take_along_axis(intensities, apex, axis=1)
+    below = intensities < fraction * height
+    # last point below the fraction before the apex, and first point below the fraction after the apex
+    left = amax(where(below & (idx < apex), idx, -1), axis=1)[:, None]
+    right = -amax(where(below & (idx > apex), -idx, -n_points), axis=1)[:, None]
+    return apex, height, ((idx > left) & (idx < right)) | (abs(idx - apex) <= 1)
+
+
+def momentEstimates(dtbins, intensities, weights=None, fraction=globals.GAUSS_SEED_FRACTION):
+    """
+BatchGaussFit.momentEstimates
+
+Estimates the parameters of the peak in each row of a batch in closed form, without any iterative fitting:
+the centroid of the points around the apex (see apexRegion), the full width at half maximum (interpolated
+between the points on either side of the half maximum crossings), and the apex intensity. Also computes two
+measures of how well the profile is described by the gaussian implied by these estimates (amplitude = apex
+intensity, mu = centroid, sigma = FWHM / 2.3548):
+    R^2     coefficient of determination of the implied gaussian over the whole profile
+    SNR     apex intensity divided by the noise, which is estimated from the median absolute deviation of
+            the points more than 3 sigma away from the centroid (inf if there is no noise)
+The FWHM (and so the R^2) is nan for rows where the peak does not fall below half maximum on both sides.
+
+Input(s):
+    dtbins              - dtbins with shape (n_rows, n_points) (numpy.array)
+    intensities         - intensities with shape (n_rows, n_points) (numpy.array)
+    [weights            - weight of each point with shape (n_rows, n_points), points with a weight of 0 are
+                            ignored (numpy.array), optional default=None]
+    [fraction           - fraction of the apex intensity that defines the points around the apex (float),
+                            optional default=globals.GAUSS_SEED_FRACTION]
+
+Returns:
+    params              - amplitude, mu, and sigma of the implied gaussians with shape (n_rows, 3) (numpy.array)
+    fwhm                - full width at half maximum of each row (numpy.array)
+    r2                  - R^2 of the implied gaussian for each row (numpy.array)
+    snr                 - signal to noise ratio of each row (numpy.array)
+"""
+    valid = ones(intensities.shape, dtype=bool) if weights is None else weights > 0
+    y = where(valid, intensities, 0.)
+    n_rows, n_points = y.shape
+    idx = arange(n_points)[None, :]
+    apex, height, region = apexRegion(y, fraction)
+    half = height / 2.
+    below = y < half
+    with errstate(all="ignore"):
+        yr = where(region, maximum(y, 0.), 0.)
+        centroid = sum(yr * dtbins, axis=1) / sum(yr, axis=1)
+        # interpolate the half maximum crossings between the last point below half maximum before the apex and
+        # the first point below half maximum after the apex and their neighbors towards the apex
+        left = amax(where(below & (idx < apex), idx, -1), axis=1)[:, None]
+        right = -amax(where(below & (idx > apex), -idx, -n_points), axis=1)[:, None]
+        crossings = []
+        for outer, inner in [(left, left + 1), (right, right - 1)]:
+            found = (outer >= 0) & (outer < n_points)
+            outer, inner = where(found, outer, 0), where(found, inner, 0)
+            x_out, x_in = take_along_axis(dtbins, outer, axis=1), take_along_axis(dtbins, inner, axis=1)
+            y_out, y_in = take_along_axis(y, outer, axis=1), take_along_axis(y, inner, axis=1)
+            crossing = x_out + (half - y_out) / (y_in - y_out) * (x_in - x_out)
+            crossings.append(where(found, crossing, nan)[:, 0])
+        fwhm = crossings[1] - crossings[0]
+        params = zeros((n_rows, 3))
+        params[:, 0] = height[:, 0]
+        params[:, 1] = centroid
+        params[:, 2] = fwhm / FWHM_TO_SIGMA
+        # quality of the implied gaussian
+        resid = where(valid, y - gaussFunc(dtbins, params), 0.)
+        n_valid = sum(valid, axis=1)
+        mean = sum(y, axis=1) / n_valid
+        r2 = 1. - sum(resid**2, axis=1) / sum(where(valid, y - mean[:, None], 0.)**2, axis=1)
+        baseline = where(valid & (abs(dtbins - centroid[:, None]) > 3. * params[:, 2:3]), y, nan)
+        noise = 1.4826 * nanmedian(abs(baseline - nanmedian(baseline, axis=1)[:, None]), axis=1)
+        snr = where(noise > 0, height[:, 0] / noise, inf)
+    return params, fwhm, r2, snr
+
+
+def truncatedVarianceRatio(fraction):
+    """
+BatchGaussFit.truncatedVarianceRatio
+
+Ratio of the variance of a gaussian truncated where it falls below a fraction of its height to the variance
+of the full gaussian, used to correct second moments measured only around the apex of a peak
+
+Input(s):
+    fraction            - fraction of the height of the gaussian it is truncated at (float)
+
+Returns:
+    ratio               - truncated variance / variance (float)
+"""
+    a = scalar_sqrt(2. * log(1. / fraction))
+    return 1. - 2. * a * scalar_exp(-a**2 / 2.) / scalar_sqrt(2. * pi) / erf(a / scalar_sqrt(2.))
+
+
+def seedParams(dtbins, intensities, weights=None, fraction=globals.GAUSS_SEED_FRACTION):
+    """
+BatchGaussFit.seedParams
+
+Estimates initial gaussian parameters for each row of a batch in closed form, from the points around the
+apex of each profile (the contiguous run of points with intensities of at least a fraction of the apex
+intensity, and always the points on either side of the apex). A parabola is fit to the log of the
+intensities of these points (Caruana's method, weighted by the squared intensities to limit the influence of
+noisy points in the tails) which gives the amplitude, mu, and sigma directly. For rows where this is not
+possible (fewer than 3 points with positive intensity, or a log-parabola that does not open downward) the
+amplitude is the apex intensity, mu is the centroid of the points around the apex, and sigma is measured from
+their second moment (corrected for the truncation of the peak), or globals.INIT_GAUSS_SIGMA if that does not
+work either.
+
+Input(s):
+    dtbins              - dtbins with shape (n_rows, n_points) (numpy.array)
+    intensities         - intensities with shape (n_rows, n_points) (numpy.array)
+    [weights            - weight of each point with shape (n_rows, n_points), points with a weight of 0 are
+                            ignored (numpy.array), optional default=None]
+    [fraction           - fraction of the apex intensity that defines the points around the apex (float),
+                            optional default=globals.GAUSS_SEED_FRACTION]
+
+Returns:
+    init_params         - initial amplitude, mu, and sigma parameters with shape (n_rows, 3) (numpy.array)
+"""
+    y = intensities if weights is None else where(weights > 0, intensities, 0.)
+    n_rows, n_points = y.shape
+    apex, height, region = apexRegion(y, fraction)
+    # second moment estimates
+    with errstate(all="ignore"):
+        yr = where(region, maximum(y, 0.), 0.)
+        centroid = sum(yr * dtbins, axis=1) / sum(yr, axis=1)
+        variance = sum(yr * (dtbins - centroid[:, None])**2, axis=1) / sum(yr, axis=1)
+        sigma = sqrt(variance / truncatedVarianceRatio(fraction))
+    init_params = zeros((n_rows, 3))
+    init_params[:, 0] = height[:, 0]
+    init_params[:, 1] = where(isfinite(centroid), centroid, take_along_axis(dtbins, apex, axis=1)[:, 0])
+    init_params[:, 2] = where(isfinite(sigma) & (sigma > 0), sigma, globals.INIT_GAUSS_SIGMA)
+    # weighted least squares fit of ln(y) = a + b x + c x^2 (x relative to the apex to keep the fit well conditioned)
+    use = region & (y > 0)
+    x0 = take_along_axis(dtbins, apex, axis=1)
+    with errstate(all="ignore"):
+        x = dtbins - x0
+        w = where(use, y**2, 0.)
+        ln_y = where(use, array_log(where(use, y, 1.)), 0.)
+        powers = [x**0, x, x**2]
+        lhs = array([[sum(w * powers[i] * powers[j], axis=1) for j in range(3)] for i in range(3)]).transpose(2, 0, 1)
+        rhs = array([sum(w * powers[i] * ln_y, axis=1) for i in range(3)]).T
+        ok = sum(use, axis=1) >= 3
+        coef = zeros((n_rows, 3))
+        if ok.any():
+            try:
+                coef[ok] = solve(lhs[ok], rhs[ok][:, :, None])[:, :, 0]
+            except LinAlgError:
+                for row in where(ok)[0]:
+                    try:
+                        coef[row] = solve(lhs[row], rhs[row])
+                    except LinAlgError:
+                        ok[row] = False
+        a, b, c = coef[:, 0], coef[:, 1], coef[:, 2]
+        mu = -b / (2. * c)
+        A = exp(a - b**2 / (4. * c))
+        sigma = sqrt(-1. / (2. * c))
+        # the log-parabola must open downward and put its apex near the apex of the data
+        ok &= (c < 0) & isfinite(A) & isfinite(mu) & isfinite(sigma) & (abs(mu) <= sum(region, axis=1))
+    init_params[ok, 0] = A[ok]
+    init_params[ok, 1] = (x0[:, 0] + mu)[ok]
+    init_params[ok, 2] = sigma[ok]
+    return init_params
+
+
+def roiSlice(dtbins, intensities, weights, init_params, widths=globals.GAUSS_ROI_WIDTHS):
+    """
+BatchGaussFit.roiSlice
+
+Trims each row of a batch to a region of interest (ROI) around its peak, within a multiple of the estimated
+sigma of the initial mu parameter (and always at least 2 points on either side of it), so that the long
+tails of the profiles do not need to be fit. All of the rows are sliced to the same number of points (the
+widest ROI), and the points in each slice outside of the ROI of its row are given a weight of 0.
+
+Input(s):
+    dtbins              - dtbins with shape (n_rows, n_points) (numpy.array)
+    intensities         - intensities with shape (n_rows, n_points) (numpy.array)
+    weights             - weight of each point with shape (n_rows, n_points) (numpy.array)
+    init_params         - initial amplitude, mu, and sigma parameters with shape (n_rows, 3) (numpy.array)
+    [widths             - half width of the ROI in multiples of the initial sigma parameter (float), optional
+                            default=globals.GAUSS_ROI_WIDTHS]
+
+Returns:
+    dtbins              - dtbins with shape (n_rows, n_roi_points) (numpy.array)
+    intensities         - intensities with shape (n_rows, n_roi_points) (numpy.array)
+    weights             - weight of each point, 0 outside of the ROI, with shape (n_rows, n_roi_points)
+                            (numpy.array)
+"""
+    n_rows, n_points = intensities.shape
+    idx = arange(n_points)[None, :]
+    valid = weights > 0
+    with errstate(all="ignore"):
+        distance = abs(dtbins - init_params[:, 1:2])
+        # point closest to the initial mu parameter
+        center = argmin(where(valid, distance, inf), axis=1)[:, None]
+        roi = (distance <= widths * abs(init_params[:, 2:3])) | (abs(idx - center) <= 2)
+    # use the whole profile for rows without a usable initial sigma parameter
+    roi |= ~isfinite(init_params[:, 2:3])
+    roi &= valid
+    first = argmax(roi, axis=1)
+    last = n_points - 1 - argmax(roi[:, ::-1], axis=1)
+    n_roi_points = int(amax(last - first)) + 1 if n_rows > 0 else n_points
+    start = minimum(first, n_points - n_roi_points)[:, None]
+    slice_idx = start + arange(n_roi_points)[None, :]
+    return (take_along_axis(dtbins, slice_idx, axis=1), take_along_axis(intensities, slice_idx, axis=1),
+            where(take_along_axis(roi, slice_idx, axis=1), take_along_axis(weights, slice_idx, axis=1), 0.))
+
+
+def stackProfiles(raw_datas):
+    """
+BatchGaussFit.stackProfiles
+
+Stacks the dtbin vs. intensity profiles from a list of RawData objects into 2D arrays. The profiles can
+have different numbers of dtbins (see RawData.fineFilterForMass), so shorter profiles are padded at the end
+with points that have a weight of 0.
+
+Input(s):
+    raw_datas           - objects containing the raw data (list(RawData))
+
+Returns:
+    dtbins              - dtbins with shape (n_profiles, n_dtbins) (numpy.array)
+    intensities         - intensities with shape (n_profiles, n_dtbins) (numpy.array)
+    weights             - weight of each point, 0 for padding, with shape (n_profiles, n_dtbins)
+                            (numpy.array)
+"""
+    n_dtbins = max([raw_data.dtBinAndIntensity.shape[1] for raw_data in raw_datas])
+    dtbins = zeros((len(raw_datas), n_dtbins))
+    intensities = zeros((len(raw_datas), n_dtbins))
+    weights = zeros((len(raw_datas), n_dtbins))
+    for i, raw_data in enumerate(raw_datas):
+        n = raw_data.dtBinAndIntensity.shape[1]
+        dtbins[i, :n], intensities[i, :n] = raw_data.dtBinAndIntensity
+        # continue the dtbins into the padding so that the model stays well defined there
+        dtbins[i, n:] = (dtbins[i, n - 1] + 1. if n > 0 else 1.) + arange(n_dtbins - n)
+        weights[i, :n] = 1.
+    return dtbins, intensities, weights
+
+
+class BatchGaussFit:
+
+    def __init__(self, dtbins, intensities, init_params=None, weights=None, estimator=None,
+                 roi_widths=globals.GAUSS_ROI_WIDTHS, conditioner=None):
+        """
+BatchGaussFit.__init__
+
+Initializes a BatchGaussFit object, which determines the gaussian parameters for each row of a stack of dtbin
+vs. intensity profiles. Depending on the estimator, every row is fit with a gaussian function ("fit"), or only
+the rows where the closed form moment estimates (see momentEstimates) fall below the quality thresholds
+globals.MOMENT_MIN_R2 and globals.MOMENT_MIN_SNR are fit and the moment estimates are used for the rest
+("tiered"). The gaussian fits only use the points within a region of interest around each peak (see
+roiSlice), but the fitted parameters describe (and fitData evaluates) the whole profile:
+    BatchGaussFit.initParams    - initial amplitude, mu, and sigma parameters with shape (n_rows, 3)
+                                    (numpy.array)
+    BatchGaussFit.optParams     - optimized amplitude, mu, and sigma parameters with shape (n_rows, 3)
+                                    (numpy.array)
+    BatchGaussFit.covars        - covariance of the optimized parameters with shape (n_rows, 3, 3), nan for
+                                    rows with moment estimates (numpy.array)
+    BatchGaussFit.converged     - whether the fit of each row converged, always True for rows with moment
+                                    estimates (numpy.array(bool))
+    BatchGaussFit.stalled       - whether the fit of each row stalled (see
+                                    BatchLeastSquares.batchLevenbergMarquardt), always False for rows with
+                                    moment estimates (numpy.array(bool))
+    BatchGaussFit.tiers         - which tier produced the parameters of each row: "moment" (closed form
+                                    moment estimates), "fit" (gaussian fit), or "failed" (the gaussian fit
+                                    did not converge or stalled) (numpy.array(str))
+    BatchGaussFit.r2            - R^2 of the gaussian implied by the moment estimates, None if the estimator
+                                    is "fit" (numpy.array)
+    BatchGaussFit.snr           - signal to noise ratio of each row, None if the estimator is "fit"
+                                    (numpy.array)
+
+Input(s):
+    dtbins              - dtbins with shape (n_dtbins,) if they are shared by all of the rows or (n_rows,
+                            n_dtbins) (numpy.array)
+    intensities         - intensities with shape (n_rows, n_dtbins) (numpy.array)
+    [init_params        - initial parameters with shape (n_rows, 3), if None then they are estimated in
+                            closed form from the points around the apex of each row (see seedParams)
+                            (numpy.array), optional default=None]
+    [weights            - weight of each point with shape (n_rows, n_dtbins), points with a weight of 0 are
+                            ignored (numpy.array), optional default=None]
+    [estimator          - drift time estimator, one of ESTIMATORS, or None to use globals.GAUSS_ESTIMATOR
+                            (string), optional default=None]
+    [roi_widths         - half width of the region of interest that is fit in multiples of the initial sigma
+                            parameter, 0 to fit the whole profile (float), optional
+                            default=globals.GAUSS_ROI_WIDTHS]
+    [conditioner        - conditions the whole stack of intensities before anything else (smoothing, baseline
+                            subtraction, normalization), BatchGaussFit.intensities holds the conditioned
+                            intensities (ProfileConditioner), optional default=None]
+"""
+        intensities = array(intensities, dtype=float).reshape(-1, array(intensities).shape[-1])
+        if conditioner is not None:
+            intensities = conditioner.condition(intensities, weights=weights)
+        self.dtBins = array(dtbins, dtype=float)
+        self.intensities = intensities
+        self.weights = weights
+        self.estimator = checkEstimator(estimator)
+        if init_params is None:
+            init_params = self.defaultInitParams()
+        self.initParams = array(init_params, dtype=float).reshape(-1, 3)
+        n_rows = intensities.shape[0]
+        self.optParams = zeros((n_rows, 3))
+        self.covars = full((n_rows, 3, 3), nan)
+        self.converged = ones(n_rows, dtype=bool)
+        self.stalled = zeros(n_rows, dtype=bool)
+        self.tiers = full(n_rows, "fit", dtype="<U6")
+        self.r2, self.snr = None, None
+        # rows that are good enough to use the moment estimates for
+        accept = zeros(n_rows, dtype=bool)
+        if self.estimator == "tiered":
+            params, fwhm, self.r2, self.snr = momentEstimates(self.stackedDtBins(), self.intensities,
+                                                              weights=self.weights)
+            accept = isfinite(fwhm) & (self.r2 >= globals.MOMENT_MIN_R2) & (self.snr >= globals.MOMENT_MIN_SNR)
+            self.optParams[accept] = params[accept]
+            self.tiers[accept] = "moment"
+        rows = nonzero(~accept)[0]
+        if len(rows) > 0:
+            dtbins, intensities = self.stackedDtBins()[rows], self.intensities[rows]
+            weights = ones(intensities.shape) if self.weights is None else array(self.weights, dtype=float)[rows]
+            if roi_widths > 0:
+                dtbins, intensities, weights = roiSlice(dtbins, intensities, weights, self.initParams[rows],
+                                                        widths=roi_widths)
+            fit = batchLevenbergMarquardt(gaussFunc, dtbins, intensities, self.initParams[rows], jac=gaussJac,
+                                          weights=weights)
+            self.optParams[rows], self.covars[rows], self.converged[rows], self.stalled[rows] = fit
+            # fits that stalled have not converged either, so they are also failed
+            self.tiers[rows[~fit[2] | fit[3]]] = "failed"
+
+    def stackedDtBins(self):
+        """
+BatchGaussFit.stackedDtBins
+
+Returns the dtbins with one row per profile (the dtbins may have been provided as a single row shared by
+all of the profiles)
+
+Input(s):
+    none
+
+Returns:
+    dtbins              - dtbins with shape (n_rows, n_dtbins) (numpy.array)
+"""
+        return self.dtBins + zeros(self.intensities.shape)
+
+    def defaultInitParams(self):
+        """
+BatchGaussFit.defaultInitParams
+
+Estimates the initial parameters for each row in closed form (see seedParams)
+
+Input(s):
+    none
+
+Returns:
+    init_params         - initial parameters with shape (n_rows, 3) (numpy.array)
+"""
+        return seedParams(self.stackedDtBins(), self.intensities, weights=self.weights)
+
+    def fitData(self):
+        """
+BatchGaussFit.fitData
+
+Evaluates the fitted gaussian functions at the dtbins of each row
+
+Input(s):
+    none
+
+Returns:
+    fit                 - fitted intensities with shape (n_rows, n_dtbins) (numpy.array)
+"""
+        return gaussFunc(self.stackedDtBins(), self.optParams)
@@ -0,0 +1,156 @@
+"""
+    CcsCal/processing/BatchLeastSquares.py
+    Dylan H. Ross
+        description:
+            Vectorized Levenberg-Marquardt least squares fitting of a model to many datasets at once. Each row of
+            a 2D stack of data is fit independently, but every iteration updates all of the rows that have not yet
+            converged with a single set of array operations, instead of making one scipy.optimize.curve_fit call
+            (with its per-call overhead) per dataset.
+"""
+
+
+from CcsCal import globals
+
+
+from numpy import (abs, all, broadcast_to, diagonal, errstate, eye, finfo, full, inf, isfinite, maximum, nonzero,
+                   ones, sqrt, sum, zeros)
+from numpy.linalg import LinAlgError, inv, pinv, solve
+
+
+def finiteDifferenceJacobian(model, x, params, f0=None):
+    """
+BatchLeastSquares.finiteDifferenceJacobian
+
+Computes the Jacobian of a model with respect to its parameters for each row of a batch using forward
+finite differences (with the same step size as scipy.optimize.curve_fit)
+
+Input(s):
+    model               - model function, model(x, params) -> values with shape (n_rows, n_points) (callable)
+    x                   - independent variable values with shape (n_rows, n_points) (numpy.array)
+    params              - parameters with shape (n_rows, n_params) (numpy.array)
+    [f0                 - model values at params, computed if not provided (numpy.array), optional
+                            default=None]
+
+Returns:
+    jac                 - Jacobian with shape (n_rows, n_points, n_params) (numpy.array)
+"""
+    if f0 is None:
+        f0 = model(x, params)
+    jac = zeros(f0.shape + (params.shape[1],))
+    steps = sqrt(finfo(float).eps) * maximum(abs(params), 1.)
+    for k in range(params.shape[1]):
+        stepped = params.copy()
+        stepped[:, k] += steps[:, k]
+        jac[:, :, k] = (model(x, stepped) - f0) / steps[:, k:k + 1]
+    return jac
+
+
+def batchLevenbergMarquardt(model, x, y, p0, jac=None, weights=None, max_iter=globals.LM_MAX_ITER,
+                            ftol=globals.LM_FTOL, xtol=globals.LM_XTOL):
+    """
+BatchLeastSquares.batchLevenbergMarquardt
+
+Fits a model to each row of a 2D stack of data by minimizing the (weighted) sum of squared residuals with
+the Levenberg-Marquardt algorithm, iterating on all of the unconverged rows at once. A row has converged
+when an accepted step reduces its sum of squared residuals by a fraction of at most ftol, when the step
+size relative to the parameters is at most xtol. A row has stalled (and is not iterated on any further) when
+the damping needed for a step to reduce its sum of squared residuals grows past globals.LM_MAX_LAMBDA, which
+means the fit failed rather than converged. Rows that have neither converged nor stalled within max_iter
+iterations are also not converged.
+
+The covariance of the optimized parameters is computed the same way as scipy.optimize.curve_fit (with
+absolute_sigma=False), i.e. inv(J^T W J) scaled by the reduced chi-squared. If there are not more (weighted)
+points than parameters, or J^T W J is singular, the covariance is filled with inf.
+
+Input(s):
+    model               - model function, model(x, params) -> values with shape (n_rows, n_points) (callable)
+    x                   - independent variable values, with shape (n_points,) if they are shared by all of
+                            the rows or (n_rows, n_points) (numpy.array)
+    y                   - data to fit with shape (n_rows, n_points) (numpy.array)
+    p0                  - initial parameters with shape (n_rows, n_params) (numpy.array)
+    [jac                - Jacobian function, jac(x, params) -> values with shape (n_rows, n_points,
+                            n_params), if None then forward finite differences are used (callable),
+                            optional default=None]
+    [weights            - weight of each point with shape (n_rows, n_points), points with a weight of 0
+                            are ignored (i.e. padding or points outside of a fitting window) (numpy.array),
+                            optional default=None]
+    [max_iter           - maximum number of iterations (int), optional default=globals.LM_MAX_ITER]
+    [ftol               - relative tolerance on the sum of squared residuals (float), optional
+                            default=globals.LM_FTOL]
+    [xtol               - relative tolerance on the parameters (float), optional default=globals.LM_XTOL]
+
+Returns:
+    params              - optimized parameters with shape (n_rows, n_params) (numpy.array)
+    covars              - covariance of the optimized parameters with shape (n_rows, n_params, n_params)
+                            (numpy.array)
+    converged           - whether each row converged (numpy.array(bool))
+    stalled             - whether each row stalled, these rows have not converged (numpy.array(bool))
+"""
+    y = y.astype(float).reshape(-1, y.shape[-1])
+    x = broadcast_to(x, y.shape).astype(float)
+    params = p0.astype(float).reshape(y.shape[0], -1).copy()
+    weights = ones(y.shape) if weights is None else broadcast_to(weights, y.shape).astype(float)
+    n_rows, n_params = params.shape
+    if jac is None:
+        jac = lambda xs, ps: finiteDifferenceJacobian(model, xs, ps)
+    with errstate(all="ignore"):
+        resid = y - model(x, params)
+        cost = sum(weights * resid**2, axis=1)
+    damping = full(n_rows, globals.LM_INIT_LAMBDA)
+    converged = zeros(n_rows, dtype=bool)
+    stalled = zeros(n_rows, dtype=bool)
+    # rows that are still being iterated on
+    active = isfinite(cost)
+    for _ in range(max_iter):
+        rows = nonzero(active)[0]
+        if len(rows) == 0:
+            break
+        xa, ya, wa, pa, ra, ca = x[rows], y[rows], weights[rows], params[rows], resid[rows], cost[rows]
+        with errstate(all="ignore"):
+            ja = jac(xa, pa)
+            jtw = ja.transpose(0, 2, 1) * wa[:, None, :]
+            jtj = jtw @ ja
+            grad = (jtw @ ra[:, :, None])[:, :, 0]
+            # Marquardt scaling of the damping term by the diagonal of J^T W J
+            scale = maximum(diagonal(jtj, axis1=1, axis2=2), finfo(float).eps)
+            lhs = jtj + damping[rows, None, None] * scale[:, :, None] * eye(n_params)
+            try:
+                step = solve(lhs, grad[:, :, None])[:, :, 0]
+            except LinAlgError:
+                step = (pinv(lhs) @ grad[:, :, None])[:, :, 0]
+            trial = pa + step
+            trial_resid = ya - model(xa, trial)
+            trial_cost = sum(wa * trial_resid**2, axis=1)
+        accepted = isfinite(trial_cost) & all(isfinite(trial), axis=1) & (trial_cost <= ca)
+        # convergence criteria (for accepted steps)
+        small_f = abs(ca - trial_cost) <= ftol * ca
+        small_x = sqrt(sum(step**2, axis=1)) <= xtol * (sqrt(sum(pa**2, axis=1)) + xtol)
+        done = accepted & (small_f | small_x | (trial_cost == 0.))
+        # no step can reduce the sum of squared residuals any further
+        stuck = ~accepted & (damping[rows] > globals.LM_MAX_LAMBDA)
+        params[rows[accepted]] = trial[accepted]
+        resid[rows[accepted]] = trial_resid[accepted]
+        cost[rows[accepted]] = trial_cost[accepted]
+        damping[rows[accepted]] /= 10.
+        damping[rows[~accepted]] *= 10.
+        converged[rows[done]] = True
+        stalled[rows[stuck]] = True
+        active[rows[done | stuck]] = False
+    covars = full((n_rows, n_params, n_params), inf)
+    dof = sum(weights > 0, axis=1) - n_params
+    rows = nonzero(dof > 0)[0]
+    if len(rows) > 0:
+        with errstate(all="ignore"):
+            ja = jac(x[rows], params[rows])
+            jtj = (ja.transpose(0, 2, 1) * weights[rows, None, :]) @ ja
+            scale = (cost[rows] / dof[rows])[:, None, None]
+            try:
+                covars[rows] = inv(jtj) * scale
+            except LinAlgError:
+                # at least one of the rows is singular, invert them one at a time to find which
+                for i, row in enumerate(rows):
+                    try:
+                        covars[row] = inv(jtj[i]) * scale[i]
+                    except LinAlgError:
+                        pass
+    return params, covars, converged, stalled
@@ -0,0 +1,225 @@
+"""
+    CcsCal/processing/BatchProcessor.py
+    Dylan H. Ross
+        description:
+            Extracts the drift times for a list of data file/mass pairs in chunks (the profiles in each chunk are
+            conditioned together as one stack), either one chunk after another or fanned out over a pool of
+            worker processes. Results are always returned in the same order as the input, and an
+            error processing one pair is recorded in its result instead of stopping the rest of the batch.
+"""
+
+
+from CcsCal import globals
+from CcsCal.input.RawData import RawData
+from CcsCal.processing.FitCache import FitCache
+from CcsCal.processing.GaussFit import GaussFit, conditionProfiles, queueGaussFitFig, wantsFigure
+
+
+from concurrent.futures import ProcessPoolExecutor
+
+
+class CompoundResult:
+
+    def __init__(self, data_file_name, mass):
+        """
+CompoundResult.__init__
+
+Initializes a new CompoundResult object, which holds the result of extracting the drift time for a single
+data file/mass pair:
+    CompoundResult.dataFileName     - name of the data file (string)
+    CompoundResult.mass             - mass the drift time was extracted for (float)
+    CompoundResult.driftTime        - extracted drift time, None if there was an error (float)
+    CompoundResult.tier             - which tier of the drift time estimator produced the drift time
+                                        ("moment", "fit", or "failed"), None if there was an error (string)
+    CompoundResult.rawAndFitData    - dtbins, raw intensities, and fitted intensities (see
+                                        GaussFit.rawandfitdata), None if there was an error (numpy.array)
+    CompoundResult.r2               - R^2 of the gaussian fit, None if there was an error (float)
+    CompoundResult.cached           - whether the result was loaded from the FitCache (bool)
+    CompoundResult.error            - description of the error, None if there was no error (string)
+
+Input(s):
+    data_file_name      - name of the data file (string)
+    mass                - mass to extract the drift time for (float)
+"""
+        self.dataFileName = data_file_name
+        self.mass = mass
+        self.driftTime = None
+        self.tier = None
+        self.rawAndFitData = None
+        self.r2 = None
+        self.cached = False
+        self.error = None
+
+
+def processCompounds(data_file_names, data_dir, masses, mass_window, gen_fig=True, estimator=None,
+                     cache=globals.USE_FIT_CACHE, conditioner=None):
+    """
+BatchProcessor.processCompounds
+
+Extracts the drift times for a chunk of data file/mass pairs (RawData -> GaussFit), loading any pair that
+has already been processed with the same data file and settings from the FitCache. The profiles of all of
+the pairs that are not cached are conditioned together as one stack (see GaussFit.conditionProfiles) before
+they are fit. Any error is caught and stored in the result for that pair so that it can be reported without
+affecting the other pairs in the batch. This is a module-level function so that it can be sent to worker
+processes.
+
+Input(s):
+    data_file_names     - names of the data files (list(string))
+    data_dir            - directory containing the data files (string)
+    masses              - masses to extract the drift times for (list(float))
+    mass_window         - window of masses to bin data together for (float)
+    [gen_fig            - whether to generate the gaussian fit figures, or a figure policy (see GaussFit)
+                            (bool or string), optional default=True]
+    [estimator          - drift time estimator (see GaussFit), None to use globals.GAUSS_ESTIMATOR (string),
+                            optional default=None]
+    [cache              - whether to use the FitCache (bool), optional default=globals.USE_FIT_CACHE]
+    [conditioner        - conditions the data before it is fit (ProfileConditioner), optional default=None]
+
+Returns:
+    results             - results for the data file/mass pairs, in the same order (list(CompoundResult))
+"""
+    fit_cache = FitCache()
+    results, pending = [], []
+    for data_file_name, mass in zip(data_file_names, masses):
+        result, key = CompoundResult(data_file_name, mass), None
+        results.append(result)
+        if cache:
+            key = fit_cache.key(data_dir + data_file_name, mass, mass_window, conditioner=conditioner,
+                                estimator=estimator)
+            entry = fit_cache.load(data_dir + data_file_name, key) if key is not None else None
+            if entry is not None:
+                result.driftTime, result.tier, result.r2, result.rawAndFitData = entry
+                result.cached = True
+                if wantsFigure(gen_fig, result.tier, result.r2):
+                    queueGaussFitFig(data_dir + data_file_name, mass, result.rawAndFitData,
+                                     conditioner=conditioner)
+                continue
+        try:
+            pending.append((result, key, RawData(data_dir + data_file_name, mass, mass_window)))
+        except Exception as e:
+            result.error = "{}: {}".format(type(e).__name__, e)
+    try:
+        conditioned = conditionProfiles([raw_data for _, _, raw_data in pending], conditioner)
+    except Exception:
+        # fall back on conditioning each profile by itself (in GaussFit) so one bad profile only affects its pair
+        conditioned = [None for _ in pending]
+    for (result, key, raw_data), c in zip(pending, conditioned):
+        try:
+            gauss_fit = GaussFit(raw_data, gen_fig=gen_fig, estimator=estimator, conditioner=conditioner,
+                                 conditioned=c)
+            result.driftTime, result.tier = gauss_fit.getDriftTime(), gauss_fit.tier
+            result.rawAndFitData, result.r2 = gauss_fit.rawandfitdata, gauss_fit.r2
+            if key is not None:
+                fit_cache.store(data_dir + result.dataFileName, key, result.driftTime, result.tier, result.r2,
+                                result.rawAndFitData)
+        except Exception as e:
+            result.error = "{}: {}".format(type(e).__name__, e)
+    return results
+
+
+def processCompound(data_file_name, data_dir, mass, mass_window, gen_fig=True, estimator=None,
+                    cache=globals.USE_FIT_CACHE, conditioner=None):
+    """
+BatchProcessor.processCompound
+
+Extracts the drift time for a single data file/mass pair, see processCompounds
+
+Input(s):
+    data_file_name      - name of the data file (string)
+    data_dir            - directory containing the data file (string)
+    mass                - mass to extract the drift time for (float)
+    mass_window         - window of masses to bin data together for (float)
+    [gen_fig            - whether to generate the gaussian fit figure, or a figure policy (see GaussFit)
+                            (bool or string), optional default=True]
+    [estimator          - drift time estimator (see GaussFit), None to use globals.GAUSS_ESTIMATOR (string),
+                            optional default=None]
+    [cache              - whether to use the FitCache (bool), optional default=globals.USE_FIT_CACHE]
+    [conditioner        - conditions the data before it is fit (ProfileConditioner), optional default=None]
+
+Returns:
+    result              - result for the data file/mass pair (CompoundResult)
+"""
+    return processCompounds([data_file_name], data_dir, [mass], mass_window, gen_fig=gen_fig, estimator=estimator,
+                            cache=cache, conditioner=conditioner)[0]
+
+
+class BatchProcessor:
+
+    def __init__(self, data_file_names, data_dir, masses, mass_window, jobs=globals.DEFAULT_JOBS, gen_fig=True,
+                 estimator=None, cache=globals.USE_FIT_CACHE, conditioner=None):
+        """
+BatchProcessor.__init__
+
+Initializes a new BatchProcessor object for extracting drift times for a list of data file/mass pairs
+
+Input(s):
+    data_file_names     - names of the data files (list(string))
+    data_dir            - directory containing the data files (string)
+    masses              - masses to extract drift times for (list(float))
+    mass_window         - window of masses to bin data together for (float)
+    [jobs               - number of worker processes, if 1 then the pairs are processed one after another
+                            in this process (int), optional default=globals.DEFAULT_JOBS]
+    [gen_fig            - whether to generate the gaussian fit figures, or a figure policy (see GaussFit)
+                            (bool or string), optional default=True]
+    [estimator          - drift time estimator (see GaussFit), None to use globals.GAUSS_ESTIMATOR (string),
+                            optional default=None]
+    [cache              - whether to use the FitCache (bool), optional default=globals.USE_FIT_CACHE]
+    [conditioner        - conditions the data before it is fit (ProfileConditioner), optional default=None]
+"""
+        self.dataFileNames = list(data_file_names)
+        self.dataDir = data_dir
+        self.masses = list(masses)
+        self.massWindow = mass_window
+        self.jobs = jobs
+        self.genFig = gen_fig
+        self.estimator = estimator
+        self.cache = cache
+        self.conditioner = conditioner
+
+    def results(self):
+        """
+BatchProcessor.results
+
+Processes all of the data file/mass pairs, yielding each result as soon as it (and all of the results
+before it) are done so that results can be reported in the same order as the input while the rest of
+the batch is still being processed. The gaussian fit figures are queued to the shared FigureRenderer of
+this process (worker processes send back the data for the figures rather than rendering them), so it
+must be drained to wait for them to be written.
+
+Input(s):
+    none
+
+Yields:
+    result              - result for the next data file/mass pair (CompoundResult)
+"""
+        pairs = list(zip(self.dataFileNames, self.masses))
+        chunks = [pairs[i:i + globals.BATCH_CHUNK_SIZE] for i in range(0, len(pairs), globals.BATCH_CHUNK_SIZE)]
+        if self.jobs <= 1:
+            for chunk in chunks:
+                for result in processCompounds([d for d, _ in chunk], self.dataDir, [m for _, m in chunk],
+                                               self.massWindow, gen_fig=self.genFig, estimator=self.estimator,
+                                               cache=self.cache, conditioner=self.conditioner):
+                    yield result
+        else:
+            with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+                # one task for each chunk of pairs, the figures are queued in this process once the results
+                # come back
+                futures = [executor.submit(processCompounds, [d for d, _ in chunk], self.dataDir,
+                                           [m for _, m in chunk], self.massWindow, gen_fig=False,
+                                           estimator=self.estimator, cache=self.cache, conditioner=self.conditioner)
+                           for chunk in chunks]
+                for chunk, future in zip(chunks, futures):
+                    try:
+                        results = future.result()
+                    except Exception as e:
+                        # the worker process itself failed (i.e. it was killed), only this chunk is affected
+                        results = []
+                        for data_file_name, mass in chunk:
+                            result = CompoundResult(data_file_name, mass)
+                            result.error = "{}: {}".format(type(e).__name__, e)
+                            results.append(result)
+                    for result in results:
+                        if result.rawAndFitData is not None and wantsFigure(self.genFig, result.tier, result.r2):
+                            queueGaussFitFig(self.dataDir + result.dataFileName, result.mass, result.rawAndFitData,
+                                             conditioner=self.conditioner)
+                        yield result
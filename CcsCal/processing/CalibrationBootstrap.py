@@ -0,0 +1,141 @@
+"""
+    CcsCal/processing/CalibrationBootstrap.py
+    Dylan H. Ross
+        description:
+            Confidence intervals for the CCS calibration curve parameters (A, t0, B) and for calibrated CCS values
+            by resampling the calibrants. Every resample is refit at once with the vectorized Levenberg-Marquardt
+            fitting in BatchCalCurveFit, warm-started from the fitted parameters of the calibration. Resamples are
+            expressed as weights on the calibrants (how many times each one was drawn, or 0 to leave it out), so
+            the calibrant data itself is never copied.
+"""
+
+
+from CcsCal import globals
+from CcsCal.processing.BatchCalCurveFit import batchFitCalCurve
+
+
+from numpy import (all, apply_along_axis, array, bincount, errstate, eye, full, isfinite, mean, nan,
+                   nanpercentile, ones, sqrt, sum, zeros)
+from numpy.random import RandomState
+from scipy.stats import norm
+
+
+# resampling methods:
+#   bootstrap   refit random resamples of the calibrants (with replacement), percentile intervals
+#   jackknife   refit the calibrants leaving out one at a time, normal intervals from the jackknife standard error
+RESAMPLING_METHODS = ("bootstrap", "jackknife")
+
+
+class CalibrationBootstrap:
+
+    def __init__(self, calibration, method="bootstrap", n_resamples=globals.BOOTSTRAP_RESAMPLES,
+                 confidence=globals.BOOTSTRAP_CONFIDENCE, seed=globals.BOOTSTRAP_SEED):
+        """
+CalibrationBootstrap.__init__
+
+Initializes a new CalibrationBootstrap object, which refits the calibration curve of a fitted calibration to
+resamples of its calibrants and computes confidence intervals from the refit parameters:
+    CalibrationBootstrap.params         - refit A, t0, and B parameters of each resample with shape
+                                            (n_resamples, 3), nan for resamples that could not be fit
+                                            (numpy.array)
+    CalibrationBootstrap.nUsed          - number of resamples that were fit successfully (int)
+    CalibrationBootstrap.paramIntervals - lower and upper bounds of the intervals of A, t0, and B with shape
+                                            (3, 2) (numpy.array)
+    CalibrationBootstrap.calCcsIntervals - lower and upper bounds of the intervals of the calibrated ccs of the
+                                            calibrants with shape (n_calibrants, 2) (numpy.array)
+
+Input(s):
+    calibration         - fitted calibration (CcsCalibration or CcsCalibrationExt)
+    [method             - resampling method, one of RESAMPLING_METHODS (string), optional default="bootstrap"]
+    [n_resamples        - number of bootstrap resamples, ignored for the jackknife (which has one resample per
+                            calibrant) (int), optional default=globals.BOOTSTRAP_RESAMPLES]
+    [confidence         - confidence level of the intervals (float), optional
+                            default=globals.BOOTSTRAP_CONFIDENCE]
+    [seed               - random seed for drawing the bootstrap resamples, None for a different seed every time
+                            (int), optional default=globals.BOOTSTRAP_SEED]
+"""
+        if method not in RESAMPLING_METHODS:
+            raise ValueError("CalibrationBootstrap: __init__: method must be one of " + str(RESAMPLING_METHODS) +
+                             " (got '" + str(method) + "')")
+        if calibration.fit_failed:
+            raise ValueError("CalibrationBootstrap: __init__: optimized fit parameters have not been generated," +
+                             " fitCalCurve() must be successfully run on the calibration first!")
+        self.calibration = calibration
+        self.method = method
+        self.confidence = confidence
+        n_cal = len(calibration.correctedDt)
+        if method == "bootstrap":
+            draws = RandomState(seed).randint(0, n_cal, size=(n_resamples, n_cal))
+            # number of times each calibrant was drawn in each resample
+            weights = apply_along_axis(bincount, 1, draws, minlength=n_cal).astype(float)
+        else:
+            weights = ones((n_cal, n_cal)) - eye(n_cal)
+        self.weights = weights
+        params, _, converged, stalled = batchFitCalCurve(calibration.correctedDt, calibration.correctedLitCcs,
+                                                         calibration.optparams, weights=weights)
+        # a resample needs more distinct calibrants than parameters to determine the curve, and resamples whose
+        # fits stalled are treated as failed
+        usable = converged & ~stalled & (sum(weights > 0, axis=1) > 3) & all(isfinite(params), axis=1)
+        params[~usable] = nan
+        self.params = params
+        self.nUsed = int(sum(usable))
+        self.paramIntervals = self.intervals(self.params, array(calibration.optparams, dtype=float))
+        self.calCcsIntervals = self.ccsIntervals(calibration.calMasses, calibration.calDriftTimes)
+
+    def intervals(self, values, estimates):
+        """
+CalibrationBootstrap.intervals
+
+Computes confidence intervals from the values of some quantities for each resample
+
+Input(s):
+    values              - values for each resample with shape (n_resamples, n_values), nan for resamples that
+                            could not be fit (numpy.array)
+    estimates           - values from the full set of calibrants with shape (n_values,) (numpy.array)
+
+Returns:
+    intervals           - lower and upper bounds of the intervals with shape (n_values, 2) (numpy.array)
+"""
+        if self.nUsed < 2:
+            return full((values.shape[1], 2), nan)
+        values = values[isfinite(self.params[:, 0])]
+        if self.method == "bootstrap":
+            alpha = 100. * (1. - self.confidence) / 2.
+            with errstate(all="ignore"):
+                return nanpercentile(values, [alpha, 100. - alpha], axis=0).T
+        n = values.shape[0]
+        with errstate(all="ignore"):
+            se = sqrt((n - 1.) / n * sum((values - mean(values, axis=0))**2, axis=0))
+        z = norm.ppf(0.5 + self.confidence / 2.)
+        return array([estimates - z * se, estimates + z * se]).T
+
+    def ccsIntervals(self, masses, drift_times, mode='N2'):
+        """
+CalibrationBootstrap.ccsIntervals
+
+Computes confidence intervals for the calibrated ccs of arrays of m/z and drift times, by calibrating them with
+the refit parameters of every resample. The values are processed in chunks so that at most
+globals.BOOTSTRAP_CHUNK_SIZE calibrated ccs values are held in memory at once.
+
+Input(s):
+    masses              - m/z values (numpy.array)
+    drift_times         - drift times with the same shape as masses (numpy.array)
+    [mode]              - calculate reduced mass for N2 or He (str, optional default='N2')
+
+Returns:
+    intervals           - lower and upper bounds of the intervals with shape (n_values, 2) (numpy.array)
+"""
+        masses = array(masses, dtype=float).ravel()
+        drift_times = array(drift_times, dtype=float).ravel()
+        calibration = self.calibration
+        estimates = calibration.getCalibratedCcsBulk(masses, drift_times, mode=mode)[0]
+        intervals = zeros((len(masses), 2))
+        chunk = max(1, globals.BOOTSTRAP_CHUNK_SIZE // max(self.params.shape[0], 1))
+        A, t0, B = self.params[:, 0:1], self.params[:, 1:2], self.params[:, 2:3]
+        for start in range(0, len(masses), chunk):
+            m, dt = masses[start:start + chunk], drift_times[start:start + chunk]
+            with errstate(all="ignore"):
+                ccs = A / sqrt(calibration.reducedMass(m, mode=mode)) * \
+                    (calibration.correctedDriftTime(dt, m) + t0)**B
+            intervals[start:start + chunk] = self.intervals(ccs, estimates[start:start + chunk])
+        return intervals
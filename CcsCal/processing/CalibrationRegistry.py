@@ -0,0 +1,251 @@
+"""
+    CcsCal/processing/CalibrationRegistry.py
+    Dylan H. Ross
+        description:
+            Stores many CCS calibrations (i.e. from calibrants run every few hours over a long acquisition
+            sequence) keyed by their acquisition timestamps, in a sorted index. The calibration for any time is
+            found with a binary search, either the nearest calibration or one with its parameters linearly
+            interpolated between the calibrations on either side, and whole lists of samples acquired at
+            different times can be converted to calibrated CCS in a single call.
+"""
+
+
+from CcsCal.processing.CcsCalibration import CcsCalibrationExt
+
+
+from bisect import bisect_left
+import numpy
+
+
+def toTimestamp(timestamp):
+    """
+CalibrationRegistry.toTimestamp
+
+Converts a timestamp to a number, so that datetime objects and numeric timestamps (i.e. seconds since the
+start of an acquisition sequence) can be used interchangeably. numpy.datetime64 values are converted the same
+way as the equivalent datetime.datetime.
+
+Input(s):
+    timestamp           - acquisition timestamp (float, datetime.datetime, or numpy.datetime64)
+
+Returns:
+    timestamp           - acquisition timestamp (float)
+"""
+    if isinstance(timestamp, numpy.datetime64):
+        timestamp = timestamp.astype("datetime64[us]").astype(object)
+    if hasattr(timestamp, "timestamp"):
+        return timestamp.timestamp()
+    return float(timestamp)
+
+
+def toTimestamps(timestamps):
+    """
+CalibrationRegistry.toTimestamps
+
+Converts an array of timestamps to numbers with toTimestamp. Numeric arrays are converted directly, arrays of
+datetime objects or numpy.datetime64 values are converted one element at a time.
+
+Input(s):
+    timestamps          - acquisition timestamps (numpy.array)
+
+Returns:
+    timestamps          - acquisition timestamps (numpy.array(float))
+"""
+    timestamps = numpy.asarray(timestamps)
+    if timestamps.dtype.kind in "biuf":
+        return timestamps.astype(float)
+    return numpy.array([toTimestamp(t) for t in timestamps.ravel()], dtype=float).reshape(timestamps.shape)
+
+
+class CalibrationRegistry:
+
+    def __init__(self, calibrations=None):
+        """
+CalibrationRegistry.__init__
+
+Initializes a new CalibrationRegistry object, which keeps calibrations sorted by their acquisition
+timestamps:
+    CalibrationRegistry.timestamps      - sorted acquisition timestamps (list(float))
+    CalibrationRegistry.calibrations    - calibrations, in the same order as the timestamps
+                                            (list(CcsCalibration))
+
+Input(s):
+    [calibrations       - acquisition timestamps and calibrations to add (list(tuple(float, CcsCalibration))),
+                            optional default=None]
+"""
+        self.timestamps = []
+        self.calibrations = []
+        # parameter table used for bulk conversions (see CalibrationRegistry.table), rebuilt after adding a
+        # calibration
+        self.tableCache = None
+        if calibrations is not None:
+            for timestamp, calibration in calibrations:
+                self.add(timestamp, calibration)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def add(self, timestamp, calibration):
+        """
+CalibrationRegistry.add
+
+Adds a calibration to the registry, replacing any calibration that already has the same timestamp
+
+Input(s):
+    timestamp           - acquisition timestamp of the calibrants (float or datetime.datetime)
+    calibration         - fitted calibration (CcsCalibration or CcsCalibrationExt)
+"""
+        if calibration.fit_failed:
+            raise ValueError("CalibrationRegistry: add: optimized fit parameters have not been generated," +
+                             " fitCalCurve() must be successfully run on the calibration first!")
+        timestamp = toTimestamp(timestamp)
+        i = bisect_left(self.timestamps, timestamp)
+        if i < len(self.timestamps) and self.timestamps[i] == timestamp:
+            self.calibrations[i] = calibration
+        else:
+            self.timestamps.insert(i, timestamp)
+            self.calibrations.insert(i, calibration)
+        self.tableCache = None
+
+    def neighbors(self, timestamp):
+        """
+CalibrationRegistry.neighbors
+
+Finds the calibrations on either side of a timestamp with a binary search. Timestamps before the first (or
+after the last) calibration only have one neighbor, and a timestamp that matches a calibration exactly is its
+own neighbor on both sides.
+
+Input(s):
+    timestamp           - acquisition timestamp, see toTimestamp (float or datetime.datetime)
+
+Returns:
+    before              - index of the calibration at or before the timestamp (int)
+    after               - index of the calibration at or after the timestamp (int)
+    fraction            - fraction of the way from the calibration before to the calibration after (float)
+"""
+        if not self.timestamps:
+            raise ValueError("CalibrationRegistry: neighbors: the registry is empty")
+        timestamp = toTimestamp(timestamp)
+        after = bisect_left(self.timestamps, timestamp)
+        if after == len(self.timestamps):
+            return after - 1, after - 1, 0.
+        if after == 0 or self.timestamps[after] == timestamp:
+            return after, after, 0.
+        before = after - 1
+        return before, after, (timestamp - self.timestamps[before]) / (self.timestamps[after] -
+                                                                      self.timestamps[before])
+
+    def calibrationAt(self, timestamp, interpolate=False):
+        """
+CalibrationRegistry.calibrationAt
+
+Gets the calibration for a timestamp, either the calibration that is nearest in time or a calibration with
+its parameters (A, t0, B, and the edc) linearly interpolated between the calibrations on either side. The
+covariance of the fitted parameters is not interpolated (an interpolated covariance does not describe the
+uncertainty of the interpolated parameters), the covariance of the nearest calibration is used instead.
+Timestamps outside of the range of the registry get the first (or last) calibration, the parameters are not
+extrapolated.
+
+Input(s):
+    timestamp           - acquisition timestamp, see toTimestamp (float or datetime.datetime)
+    [interpolate        - whether to interpolate the parameters between the calibrations on either side
+                            (bool), optional default=False]
+
+Returns:
+    calibration         - calibration for the timestamp, an interpolated calibration has the calibrants and the
+                            covariance of the nearest calibration (CcsCalibration or CcsCalibrationExt)
+"""
+        before, after, fraction = self.neighbors(timestamp)
+        nearest = self.calibrations[after if fraction > 0.5 else before]
+        if not interpolate or before == after:
+            return nearest
+        params = (1. - fraction) * self.table()[before] + fraction * self.table()[after]
+        calibration = CcsCalibrationExt(nearest.calMasses, nearest.calDriftTimes, nearest.calLitCcs,
+                                        init_params=tuple(params[:3]), edc=params[3], do_fit=False)
+        calibration.n2_mass, calibration.he_mass = nearest.n2_mass, nearest.he_mass
+        calibration.covar = nearest.covar
+        calibration.fit_failed = False
+        calibration.calCalcCcs = calibration.getCalibratedCcs(calibration.calMasses, calibration.calDriftTimes)
+        return calibration
+
+    def table(self):
+        """
+CalibrationRegistry.table
+
+Collects the parameters of all of the calibrations into a single array, so that they can be looked up and
+interpolated for many timestamps at once
+
+Input(s):
+    none
+
+Returns:
+    table               - A, t0, B, edc, the 9 elements of the covariance of the fitted parameters (nan if
+                            not available), N2 mass, and He mass of each calibration with shape
+                            (n_calibrations, 15) (numpy.array)
+"""
+        if self.tableCache is None:
+            rows = []
+            for calibration in self.calibrations:
+                covar = numpy.full((3, 3), numpy.nan) if calibration.covar is None else calibration.covar
+                rows.append(numpy.concatenate([numpy.asarray(calibration.optparams, dtype=float),
+                                               [calibration.edc],
+                                               numpy.asarray(covar, dtype=float).ravel(),
+                                               [calibration.n2_mass, calibration.he_mass]]))
+            self.tableCache = numpy.array(rows)
+        return self.tableCache
+
+    def getCalibratedCcsBulk(self, timestamps, masses, drift_times, mode='N2', interpolate=True):
+        """
+CalibrationRegistry.getCalibratedCcsBulk
+
+Gets calibrated ccs values for a whole list of samples acquired at different times in a single call, each
+sample calibrated with the calibration for its timestamp (see CalibrationRegistry.calibrationAt). The
+calibrations for all of the timestamps are found with one vectorized binary search, and the uncertainties are
+propagated from the covariance of the fitted parameters of the nearest calibration as in
+CcsCalibration.getCalibratedCcsBulk.
+
+Input(s):
+    timestamps          - acquisition timestamps of the samples, see toTimestamp (numpy.array)
+    masses              - m/z values (numpy.array)
+    drift_times         - drift times (numpy.array)
+    [mode]              - calculate reduced mass for N2 or He (str, optional default='N2')
+    [interpolate        - whether to interpolate the parameters between the calibrations on either side
+                            (bool), optional default=True]
+
+Returns:
+    ccs                 - calibrated ccs values (numpy.array)
+    ccs_err             - uncertainties of the calibrated ccs values, nan if the covariance of the fitted
+                            parameters is not available (numpy.array)
+"""
+        if not self.timestamps:
+            raise ValueError("CalibrationRegistry: getCalibratedCcsBulk: the registry is empty")
+        if mode not in ['N2', 'He']:
+            raise ValueError('CalibrationRegistry: getCalibratedCcsBulk: mode must be either "N2" or "He"')
+        timestamps, masses, drift_times = numpy.broadcast_arrays(toTimestamps(timestamps),
+                                                                 numpy.asarray(masses, dtype=float),
+                                                                 numpy.asarray(drift_times, dtype=float))
+        known = numpy.array(self.timestamps)
+        table = self.table()
+        # indices of the calibrations on either side of each timestamp, clamped to the range of the registry
+        after = numpy.clip(numpy.searchsorted(known, timestamps, side='left'), 0, len(known) - 1)
+        before = numpy.clip(after - 1, 0, len(known) - 1)
+        with numpy.errstate(all='ignore'):
+            span = known[after] - known[before]
+            fraction = numpy.where(span > 0, numpy.clip((timestamps - known[before]) / span, 0., 1.), 1.)
+        if not interpolate:
+            fraction = numpy.where(fraction > 0.5, 1., 0.)
+        params = (1. - fraction)[..., None] * table[before] + fraction[..., None] * table[after]
+        A, t0, B, edc = params[..., 0], params[..., 1], params[..., 2], params[..., 3]
+        # the covariance comes from the nearest calibration, see CalibrationRegistry.calibrationAt
+        nearest = numpy.where(fraction > 0.5, after, before)
+        covar = table[nearest, 4:13].reshape(params.shape[:-1] + (3, 3))
+        gas_mass = params[..., 13] if mode == 'N2' else params[..., 14]
+        with numpy.errstate(all='ignore'):
+            # same as CcsCalibration.getCalibratedCcsBulk, with parameters that vary from sample to sample
+            inv_sqrt_mu = numpy.sqrt((masses + gas_mass) / (masses * gas_mass))
+            x = drift_times - (numpy.sqrt(masses) * edc / 1000.0) + t0
+            x_B = x**B
+            ccs = A * inv_sqrt_mu * x_B
+            jac = numpy.stack([inv_sqrt_mu * x_B, ccs * B / x, ccs * numpy.log(x)], axis=-1)
+            ccs_err = numpy.sqrt(numpy.einsum('...i,...ij,...j->...', jac, covar, jac))
+        return ccs, ccs_err
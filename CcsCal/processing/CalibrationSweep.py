@@ -0,0 +1,145 @@
+"""
+    CcsCal/processing/CalibrationSweep.py
+    Dylan H. Ross
+        description:
+            Sweeps the EDC parameter (and optionally the initial parameters of the calibration curve fit) over a
+            grid, reusing the calibrant drift times that were already extracted. The corrected drift times for
+            the whole grid are computed in a single broadcasting pass and every grid point is fit at once with
+            the vectorized Levenberg-Marquardt fitting in BatchCalCurveFit, then the grid point with the lowest
+            residual CCS of the calibrants is picked as the best setting.
+"""
+
+
+from CcsCal import globals
+from CcsCal.processing.BatchCalCurveFit import batchFitCalCurve, calCurveFunc
+
+
+from numpy import (abs, all, argmin, array, errstate, inf, isfinite, max, mean, nan, nanargmin, repeat, sqrt,
+                   tile, unravel_index, where)
+
+
+# residual statistics of the calibrants that a sweep can pick the best setting by:
+#   rms     root mean square residual CCS (%)
+#   mean    mean absolute residual CCS (%)
+#   max     maximum absolute residual CCS (%)
+SWEEP_CRITERIA = ("rms", "mean", "max")
+
+
+class CalibrationSweep:
+
+    def __init__(self, calibration, edc_values, seeds=None, criterion=globals.SWEEP_CRITERION,
+                 max_iter=globals.CURVE_FIT_MAXFEV):
+        """
+CalibrationSweep.__init__
+
+Initializes a new CalibrationSweep object, which fits the calibration curve to the calibrants of a
+calibration for every combination of EDC parameter and initial fit parameters in a grid, and computes the
+residual statistics of each grid point:
+    CalibrationSweep.edcs               - EDC parameters of the grid with shape (n_edcs,) (numpy.array)
+    CalibrationSweep.seeds              - initial A, t0, and B parameters of the grid with shape (n_seeds, 3)
+                                            (numpy.array)
+    CalibrationSweep.params             - fitted A, t0, and B parameters of each grid point with shape
+                                            (n_edcs, n_seeds, 3) (numpy.array)
+    CalibrationSweep.converged          - whether the fit of each grid point converged with shape
+                                            (n_edcs, n_seeds) (numpy.array(bool))
+    CalibrationSweep.stalled            - whether the fit of each grid point stalled (see
+                                            BatchLeastSquares.batchLevenbergMarquardt) with shape (n_edcs, n_seeds)
+                                            (numpy.array(bool))
+    CalibrationSweep.rmsResidual        - root mean square residual CCS (%) of each grid point with shape
+                                            (n_edcs, n_seeds), nan if the fit failed (numpy.array)
+    CalibrationSweep.meanResidual       - mean absolute residual CCS (%), as above (numpy.array)
+    CalibrationSweep.maxResidual        - maximum absolute residual CCS (%), as above (numpy.array)
+    CalibrationSweep.bestIndex          - indices of the best grid point in the EDC parameters and seeds, None
+                                            if none of the fits succeeded (tuple(int) or None)
+    CalibrationSweep.bestEdc            - EDC parameter of the best grid point, None if none of the fits
+                                            succeeded (float or None)
+    CalibrationSweep.bestParams         - fitted A, t0, and B parameters of the best grid point, None if none of
+                                            the fits succeeded (numpy.array or None)
+
+Input(s):
+    calibration         - calibration with extracted calibrant drift times (CcsCalibration or CcsCalibrationExt)
+    edc_values          - EDC parameters to try (list(float))
+    [seeds              - initial A, t0, and B parameters to try for each EDC parameter, None to only use the
+                            current parameters of the calibration (list(tuple(float))), optional default=None]
+    [criterion          - residual statistic to pick the best grid point by, one of SWEEP_CRITERIA (string),
+                            optional default=globals.SWEEP_CRITERION]
+    [max_iter           - maximum number of iterations for each fit (int), optional
+                            default=globals.CURVE_FIT_MAXFEV]
+"""
+        if criterion not in SWEEP_CRITERIA:
+            raise ValueError("CalibrationSweep: __init__: criterion must be one of " + str(SWEEP_CRITERIA) +
+                             " (got '" + str(criterion) + "')")
+        self.calibration = calibration
+        self.criterion = criterion
+        self.edcs = array(edc_values, dtype=float).ravel()
+        if seeds is None:
+            seeds = [calibration.optparams]
+        self.seeds = array(seeds, dtype=float).reshape(-1, 3)
+        n_edcs, n_seeds = len(self.edcs), len(self.seeds)
+        # corrected drift times of the calibrants for every EDC parameter at once, with shape (n_edcs, n_cal),
+        # the corrected ccs do not depend on the EDC parameter
+        masses = array(calibration.calMasses, dtype=float)
+        corrected_dt = array(calibration.calDriftTimes, dtype=float) - sqrt(masses) * self.edcs[:, None] / 1000.
+        corrected_ccs = array(calibration.correctedLitCcs, dtype=float)
+        # one row for each combination of EDC parameter and seed
+        x = repeat(corrected_dt, n_seeds, axis=0)
+        params, _, converged, stalled = batchFitCalCurve(x, corrected_ccs, tile(self.seeds, (n_edcs, 1)),
+                                                         max_iter=max_iter)
+        with errstate(all="ignore"):
+            residuals = 100. * (corrected_ccs - calCurveFunc(x, params)) / corrected_ccs
+            # fits that stalled failed, their grid points get nan residual statistics
+            ok = converged & ~stalled & all(isfinite(params), axis=1) & all(isfinite(residuals), axis=1)
+            stats = {"rms": sqrt(mean(residuals**2, axis=1)),
+                     "mean": mean(abs(residuals), axis=1),
+                     "max": max(abs(residuals), axis=1)}
+        shape = (n_edcs, n_seeds)
+        self.params = params.reshape(shape + (3,))
+        self.converged = converged.reshape(shape)
+        self.stalled = stalled.reshape(shape)
+        self.rmsResidual, self.meanResidual, self.maxResidual = \
+            [where(ok, stats[k], nan).reshape(shape) for k in ["rms", "mean", "max"]]
+        self.bestIndex, self.bestEdc, self.bestParams = None, None, None
+        if ok.any():
+            score = where(ok, stats[criterion], nan)
+            self.bestIndex = tuple(int(i) for i in unravel_index(nanargmin(score), shape))
+            self.bestEdc = float(self.edcs[self.bestIndex[0]])
+            self.bestParams = self.params[self.bestIndex]
+
+    def bestSeeds(self):
+        """
+CalibrationSweep.bestSeeds
+
+Finds the best seed for each EDC parameter in the grid (i.e. to summarize the sweep with one line per EDC
+parameter)
+
+Input(s):
+    none
+
+Returns:
+    best_seeds          - index of the best seed for each EDC parameter, -1 if none of the fits for that EDC
+                            parameter succeeded (numpy.array(int))
+"""
+        score = {"rms": self.rmsResidual, "mean": self.meanResidual, "max": self.maxResidual}[self.criterion]
+        failed = ~isfinite(score).any(axis=1)
+        return where(failed, -1, argmin(where(isfinite(score), score, inf), axis=1))
+
+    def apply(self):
+        """
+CalibrationSweep.apply
+
+Applies the best setting from the sweep to the calibration: sets its EDC parameter, recomputes the corrected
+drift times of the calibrants, and refits the calibration curve starting from the best fitted parameters
+(which also computes their covariance)
+
+Input(s):
+    none
+"""
+        if self.bestIndex is None:
+            raise ValueError("CalibrationSweep: apply: none of the fits in the sweep succeeded")
+        calibration = self.calibration
+        calibration.edc = self.bestEdc
+        calibration.correctedDt = calibration.correctedDriftTime(calibration.calDriftTimes, calibration.calMasses)
+        calibration.optparams = [float(p) for p in self.bestParams]
+        calibration.fitCalCurve()
+        if not calibration.fit_failed:
+            calibration.calCalcCcs = calibration.getCalibratedCcs(calibration.calMasses, calibration.calDriftTimes)
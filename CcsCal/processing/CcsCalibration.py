@@ -2,21 +2,70 @@
     CcsCal/processing/CcsCalibration.py
     Dylan H. Ross
         description:
-            TODO
+            Builds a CCS calibration curve by extracting the drift times of the calibrants from their raw data
+            file and fitting them against the (corrected) literature CCS values. The fitted curve converts m/z
+            and drift time into calibrated CCS, one value or whole arrays at a time. A calibration can be saved
+            and loaded again (see saveCalibration and loadCalibration). CcsCalibrationExt builds one straight
+            from calibrant m/z, drift times and CCS values.
 """
 
 
 from CcsCal import globals
-from CcsCal.input.RawData import RawData
-from CcsCal.processing.GaussFit import GaussFit
+from CcsCal.input.DataCache import fileFingerprint
+from CcsCal.input.RawData import MultiMassExtractor
+from CcsCal.processing.GaussFit import GaussFit, conditionProfiles
+from CcsCal.processing.CalibrationSweep import CalibrationSweep
+from CcsCal.processing.BatchCalCurveFit import calCurveJac, seedCalCurve
+from CcsCal.processing.FigureRenderer import getRenderer, renderCalCurveFig
 
 
+import json
 import numpy
-from matplotlib import pyplot as plt
-from matplotlib import gridspec as gs
+from os.path import abspath, isfile, splitext
 from scipy.optimize import curve_fit
 
 
+# identifies calibration artifact files (see CcsCalibration.saveCalibration), and the version of their layout
+CALIBRATION_FORMAT = "CcsCal calibration"
+CALIBRATION_VERSION = 2
+
+
+def calibrationSettings(mass_window, edc, cal_masses=None, cal_lit_ccs=None, conditioner=None, estimator=None,
+                        edc_sweep=None):
+    """
+CcsCalibration.calibrationSettings
+
+Describes the settings that a calibration was performed with, so that a saved calibration artifact is only
+reused by runs with the same settings (see CcsCalibration.saveCalibration and loadCalibration)
+
+Input(s):
+    mass_window             - mass window the calibrant drift times were extracted with (float)
+    edc                     - edc delay coefficient from the input file (float)
+    [cal_masses             - calibrant m/z values, None if they are not known (i.e. omitted from the input file)
+                                (list(float)), optional default=None]
+    [cal_lit_ccs            - calibrant literature ccs values, None if they are not known (list(float)), optional
+                                default=None]
+    [conditioner            - conditions the data before it is fit (ProfileConditioner), optional default=None]
+    [estimator              - drift time estimator, None to use globals.GAUSS_ESTIMATOR (string), optional
+                                default=None]
+    [edc_sweep              - minimum, maximum, and number of EDC parameters in a sweep (list(float)), optional
+                                default=None]
+
+Returns:
+    settings                - the settings, calibrant values that are not known are left out (dict)
+"""
+    settings = {"mass_window": float(mass_window),
+                "edc": float(edc),
+                "conditioning": conditioner.settings() if conditioner is not None else None,
+                "estimator": estimator if estimator is not None else globals.GAUSS_ESTIMATOR,
+                "edc_sweep": None if edc_sweep is None else [float(v) for v in edc_sweep]}
+    if cal_masses is not None:
+        settings["cal_mz"] = [float(m) for m in cal_masses]
+    if cal_lit_ccs is not None:
+        settings["cal_lit_ccs"] = [float(c) for c in cal_lit_ccs]
+    return settings
+
+
 class CcsCalibration:
 
     def __init__ (self,
@@ -26,24 +75,32 @@ class CcsCalibration:
                   mass_window,
                   edc=globals.DEFAULT_EDC,
                   pp=True,
-                  gauss_figs=True):
+                  gauss_figs=True,
+                  estimator=None,
+                  conditioner=None):
         """
 CcsCalibration -- Class
 
 Makes use of a GaussFit object to extract the drift times for a list of
-calibrant masses. Then, using a list of calibrant literature ccs values, a
+calibrant masses. The raw data file is only read once for all of the calibrant masses
+(using a MultiMassExtractor). Then, using a list of calibrant literature ccs values, a
 ccs calibration curve is generated. Once the curve has been fit, the
 CcsCalibration.getCalibratedCcs method can be used to get a calibrated ccs for a
 given mass and drift time
 
 Input(s):
-    data_file               - name of raw data file (string)
+    data_file               - name of raw data file, or an IMMatrix loaded from it (string or IMMatrix)
     cal_masses              - calibrant m/z values (list)
     cal_lit_ccs             - calibrant literature ccs values (list)
     mass_window             - specify a mass window to extract values from (float)
     [optional edc           - edc delay coefficient (float) [default = globals.DEFAULT_EDC]
-    [optional pp            - pp parameter passed to RawData instances [default = True]
-    [optional gauss_figs    - generate figures of the gaussian fits [default = True]
+    [optional pp            - pp parameter passed to the MultiMassExtractor [default = True]
+    [optional gauss_figs    - generate figures of the gaussian fits, or a figure policy (see GaussFit)
+                                [default = True]
+    [optional estimator     - drift time estimator passed to GaussFit, None to use globals.GAUSS_ESTIMATOR
+                                [default = None]
+    [optional conditioner   - conditions the data before it is fit, passed to GaussFit (ProfileConditioner)
+                                [default = None]
  """
         # store some calculation constants
         self.edc = edc
@@ -55,18 +112,27 @@ Input(s):
         self.calMasses = numpy.array(cal_masses)
         # make an array with calibrant lit ccs values
         self.calLitCcs = numpy.array(cal_lit_ccs_vals)
-        # make an array with calibrant drift times
-        self.calDriftTimes = numpy.zeros([len(self.calMasses)])
-        for n in range(len(self.calMasses)):
-            self.calDriftTimes[n - 1] = GaussFit(RawData(data_file,
-                                                         self.calMasses[n - 1],
-                                                         mass_window, pp=pp), gen_fig=gauss_figs).getDriftTime()
+        # the calibrant data file the calibration comes from (recorded in saved calibration artifacts)
+        self.calDataFile = data_file if isinstance(data_file, str) else getattr(data_file, "dataFileName", None)
+        # extract the data for all of the calibrant masses in a single pass over the data file
+        extractor = MultiMassExtractor(data_file, self.calMasses, mass_window, pp=pp)
+        # make an array with calibrant drift times, and which tier of the drift time estimator produced each
+        # the profiles of all of the calibrants are conditioned together as one stack
+        conditioned = conditionProfiles(extractor.rawData, conditioner)
+        gauss_fits = [GaussFit(raw_data, gen_fig=gauss_figs, estimator=estimator, conditioner=conditioner,
+                               conditioned=c)
+                      for raw_data, c in zip(extractor.rawData, conditioned)]
+        self.calDriftTimes = numpy.array([gauss_fit.getDriftTime() for gauss_fit in gauss_fits])
+        self.calTiers = [gauss_fit.tier for gauss_fit in gauss_fits]
+        # keep the data and quality of the gaussian fits (i.e. for a ContactSheet)
+        self.calRawAndFitData = [gauss_fit.rawandfitdata for gauss_fit in gauss_fits]
+        self.calR2 = [gauss_fit.r2 for gauss_fit in gauss_fits]
         # make an array with corrected drift time
         self.correctedDt = self.correctedDriftTime(self.calDriftTimes, self.calMasses)
         # make an array with corrected lit ccs
         self.correctedLitCcs = self.calLitCcs * numpy.sqrt(self.reducedMass(self.calMasses))
-        # Optimized parameters A, t0, B
-        self.optparams = [globals.INIT_A, globals.INIT_T0, globals.INIT_B]
+        # Optimized parameters A, t0, B, starting from the linearized estimate
+        self.optparams = list(seedCalCurve(self.correctedDt, self.correctedLitCcs)[0])
         self.covar = None
         self.fit_failed = True
         # perform the calibration
@@ -86,11 +152,27 @@ Input(s):
 
 Returns:
                             - reduced mass (float)
+"""
+        gas_mass = self.gasMass(mode)
+        return (mass * gas_mass) / (mass + gas_mass)
+
+    def gasMass(self, mode='N2'):
+        """
+CcsCalibration.gasMass
+
+Looks up the mass of the drift gas, so that the mode only needs to be checked once for a whole array of
+masses
+
+Input(s):
+    [mode]         - N2 or He (str, optional default='N2')
+
+Returns:
+                            - mass of the drift gas (float)
 """
         if mode == 'N2':
-            return (mass * self.n2_mass) / (mass + self.n2_mass)
+            return self.n2_mass
         elif mode == 'He':
-            return (mass * self.he_mass) / (mass + self.he_mass)
+            return self.he_mass
         else:
             raise ValueError('CcsCalibration: reducedMass: mode must be either "N2" or "He"')
 
@@ -124,12 +206,31 @@ Returns:
     """
         return (A  * (dt + t0)**B)
 
+    def baseCalCurveJac(self, dt, A, t0, B):
+        """
+CcsCalibration.baseCalCurveJac
+
+Analytic Jacobian of the basic power function for calibration curve with respect to
+its parameters (see BatchCalCurveFit.calCurveJac)
+
+Input(s):
+    dt                      - drift times (numpy.array)
+    A, t0, B                - curve parameters (float, float, float)
+
+Returns:
+                            - derivatives with respect to A, t0, and B with shape
+                                (len(dt), 3) (numpy.array)
+"""
+        return calCurveJac(numpy.atleast_2d(numpy.asarray(dt, dtype=float)), numpy.array([[A, t0, B]]))[0]
+
     def fitCalCurve(self):
         """
 CcsCalibration.fitCalCurve
 
 Performs least squares fit of the power equation CcsCalibration.baseCalCurve(...) to
-the corrected literature ccs data and corrected drift time values
+the corrected literature ccs data and corrected drift time values, starting from the
+current parameters (CcsCalibration.optparams) and using the analytic Jacobian
+CcsCalibration.baseCalCurveJac(...)
 
 Input(s):
     none
@@ -140,6 +241,7 @@ Input(s):
                                                    self.correctedDt,
                                                    self.correctedLitCcs,
                                                    p0=self.optparams,
+                                                   jac=self.baseCalCurveJac,
                                                    maxfev=self.max_fev)
         except RuntimeError:
             self.fit_failed = True
@@ -168,12 +270,81 @@ Returns:
             raise ValueError("CcsCalibration: getcalibratedCcs: optimized fit parameters have not been generated," +
                              " fitCalCurve() must be successfully run first!")
 
+    def getCalibratedCcsBulk(self, masses, drift_times, mode='N2'):
+        """
+CcsCalibration.getCalibratedCcsBulk
+
+Uses the fitted parameters for the ccs calibration curve to get calibrated ccs values for whole arrays of m/z
+and drift times at once, along with their uncertainties propagated from the covariance of the fitted
+parameters (CcsCalibration.covar). The uncertainty of each ccs is sqrt(J C J^T), where J is the gradient of
+the ccs with respect to the A, t0, and B parameters (computed analytically for all of the values at once) and
+C is the covariance. Drift times that are shorter than the mass-dependent flight time correction (minus t0)
+give a ccs of nan.
+
+Input(s):
+    masses                  - m/z values (numpy.array)
+    drift_times             - drift times, with the same shape as masses or a shape that can be broadcast
+                                against it (numpy.array)
+    [mode]                  - calculate reduced mass for N2 or He (str, optional default='N2')
+
+Returns:
+    ccs                     - calibrated ccs values (numpy.array)
+    ccs_err                 - uncertainties of the calibrated ccs values, nan if the covariance of the fitted
+                                parameters is not available (numpy.array)
+"""
+        if self.fit_failed:
+            raise ValueError("CcsCalibration: getCalibratedCcsBulk: optimized fit parameters have not been " +
+                             "generated, fitCalCurve() must be successfully run first!")
+        masses, drift_times = numpy.broadcast_arrays(numpy.asarray(masses, dtype=float),
+                                                     numpy.asarray(drift_times, dtype=float))
+        A, t0, B = self.optparams
+        gas_mass = self.gasMass(mode)
+        with numpy.errstate(all='ignore'):
+            # 1 / sqrt(reduced mass) and the corrected drift time plus t0
+            inv_sqrt_mu = numpy.sqrt((masses + gas_mass) / (masses * gas_mass))
+            x = drift_times - (numpy.sqrt(masses) * self.edc / 1000.0) + t0
+            x_B = x**B
+            ccs = A * inv_sqrt_mu * x_B
+            # gradient of the ccs with respect to A, t0, and B
+            jac = numpy.stack([inv_sqrt_mu * x_B, ccs * B / x, ccs * numpy.log(x)], axis=-1)
+            covar = numpy.full((3, 3), numpy.nan) if self.covar is None else numpy.asarray(self.covar)
+            ccs_err = numpy.sqrt(numpy.einsum('...i,ij,...j->...', jac, covar, jac))
+        return ccs, ccs_err
+
+    def sweepEdc(self, edc_values, seeds=None, criterion=globals.SWEEP_CRITERION, apply=True):
+        """
+CcsCalibration.sweepEdc
+
+Fits the calibration curve for a grid of EDC parameters (and optionally initial fit parameters) using the
+calibrant drift times that were already extracted, then picks the setting with the lowest residual CCS of the
+calibrants (see CalibrationSweep)
+
+Input(s):
+    edc_values              - EDC parameters to try (list(float))
+    [seeds                  - initial A, t0, and B parameters to try for each EDC parameter, None to only use
+                                the current parameters (list(tuple(float))), optional default=None]
+    [criterion              - residual statistic to pick the best setting by, one of
+                                CalibrationSweep.SWEEP_CRITERIA (string), optional
+                                default=globals.SWEEP_CRITERION]
+    [apply                  - whether to apply the best setting to this calibration (bool), optional
+                                default=True]
+
+Returns:
+    sweep                   - fitted parameters and residual statistics for each grid point, and the best
+                                setting (CalibrationSweep)
+"""
+        sweep = CalibrationSweep(self, edc_values, seeds=seeds, criterion=criterion)
+        if apply:
+            sweep.apply()
+        return sweep
+
     def saveCalCurveFig(self, figure_file_name="cal_curve.png"):
         """
 CcsCalibration.saveCalCurveFig
 
 Outputs a Figure showing the CCS calibration curve fitted to the CCS
-calibration data
+calibration data. The figure is queued to be rendered in the background by the
+shared FigureRenderer, use getRenderer().drain() to wait for it to be written.
 
 Input(s):
     [optional] figure_file_name - choose a different filename to save the
@@ -181,36 +352,132 @@ Input(s):
                                   = "cal_curve.png"]
 """
         if not self.fit_failed:
-            g = gs.GridSpec(2,1,height_ratios=[globals.HEIGHT_RATIO_1, globals.HEIGHT_RATIO_2])
-            plt.subplot(g[0])
-            plt.plot(self.correctedDt,
-                   self.correctedLitCcs,
-                   'ko' ,
-                   fillstyle='none',
-                   markeredgewidth=1.0,
-                   label="calibrants")
-            plt.plot(self.correctedDt,
-                     self.baseCalCurve(self.correctedDt, self.optparams[0], self.optparams[1], self.optparams[2]),
-                     'black',
-                     label="fitted curve")
-            plt.legend(loc="best")
-            plt.title("CCS Calibration")
-            plt.ylabel("corrected CCS")
-            plt.subplot(g[1])
-            plt.bar(self.correctedDt,
-                    numpy.array((100. * (self.calLitCcs - self.calCalcCcs) / self.calLitCcs)),
-                    0.25,
-                    color='black',
-                    align='center')
-            plt.xlabel("corrected drift time (ms)")
-            plt.ylabel("residual CCS (%)")
-            plt.axhline(y=0, color='black')
-            plt.savefig(figure_file_name, bbox_inches='tight', dpi=500)
-            plt.close()
+            # the figure is rendered in the background by the shared FigureRenderer
+            getRenderer().submit(renderCalCurveFig,
+                                 figure_file_name,
+                                 numpy.array(self.correctedDt),
+                                 numpy.array(self.correctedLitCcs),
+                                 self.baseCalCurve(self.correctedDt, self.optparams[0], self.optparams[1],
+                                                   self.optparams[2]),
+                                 numpy.array((100. * (self.calLitCcs - self.calCalcCcs) / self.calLitCcs)))
         else:
             raise ValueError("CcsCalibration: saveCalCurveFig: optimized fit parameters have not been generated," +
                              " fitCalCurve() must be successfully run first!")
 
+    def saveCalibration(self, file_name, settings=None):
+        """
+CcsCalibration.saveCalibration
+
+Saves the calibration as a compact artifact that can be loaded with loadCalibration instead of repeating the
+calibration, either as JSON or npz depending on the file extension (.json or .npz). The artifact contains the
+fitted parameters and their covariance, the edc and drift gas masses, the calibrant table (m/z, extracted
+drift times, literature ccs, and drift time estimator tiers if available), and the path and fingerprint of
+the calibrant data file (see DataCache.fileFingerprint) if there is one, and the settings the calibration was
+performed with (if provided).
+
+Input(s):
+    file_name               - file name to save the calibration under, ending in .json or .npz (string)
+    [settings               - settings the calibration was performed with (see calibrationSettings), checked by
+                                loadCalibration (dict), optional default=None]
+"""
+        if self.fit_failed:
+            raise ValueError("CcsCalibration: saveCalibration: optimized fit parameters have not been generated," +
+                             " fitCalCurve() must be successfully run first!")
+        ext = splitext(file_name)[1].lower()
+        if ext not in [".json", ".npz"]:
+            raise ValueError("CcsCalibration: saveCalibration: file_name must end in .json or .npz (got '" +
+                             file_name + "')")
+        source = getattr(self, "calDataFile", None)
+        fingerprint = fileFingerprint(source) if source is not None and isfile(source) else None
+        covar = numpy.full((3, 3), numpy.nan) if self.covar is None else numpy.asarray(self.covar, dtype=float)
+        tiers = getattr(self, "calTiers", None)
+        artifact = {"format": CALIBRATION_FORMAT,
+                    "version": CALIBRATION_VERSION,
+                    "optparams": [float(p) for p in self.optparams],
+                    "covar": covar.tolist(),
+                    "edc": float(self.edc),
+                    "n2_mass": float(self.n2_mass),
+                    "he_mass": float(self.he_mass),
+                    "cal_mz": numpy.asarray(self.calMasses, dtype=float).tolist(),
+                    "cal_dt": numpy.asarray(self.calDriftTimes, dtype=float).tolist(),
+                    "cal_lit_ccs": numpy.asarray(self.calLitCcs, dtype=float).tolist(),
+                    "cal_tiers": None if tiers is None else [str(tier) for tier in tiers],
+                    "source_file": None if source is None else abspath(source),
+                    "source_fingerprint": fingerprint,
+                    "settings": settings}
+        if ext == ".json":
+            with open(file_name, "w") as f:
+                json.dump(artifact, f)
+        else:
+            # the values that are not arrays are stored as a JSON string alongside the arrays
+            arrays = ["optparams", "covar", "cal_mz", "cal_dt", "cal_lit_ccs"]
+            numpy.savez(file_name,
+                        meta=json.dumps({k: v for k, v in artifact.items() if k not in arrays}),
+                        **{k: numpy.array(artifact[k], dtype=float) for k in arrays})
+
+
+def loadCalibration(file_name, source_file=None, settings=None):
+    """
+CcsCalibration.loadCalibration
+
+Loads a calibration artifact saved by CcsCalibration.saveCalibration (JSON or npz, depending on the file
+extension), without repeating the calibration
+
+Input(s):
+    file_name               - file name of the calibration artifact, ending in .json or .npz (string)
+    [source_file            - calibrant data file the calibration is expected to come from, if provided and
+                                the artifact records a fingerprint for it then a ValueError is raised if the
+                                file has changed since the calibration was saved (string), optional
+                                default=None]
+    [settings               - settings of the current run (see calibrationSettings), if provided then a
+                                ValueError is raised if any of them differ from the settings that the calibration
+                                was saved with, calibrant values that are left out of the settings are not
+                                checked (dict), optional default=None]
+
+Returns:
+    calibration             - the loaded calibration, with CcsCalibrationExt.calDataFile and
+                                CcsCalibrationExt.calTiers restored from the artifact (CcsCalibrationExt)
+"""
+    ext = splitext(file_name)[1].lower()
+    if ext == ".json":
+        with open(file_name, "r") as f:
+            artifact = json.load(f)
+    elif ext == ".npz":
+        with numpy.load(file_name) as data:
+            artifact = json.loads(str(data["meta"]))
+            for k in ["optparams", "covar", "cal_mz", "cal_dt", "cal_lit_ccs"]:
+                artifact[k] = data[k]
+    else:
+        raise ValueError("CcsCalibration: loadCalibration: file_name must end in .json or .npz (got '" +
+                         file_name + "')")
+    if artifact.get("format") != CALIBRATION_FORMAT or artifact.get("version") != CALIBRATION_VERSION:
+        raise ValueError("CcsCalibration: loadCalibration: " + file_name + " is not a version " +
+                         str(CALIBRATION_VERSION) + " calibration artifact")
+    if source_file is not None and artifact["source_fingerprint"] is not None:
+        if fileFingerprint(source_file) != artifact["source_fingerprint"]:
+            raise ValueError("CcsCalibration: loadCalibration: calibrant data file " + source_file +
+                             " has changed since the calibration in " + file_name + " was saved")
+    if settings is not None:
+        saved = artifact.get("settings") or {}
+        # compare the JSON representations, the same way the settings are stored in the artifact
+        changed = [k for k in sorted(settings) if k not in saved or
+                   json.dumps(settings[k], sort_keys=True) != json.dumps(saved[k], sort_keys=True)]
+        if changed:
+            raise ValueError("CcsCalibration: loadCalibration: settings (" + ", ".join(changed) + ") have " +
+                             "changed since the calibration in " + file_name + " was saved")
+    calibration = CcsCalibrationExt(artifact["cal_mz"], artifact["cal_dt"], artifact["cal_lit_ccs"],
+                                    init_params=tuple(artifact["optparams"]), edc=artifact["edc"], do_fit=False)
+    calibration.n2_mass, calibration.he_mass = artifact["n2_mass"], artifact["he_mass"]
+    calibration.covar = numpy.array(artifact["covar"], dtype=float)
+    calibration.calDataFile = artifact["source_file"]
+    calibration.calTiers = artifact["cal_tiers"]
+    calibration.fit_failed = False
+    # recompute the corrected calibrant values with the drift gas masses from the artifact
+    calibration.correctedDt = calibration.correctedDriftTime(calibration.calDriftTimes, calibration.calMasses)
+    calibration.correctedLitCcs = calibration.calLitCcs * numpy.sqrt(calibration.reducedMass(calibration.calMasses))
+    calibration.calCalcCcs = calibration.getCalibratedCcs(calibration.calMasses, calibration.calDriftTimes)
+    return calibration
+
 
 class CcsCalibrationExt(CcsCalibration):
     """
@@ -223,7 +490,7 @@ structuring inputs/outputs
 """
 
     def __init__(self, calibrant_mz, calibrant_dt, calibrant_ccs,
-                 init_params=(500, 0, 0.5), edc=1.35, max_fev=5000, do_fit=True):
+                 init_params=None, edc=1.35, max_fev=5000, do_fit=True):
         """
 CcsCalibrationExt.__init__
 
@@ -233,8 +500,9 @@ Input(s):
     calibrant_mz            - list of calibrant m/z values (list(float))
     calibrant_dt            - list of calibrant drift times (list(float))
     calibrant_ccs           - list of calibrant ccs values (list(float))
-    [optional] init_params  - A, t0, B parameters for CCS calibration power function (tuple(float), optional
-                              default=(500, 0, 0.5))
+    [optional] init_params  - A, t0, B parameters for CCS calibration power function, if None then they are
+                              estimated from the calibrants (see BatchCalCurveFit.seedCalCurve) (tuple(float),
+                              optional default=None)
     [optional] edc          - edc parameter (float, optional default=1.35)
     [optional] max_fev      - maximum iterations for curve fit to converge (int, optional default=5000)
     [optional] do_fit       - whether to perform curve fit at initialization (bool, optional default=True)
@@ -247,13 +515,15 @@ Input(s):
         # TODO: implement helium option
         self.he_mass = 4.0026
         self.max_fev = max_fev
-        self.optparams = init_params
         # make numpy arrays with calibrant m/z, dt, and CCS
         self.calMasses, self.calDriftTimes, self.calLitCcs = \
                     numpy.array(calibrant_mz), numpy.array(calibrant_dt), numpy.array(calibrant_ccs)
         # make arrays with corrected drift time and CCS
         self.correctedDt = self.correctedDriftTime(self.calDriftTimes, self.calMasses)
         self.correctedLitCcs = self.calLitCcs * numpy.sqrt(self.reducedMass(self.calMasses))
+        if init_params is None:
+            init_params = seedCalCurve(self.correctedDt, self.correctedLitCcs)[0]
+        self.optparams = list(init_params)
         # automatically perform calibration if asked to do so
         if do_fit:
             # perform the calibration
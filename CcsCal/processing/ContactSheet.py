@@ -0,0 +1,148 @@
+"""
+    CcsCal/processing/ContactSheet.py
+    Dylan H. Ross
+        description:
+            Writes a single self-contained HTML file with a small inline SVG thumbnail of every drift time profile
+            and its gaussian fit (built from GaussFit.rawandfitdata), as a lightweight alternative to rendering a
+            full resolution figure for every fit. The thumbnails are drawn directly as SVG polylines, without
+            matplotlib, so the whole sheet takes a small fraction of the time and disk space of the figures.
+            Failed and low quality fits are outlined in red.
+"""
+
+
+from CcsCal import globals
+
+
+from html import escape
+from numpy import amax, amin, array, isfinite
+
+
+def svgPoints(x, y, x_range, y_range, width, height):
+    """
+ContactSheet.svgPoints
+
+Converts data to the points attribute of an SVG polyline, scaled to fit a thumbnail
+
+Input(s):
+    x                   - x values (numpy.array)
+    y                   - y values (numpy.array)
+    x_range             - (minimum, maximum) x values of the thumbnail (tuple(float, float))
+    y_range             - (minimum, maximum) y values of the thumbnail (tuple(float, float))
+    width               - width of the thumbnail (int)
+    height              - height of the thumbnail (int)
+
+Returns:
+    points              - polyline points (string)
+"""
+    keep = isfinite(x) & isfinite(y)
+    x_span = (x_range[1] - x_range[0]) or 1.
+    y_span = (y_range[1] - y_range[0]) or 1.
+    px = (x[keep] - x_range[0]) / x_span * width
+    py = height - (y[keep] - y_range[0]) / y_span * height
+    return " ".join(["{:.1f},{:.1f}".format(a, b) for a, b in zip(px, py)])
+
+
+class ContactSheet:
+
+    def __init__(self, sheet_file_name, title="CcsCal drift time profiles",
+                 thumbnail_size=globals.CONTACT_SHEET_THUMBNAIL_SIZE):
+        """
+ContactSheet.__init__
+
+Initializes a new ContactSheet object, profiles are added with ContactSheet.add and the sheet is written with
+ContactSheet.write
+
+Input(s):
+    sheet_file_name     - path to the HTML file to write (string)
+    [title              - title of the sheet (string), optional default="CcsCal drift time profiles"]
+    [thumbnail_size     - (width, height) of each thumbnail in pixels (tuple(int, int)), optional
+                            default=globals.CONTACT_SHEET_THUMBNAIL_SIZE]
+"""
+        self.sheetFileName = sheet_file_name
+        self.title = title
+        self.thumbnailSize = thumbnail_size
+        self.cards = []
+        self.nFlagged = 0
+
+    def add(self, label, mass, rawandfitdata, drift_time=None, tier=None, r2=None, flagged=False):
+        """
+ContactSheet.add
+
+Adds a drift time profile and its gaussian fit to the sheet
+
+Input(s):
+    label               - label for the profile, i.e. the data file name (string)
+    mass                - mass the profile was extracted for (float)
+    rawandfitdata       - dtbins, raw intensities, and fitted intensities (see GaussFit.rawandfitdata)
+                            (numpy.array)
+    [drift_time         - extracted drift time (float), optional default=None]
+    [tier               - tier of the drift time estimator that produced the drift time (string), optional
+                            default=None]
+    [r2                 - R^2 of the gaussian fit (float), optional default=None]
+    [flagged            - whether to outline the thumbnail in red (i.e. a failed or low quality fit) (bool),
+                            optional default=False]
+"""
+        self.cards.append(self.card(label, mass, array(rawandfitdata, dtype=float), drift_time, tier, r2, flagged))
+        self.nFlagged += 1 if flagged else 0
+
+    def card(self, label, mass, rawandfitdata, drift_time, tier, r2, flagged):
+        """
+ContactSheet.card
+
+Builds the HTML for a single profile
+
+Input(s):
+    label, mass, rawandfitdata, drift_time, tier, r2, flagged - see ContactSheet.add
+
+Returns:
+    card                - HTML for the profile (string)
+"""
+        width, height = self.thumbnailSize
+        x, raw, fit = rawandfitdata
+        x_range = (amin(x), amax(x)) if len(x) else (0., 1.)
+        y_values = [v for v in list(raw) + list(fit) if isfinite(v)]
+        y_range = (min(min(y_values), 0.), max(y_values)) if y_values else (0., 1.)
+        details = ["m/z {:.4f}".format(mass)]
+        if drift_time is not None:
+            details.append("dt {:.3f} ms".format(drift_time))
+        if tier is not None:
+            details.append(escape(str(tier)))
+        if r2 is not None:
+            details.append("R&sup2; {:.3f}".format(r2))
+        return ('<div class="card{}">'.format(" flagged" if flagged else "") +
+                '<div class="label">' + escape(str(label)) + '</div>' +
+                '<svg width="{0}" height="{1}" viewBox="0 0 {0} {1}">'.format(width, height) +
+                '<polyline class="raw" points="' + svgPoints(x, raw, x_range, y_range, width, height) + '"/>' +
+                '<polyline class="fit" points="' + svgPoints(x, fit, x_range, y_range, width, height) + '"/>' +
+                '</svg><div class="details">' + " &middot; ".join(details) + '</div></div>')
+
+    def write(self):
+        """
+ContactSheet.write
+
+Writes the sheet to its HTML file
+
+Input(s):
+    none
+"""
+        with open(self.sheetFileName, "w") as f:
+            f.write("<!DOCTYPE html>\n<html>\n<head>\n<meta charset=\"utf-8\">\n")
+            f.write("<title>" + escape(self.title) + "</title>\n")
+            f.write("<style>\n"
+                    "body { font-family: sans-serif; font-size: 11px; }\n"
+                    ".card { display: inline-block; margin: 3px; padding: 3px; border: 2px solid #ddd; }\n"
+                    ".card.flagged { border-color: #d00; }\n"
+                    ".label { max-width: " + str(self.thumbnailSize[0]) + "px; overflow: hidden; "
+                    "white-space: nowrap; text-overflow: ellipsis; }\n"
+                    "svg { display: block; background: #fafafa; }\n"
+                    "polyline { fill: none; stroke-width: 1; }\n"
+                    "polyline.raw { stroke: blue; stroke-dasharray: 2,1; }\n"
+                    "polyline.fit { stroke: black; }\n"
+                    "</style>\n</head>\n<body>\n")
+            f.write("<h3>" + escape(self.title) + "</h3>\n")
+            f.write("<p>{} profiles, {} failed or low quality fits (outlined in red). ".format(len(self.cards),
+                                                                                            self.nFlagged) +
+                    "Raw data is dashed blue, gaussian fits are black.</p>\n")
+            for card in self.cards:
+                f.write(card + "\n")
+            f.write("</body>\n</html>\n")
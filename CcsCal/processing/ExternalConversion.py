@@ -0,0 +1,178 @@
+"""
+    CcsCal/processing/ExternalConversion.py
+    Dylan H. Ross
+        description:
+            Calibrates CCS for drift times that were extracted by other software. A CcsCalibrationExt is fit
+            once to a CSV of calibrant m/z, drift times, and literature CCS, then a CSV feature table of any size
+            is streamed through it in chunks of rows: each chunk is parsed, converted to calibrated CCS (with
+            uncertainties) in a single vectorized call, and written out before the next chunk is read, so the
+            memory used does not depend on the size of the feature table. Feature tables may be compressed (see
+            CompressedFile).
+"""
+
+
+from CcsCal import globals
+from CcsCal.input.CompressedFile import openDataFile
+from CcsCal.processing.CcsCalibration import CcsCalibrationExt
+
+
+from io import TextIOWrapper
+from itertools import islice
+import numpy
+
+
+def parseCsvColumns(lines, columns, delimiter=","):
+    """
+ExternalConversion.parseCsvColumns
+
+Parses numeric columns from lines of a CSV file. All of the lines are parsed at once if possible, otherwise
+(i.e. if some of the lines have missing or non-numeric values) they are parsed one at a time.
+
+Input(s):
+    lines               - lines of the CSV file, without blank lines (list(string))
+    columns             - indices of the columns to parse (list(int))
+    [delimiter          - column delimiter (string), optional default=","]
+
+Returns:
+    values              - values of the columns with shape (len(lines), len(columns)), nan for lines that
+                            could not be parsed (numpy.array)
+"""
+    try:
+        return numpy.loadtxt(lines, delimiter=delimiter, usecols=columns, comments=None, ndmin=2,
+                             dtype=float).reshape(len(lines), len(columns))
+    except (ValueError, IndexError):
+        values = numpy.full((len(lines), len(columns)), numpy.nan)
+        for i, line in enumerate(lines):
+            fields = line.split(delimiter)
+            try:
+                values[i] = [float(fields[column]) for column in columns]
+            except (ValueError, IndexError):
+                pass
+        return values
+
+
+def isHeader(line, columns, delimiter=","):
+    """
+ExternalConversion.isHeader
+
+Determines whether a line of a CSV file is a header, i.e. it has a non-numeric value (such as a column name) in
+at least one of the columns. Empty or missing values do not make a line a header.
+
+Input(s):
+    line                - line of the CSV file, without the line ending (string)
+    columns             - indices of the numeric columns (list(int))
+    [delimiter          - column delimiter (string), optional default=","]
+
+Returns:
+    header              - whether the line is a header (bool)
+"""
+    fields = line.split(delimiter)
+    for column in columns:
+        field = fields[column].strip() if column < len(fields) else ""
+        if not field:
+            continue
+        try:
+            float(field)
+        except ValueError:
+            return True
+    return False
+
+
+def readCsvChunks(f, columns, delimiter=",", chunk_rows=globals.EXT_CHUNK_ROWS):
+    """
+ExternalConversion.readCsvChunks
+
+Reads a CSV file in chunks of rows, skipping blank lines. If the first line has non-numeric values in the
+columns it is treated as a header (see isHeader), a first line that only has empty values is a row of data.
+
+Input(s):
+    f                   - CSV file opened in text mode (file)
+    columns             - indices of the numeric columns to parse (list(int))
+    [delimiter          - column delimiter (string), optional default=","]
+    [chunk_rows         - number of lines to read at a time (int), optional default=globals.EXT_CHUNK_ROWS]
+
+Yields:
+    header              - the header line, None for the first chunk of a file without a header or for the
+                            chunks after the first (string or None)
+    lines               - lines in the chunk, without line endings (list(string))
+    values              - values of the columns, see parseCsvColumns (numpy.array)
+"""
+    first = True
+    while True:
+        lines = [line.rstrip("\r\n") for line in islice(f, chunk_rows)]
+        if not lines:
+            return
+        lines = [line for line in lines if line.strip()]
+        header = None
+        if first and lines:
+            first = False
+            if isHeader(lines[0], columns, delimiter=delimiter):
+                header, lines = lines[0], lines[1:]
+        yield header, lines, parseCsvColumns(lines, columns, delimiter=delimiter) if lines else \
+            numpy.zeros((0, len(columns)))
+
+
+def calibrateFromCsv(calibrant_file, edc=globals.DEFAULT_EDC, delimiter=","):
+    """
+ExternalConversion.calibrateFromCsv
+
+Fits a CCS calibration to a CSV of calibrant m/z, drift times, and literature CCS (the first three columns,
+with or without a header). Rows without numeric values are skipped.
+
+Input(s):
+    calibrant_file      - CSV file of calibrant m/z, drift times, and literature CCS (string)
+    [edc                - edc delay coefficient (float), optional default=globals.DEFAULT_EDC]
+    [delimiter          - column delimiter (string), optional default=","]
+
+Returns:
+    calibration         - fitted calibration (CcsCalibrationExt)
+"""
+    with TextIOWrapper(openDataFile(calibrant_file)) as f:
+        values = numpy.concatenate([chunk for _, _, chunk in readCsvChunks(f, [0, 1, 2], delimiter=delimiter)])
+    values = values[numpy.isfinite(values).all(axis=1)]
+    if len(values) < 4:
+        raise ValueError("ExternalConversion: calibrateFromCsv: " + calibrant_file + " must have at least 4 " +
+                         "calibrants with numeric m/z, drift time, and CCS (found " + str(len(values)) + ")")
+    calibration = CcsCalibrationExt(values[:, 0], values[:, 1], values[:, 2], edc=edc)
+    calibration.calDataFile = calibrant_file
+    return calibration
+
+
+def convertFeatureCsv(calibration, feature_file, output_file, mz_column=0, dt_column=1, delimiter=",",
+                      mode='N2', chunk_rows=globals.EXT_CHUNK_ROWS):
+    """
+ExternalConversion.convertFeatureCsv
+
+Streams a CSV feature table through a fitted calibration in chunks of rows, writing each row with its
+calibrated CCS and the uncertainty of the calibrated CCS (see CcsCalibration.getCalibratedCcsBulk) appended as
+two new columns. A header line (if there is one) gets "ccs" and "ccs_err" appended. Rows without a numeric m/z
+or drift time are written with a CCS of nan.
+
+Input(s):
+    calibration         - fitted calibration (CcsCalibration or CcsCalibrationExt)
+    feature_file        - CSV feature table, may be compressed (string)
+    output_file         - file name to write the feature table with calibrated CCS to (string)
+    [mz_column          - index of the m/z column (int), optional default=0]
+    [dt_column          - index of the drift time column (int), optional default=1]
+    [delimiter          - column delimiter (string), optional default=","]
+    [mode               - calculate reduced mass for N2 or He (str), optional default='N2']
+    [chunk_rows         - number of rows to convert at a time (int), optional default=globals.EXT_CHUNK_ROWS]
+
+Returns:
+    n_rows              - number of rows written, not counting the header (int)
+    n_failed            - number of rows without a calibrated CCS (int)
+"""
+    n_rows, n_failed = 0, 0
+    with TextIOWrapper(openDataFile(feature_file)) as f, open(output_file, "w") as out:
+        for header, lines, values in readCsvChunks(f, [mz_column, dt_column], delimiter=delimiter,
+                                                   chunk_rows=chunk_rows):
+            if header is not None:
+                out.write(header + delimiter + "ccs" + delimiter + "ccs_err\n")
+            if not lines:
+                continue
+            ccs, ccs_err = calibration.getCalibratedCcsBulk(values[:, 0], values[:, 1], mode=mode)
+            out.writelines(["{}{}{:.4f}{}{:.4f}\n".format(line, delimiter, c, delimiter, e)
+                            for line, c, e in zip(lines, ccs, ccs_err)])
+            n_rows += len(lines)
+            n_failed += int(numpy.sum(~numpy.isfinite(ccs)))
+    return n_rows, n_failed
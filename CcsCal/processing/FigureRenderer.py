@@ -0,0 +1,304 @@
+"""
+    CcsCal/processing/FigureRenderer.py
+    Dylan H. Ross
+        description:
+            Renders figures (gaussian fits, CCS calibration curves) in the background. Figures are drawn with the
+            object-oriented matplotlib Figure/Agg API rather than the global pyplot state, so they can safely be
+            rendered by a pool of worker threads while the rest of the pipeline continues. The render functions
+            only take plain data (file names, arrays, strings) so that figures can be queued from anywhere,
+            including from the results of worker processes. The shared renderer (getRenderer) must be drained
+            before exiting, or any figures still in the queue are not written.
+"""
+
+
+from CcsCal import globals
+
+
+import atexit
+from concurrent.futures import ThreadPoolExecutor, wait
+from threading import BoundedSemaphore, Lock
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+
+# names of the gaussian fit figure policies:
+#   none        do not generate gaussian fit figures
+#   failed      only generate figures for failed or low quality fits (see GaussFit.isPoorFit)
+#   all         generate figures for all of the fits
+FIGURE_POLICIES = ("none", "failed", "all")
+
+
+def checkFigurePolicy(policy):
+    """
+FigureRenderer.checkFigurePolicy
+
+Resolves a gaussian fit figure policy, raising a ValueError if it is not one of FIGURE_POLICIES. True and
+False are accepted in place of "all" and "none" (i.e. the gen_fig parameter of GaussFit).
+
+Input(s):
+    policy              - name of the policy, True, False, or None to use globals.FIGURE_POLICY
+                            (string or bool)
+
+Returns:
+    policy              - name of the policy (string)
+"""
+    if policy is None:
+        policy = globals.FIGURE_POLICY
+    if policy is True:
+        return "all"
+    if policy is False:
+        return "none"
+    if policy not in FIGURE_POLICIES:
+        raise ValueError("FigureRenderer: checkFigurePolicy: policy must be one of " + str(FIGURE_POLICIES) +
+                         " (got '" + str(policy) + "')")
+    return policy
+
+
+def newFigure():
+    """
+FigureRenderer.newFigure
+
+Creates a new Figure attached to its own Agg canvas, independent of the global pyplot state
+
+Input(s):
+    none
+
+Returns:
+    figure              - new figure (matplotlib.figure.Figure)
+"""
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    return figure
+
+
+def renderGaussFitFig(figure_file_name, rawandfitdata, title, data_label, dpi=globals.FIGURE_DPI):
+    """
+FigureRenderer.renderGaussFitFig
+
+Renders a figure of the raw dtbin vs. intensity data and the fitted gaussian function to a file
+
+Input(s):
+    figure_file_name    - file name to save the figure under (string)
+    rawandfitdata       - dtbins, raw intensities, and fitted intensities (see GaussFit.rawandfitdata)
+                            (numpy.array)
+    title               - figure title (string)
+    data_label          - legend label for the raw data (string)
+    [dpi                - resolution of the figure (int), optional default=globals.FIGURE_DPI]
+"""
+    figure = newFigure()
+    ax = figure.add_subplot(111)
+    ax.plot(rawandfitdata[0],
+            rawandfitdata[1],
+            color='blue',
+            ls='--',
+            marker='o',
+            ms=5,
+            mec='blue',
+            mfc='blue',
+            label=data_label)
+    ax.plot(rawandfitdata[0],
+            rawandfitdata[2],
+            color='black',
+            ls='-',
+            label="gaussian fit")
+    ax.legend(loc="best")
+    ax.ticklabel_format(style='sci', axis='y', scilimits=(0, 0))
+    ax.set_xlabel("dt bin")
+    ax.set_ylabel("intensity")
+    ax.set_title(title)
+    figure.savefig(figure_file_name, bbox_inches='tight', dpi=dpi)
+
+
+def renderCalCurveFig(figure_file_name, corrected_dt, corrected_lit_ccs, fitted_ccs, residuals,
+                      dpi=globals.FIGURE_DPI):
+    """
+FigureRenderer.renderCalCurveFig
+
+Renders a figure of the CCS calibration curve fitted to the CCS calibration data, with the residual CCS of
+the calibrants below it, to a file
+
+Input(s):
+    figure_file_name    - file name to save the figure under (string)
+    corrected_dt        - corrected drift times of the calibrants (numpy.array)
+    corrected_lit_ccs   - corrected literature CCS of the calibrants (numpy.array)
+    fitted_ccs          - corrected CCS from the fitted calibration curve (numpy.array)
+    residuals           - residual CCS of the calibrants (%) (numpy.array)
+    [dpi                - resolution of the figure (int), optional default=globals.FIGURE_DPI]
+"""
+    figure = newFigure()
+    g = figure.add_gridspec(2, 1, height_ratios=[globals.HEIGHT_RATIO_1, globals.HEIGHT_RATIO_2])
+    ax = figure.add_subplot(g[0])
+    ax.plot(corrected_dt,
+            corrected_lit_ccs,
+            'ko',
+            fillstyle='none',
+            markeredgewidth=1.0,
+            label="calibrants")
+    ax.plot(corrected_dt,
+            fitted_ccs,
+            'black',
+            label="fitted curve")
+    ax.legend(loc="best")
+    ax.set_title("CCS Calibration")
+    ax.set_ylabel("corrected CCS")
+    ax = figure.add_subplot(g[1])
+    ax.bar(corrected_dt,
+           residuals,
+           0.25,
+           color='black',
+           align='center')
+    ax.set_xlabel("corrected drift time (ms)")
+    ax.set_ylabel("residual CCS (%)")
+    ax.axhline(y=0, color='black')
+    figure.savefig(figure_file_name, bbox_inches='tight', dpi=dpi)
+
+
+class FigureRenderer:
+
+    def __init__(self, jobs=globals.FIGURE_JOBS, queue_size=globals.FIGURE_QUEUE_SIZE):
+        """
+FigureRenderer.__init__
+
+Initializes a new FigureRenderer object, which renders queued figures using a pool of worker threads. At
+most queue_size figures can be waiting to be rendered at a time, queueing another one blocks until there is
+room, which limits how much figure data is held in memory if figures are queued faster than they can be
+rendered. Errors rendering a figure are collected rather than raised:
+    FigureRenderer.errors       - descriptions of the errors rendering figures (list(string))
+
+Input(s):
+    [jobs               - number of worker threads, if 0 then figures are rendered immediately when they
+                            are queued (int), optional default=globals.FIGURE_JOBS]
+    [queue_size         - maximum number of figures waiting to be rendered (int), optional
+                            default=globals.FIGURE_QUEUE_SIZE]
+"""
+        self.jobs = jobs
+        self.errors = []
+        self.executor = None
+        self.pending = set()
+        self.lock = Lock()
+        self.slots = BoundedSemaphore(max(queue_size, 1))
+
+    def submit(self, render, figure_file_name, *args, **kwargs):
+        """
+FigureRenderer.submit
+
+Queues a figure to be rendered
+
+Input(s):
+    render              - render function, i.e. renderGaussFitFig (callable)
+    figure_file_name    - file name to save the figure under, the first argument of the render function
+                            (string)
+    *args, **kwargs     - the rest of the arguments of the render function
+"""
+        if self.jobs <= 0:
+            try:
+                render(figure_file_name, *args, **kwargs)
+            except Exception as e:
+                self.errors.append(self.describeError(figure_file_name, e))
+            return
+        self.slots.acquire()
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.jobs)
+            future = self.executor.submit(render, figure_file_name, *args, **kwargs)
+            self.pending.add(future)
+        future.add_done_callback(lambda f: self.done(f, figure_file_name))
+
+    def done(self, future, figure_file_name):
+        """
+FigureRenderer.done
+
+Called when a queued figure has been rendered (or failed to), records any error and frees its slot in the
+queue
+
+Input(s):
+    future              - future of the render function call (concurrent.futures.Future)
+    figure_file_name    - file name the figure was saved under (string)
+"""
+        with self.lock:
+            self.pending.discard(future)
+            if future.exception() is not None:
+                self.errors.append(self.describeError(figure_file_name, future.exception()))
+        self.slots.release()
+
+    def describeError(self, figure_file_name, error):
+        """
+FigureRenderer.describeError
+
+Describes an error rendering a figure
+
+Input(s):
+    figure_file_name    - file name of the figure (string)
+    error               - error raised by the render function (Exception)
+
+Returns:
+    description         - description of the error (string)
+"""
+        return "failed to render figure {}: {}: {}".format(figure_file_name, type(error).__name__, error)
+
+    def drain(self):
+        """
+FigureRenderer.drain
+
+Waits for all of the queued figures to be rendered, then returns (and clears) the errors from rendering
+them
+
+Input(s):
+    none
+
+Returns:
+    errors              - descriptions of the errors rendering figures (list(string))
+"""
+        while True:
+            with self.lock:
+                pending = list(self.pending)
+            if not pending:
+                break
+            wait(pending)
+        with self.lock:
+            errors, self.errors = self.errors, []
+        return errors
+
+    def shutdown(self):
+        """
+FigureRenderer.shutdown
+
+Waits for all of the queued figures to be rendered, printing any errors, then stops the worker threads
+
+Input(s):
+    none
+"""
+        for error in self.drain():
+            print(error)
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
+
+
+# the shared renderer used by GaussFit and CcsCalibration
+RENDERER = None
+RENDERER_LOCK = Lock()
+
+
+def getRenderer():
+    """
+FigureRenderer.getRenderer
+
+Returns the shared FigureRenderer, creating it the first time this is called. The shared renderer is shut
+down (after rendering any figures still in the queue) when the interpreter exits, but it should be drained
+explicitly before then so that the figures are written in a predictable order with respect to the rest of
+the output.
+
+Input(s):
+    none
+
+Returns:
+    renderer            - the shared renderer (FigureRenderer)
+"""
+    global RENDERER
+    with RENDERER_LOCK:
+        if RENDERER is None:
+            RENDERER = FigureRenderer()
+            atexit.register(RENDERER.shutdown)
+        return RENDERER
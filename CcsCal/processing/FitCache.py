@@ -0,0 +1,192 @@
+"""
+    CcsCal/processing/FitCache.py
+    Dylan H. Ross
+        description:
+            Persistent cache of drift time extraction results (RawData -> GaussFit) for data file/mass pairs.
+            Entries are addressed by a hash of everything that determines the result: the identity of the data
+            file (size, mtime, and hash, see DataCache.fileFingerprint), the mass and mass window, the conditioning
+            settings (see ProfileConditioner), the drift time estimator and fitting settings, and
+            globals.FITTER_VERSION. A cache hit skips reading the data file and fitting entirely.
+"""
+
+
+from CcsCal import globals
+from CcsCal.input.DataCache import fileFingerprint
+
+
+from os import getpid, listdir, makedirs, remove, replace, stat, utime
+from os.path import abspath, basename, dirname, getsize, join, splitext
+from hashlib import sha1
+from json import dumps
+from numpy import array, load, nan, savez
+
+
+# suffix of the fit cache entry files (which may share a directory with DataCache entries)
+ENTRY_SUFFIX = ".fit.npz"
+
+
+class FitCache:
+
+    def __init__(self, cache_dir=globals.FIT_CACHE_DIR, max_size=globals.FIT_CACHE_MAX_SIZE):
+        """
+FitCache.__init__
+
+Initializes a new FitCache object. Each cache entry is a single .npz file with the drift time, the tier of
+the drift time estimator that produced it, the R^2 of the gaussian fit, and the raw and fitted data (see
+GaussFit.rawandfitdata). The modification time of the file records when the entry was last used, and the
+least recently used entries are evicted when the total size of the entries in a cache directory exceeds
+max_size.
+
+Input(s):
+    [cache_dir          - directory to store the cache entries in, if None then the entries are stored in a
+                            .ccscal_cache directory next to each data file (string), optional
+                            default=globals.FIT_CACHE_DIR]
+    [max_size           - maximum total size of the entries in a cache directory (in bytes) (int), optional
+                            default=globals.FIT_CACHE_MAX_SIZE]
+"""
+        self.cacheDir = cache_dir
+        self.maxSize = max_size
+
+    def key(self, data_file_name, mass, mass_window, conditioner=None, estimator=None):
+        """
+FitCache.key
+
+Computes the key of the cache entry for a data file/mass pair
+
+Input(s):
+    data_file_name      - full path to the data file (string)
+    mass                - mass to extract the drift time for (float)
+    mass_window         - window of masses to bin data together for (float)
+    [conditioner        - conditions the data before it is fit (ProfileConditioner), optional default=None]
+    [estimator          - drift time estimator (see GaussFit), None to use globals.GAUSS_ESTIMATOR (string),
+                            optional default=None]
+
+Returns:
+    key                 - key of the cache entry, None if the data file cannot be read (string)
+"""
+        try:
+            fingerprint = fileFingerprint(data_file_name)
+        except OSError:
+            return None
+        settings = {"file": fingerprint,
+                    "mass": float(mass),
+                    "mass_window": float(mass_window),
+                    "conditioning": conditioner.settings() if conditioner is not None else None,
+                    "estimator": estimator if estimator is not None else globals.GAUSS_ESTIMATOR,
+                    "fitting": [globals.N_DTBINS, globals.GAUSS_ROI_WIDTHS, globals.GAUSS_SEED_FRACTION,
+                                globals.MOMENT_MIN_R2, globals.MOMENT_MIN_SNR, globals.LM_MAX_ITER,
+                                globals.LM_FTOL, globals.LM_XTOL],
+                    "dtbin_to_dt": globals.DEFAULT_DTBIN_TO_DT,
+                    "version": globals.FITTER_VERSION}
+        return sha1(dumps(settings, sort_keys=True).encode()).hexdigest()
+
+    def entryPath(self, data_file_name, key):
+        """
+FitCache.entryPath
+
+Determines the path of a cache entry
+
+Input(s):
+    data_file_name      - full path to the data file (string)
+    key                 - key of the cache entry (see FitCache.key) (string)
+
+Returns:
+    entry_path          - path to the cache entry (string)
+"""
+        path = abspath(data_file_name)
+        cache_dir = self.cacheDir if self.cacheDir is not None else join(dirname(path), ".ccscal_cache")
+        return join(cache_dir, splitext(basename(path))[0] + "." + key[:24] + ENTRY_SUFFIX)
+
+    def load(self, data_file_name, key):
+        """
+FitCache.load
+
+Loads a cache entry, if it exists
+
+Input(s):
+    data_file_name      - full path to the data file (string)
+    key                 - key of the cache entry (see FitCache.key) (string)
+
+Returns:
+    entry               - drift time (float), tier (string), R^2 (float or None), and raw and fitted data
+                            (numpy.array), or None if there is no cache entry (tuple)
+"""
+        entry_path = self.entryPath(data_file_name, key)
+        try:
+            with load(entry_path) as entry:
+                if str(entry["key"]) != key:
+                    # shortened keys collided, treat it as a miss
+                    return None
+                r2 = float(entry["r2"])
+                result = (float(entry["drift_time"]), str(entry["tier"]), None if r2 != r2 else r2,
+                          array(entry["rawandfitdata"]))
+            # mark the entry as recently used
+            utime(entry_path)
+            return result
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def store(self, data_file_name, key, drift_time, tier, r2, rawandfitdata):
+        """
+FitCache.store
+
+Writes a cache entry, then evicts the least recently used entries if the entries in the cache directory
+have grown larger than the maximum size. Entries that cannot be written (i.e. in a read-only directory)
+are skipped.
+
+Input(s):
+    data_file_name      - full path to the data file (string)
+    key                 - key of the cache entry (see FitCache.key) (string)
+    drift_time          - extracted drift time (float)
+    tier                - tier of the drift time estimator that produced the drift time (string)
+    r2                  - R^2 of the gaussian fit (float)
+    rawandfitdata       - dtbins, raw intensities, and fitted intensities (see GaussFit.rawandfitdata)
+                            (numpy.array)
+
+Returns:
+    stored              - whether the entry was written (bool)
+"""
+        entry_path = self.entryPath(data_file_name, key)
+        # written under a temporary name first so that other processes never load a partially written entry
+        tmp = entry_path + "." + str(getpid()) + ".tmp"
+        try:
+            makedirs(dirname(entry_path), exist_ok=True)
+            with open(tmp, "wb") as f:
+                savez(f, key=key, drift_time=drift_time, tier=tier, r2=nan if r2 is None else r2,
+                      rawandfitdata=rawandfitdata)
+            replace(tmp, entry_path)
+        except OSError:
+            return False
+        self.evict(dirname(entry_path), keep=entry_path)
+        return True
+
+    def evict(self, cache_dir, keep=None):
+        """
+FitCache.evict
+
+Removes the least recently used entries from a cache directory until the total size of its entries is
+below the maximum size
+
+Input(s):
+    cache_dir           - cache directory to evict entries from (string)
+    [keep               - path to an entry to never evict (string), optional default=None]
+"""
+        entries = []
+        for name in listdir(cache_dir):
+            if name.endswith(ENTRY_SUFFIX):
+                entry_path = join(cache_dir, name)
+                try:
+                    entries.append((stat(entry_path).st_mtime, getsize(entry_path), entry_path))
+                except OSError:
+                    # the entry was removed while the directory was being listed
+                    pass
+        total = sum([size for _, size, _ in entries])
+        for _, size, entry_path in sorted(entries):
+            if total <= self.maxSize:
+                break
+            if entry_path != keep:
+                try:
+                    remove(entry_path)
+                except OSError:
+                    pass
+                total -= size
@@ -2,23 +2,134 @@
     CcsCal/processing/GaussFit.py
     Dylan H. Ross
         description:
-            TODO
+            Determines the drift time of a single extracted dtbin vs. intensity profile (RawData) by fitting it
+            with a gaussian function (see BatchGaussFit), optionally after conditioning it (see
+            ProfileConditioner). Also includes helpers for judging the quality of a fit and for queueing figures
+            of the fits to be rendered in the background.
 """
 
 
 from CcsCal import globals
+from CcsCal.processing.BatchGaussFit import BatchGaussFit, seedParams, stackProfiles
+from CcsCal.processing.FigureRenderer import checkFigurePolicy, getRenderer, renderGaussFitFig
+from CcsCal.processing.ProfileConditioner import ProfileConditioner, describeSettings
 
 
 from os.path import split, splitext
-from numpy import amax, sum, array, exp
-from matplotlib import pyplot as plt
-from scipy.optimize import curve_fit
-from scipy.signal import savgol_filter
+from numpy import array, exp, mean, sum
+
+
+def queueGaussFitFig(data_file_name, mass, rawandfitdata, conditioner=None):
+    """
+GaussFit.queueGaussFitFig
+
+Queues a figure of a gaussian fit to be rendered in the background by the shared
+FigureRenderer. The figure is saved next to the data file as
+<data file name>_mass-<mass>.png
+
+Input(s):
+    data_file_name          - name of the data file the drift time was extracted from (string)
+    mass                    - mass the drift time was extracted for (float)
+    rawandfitdata           - dtbins, raw intensities, and fitted intensities (see
+                                GaussFit.rawandfitdata) (numpy.array)
+    [conditioner            - conditioner the raw data was conditioned with, its conditioning
+                                steps are added to the label of the raw data (ProfileConditioner).
+                                optional, default = None]
+"""
+    steps = describeSettings(None if conditioner is None else conditioner.settings())
+    d_label = "raw data"
+    if steps:
+        d_label += "\n(" + ",\n".join(steps) + ")"
+    title = split(splitext(data_file_name)[0])[1] + "\nmass: " + str(mass)
+    fname = splitext(data_file_name)[0] + "_mass-" + str(int(mass)) + ".png"
+    # copy the data so that it does not change while it is waiting to be rendered
+    getRenderer().submit(renderGaussFitFig, fname, array(rawandfitdata), title, d_label)
+
+
+def conditionProfiles(raw_datas, conditioner):
+    """
+GaussFit.conditionProfiles
+
+Conditions the drift time profiles from a list of RawData objects as a single stack (see
+BatchGaussFit.stackProfiles and ProfileConditioner.condition), so that the conditioning is
+done in one call rather than once for each profile. The RawData objects are not modified.
+
+Input(s):
+    raw_datas               - objects containing the raw data (list(RawData))
+    conditioner             - conditions the data before it is fit, None to leave the profiles
+                                as they are (ProfileConditioner)
+
+Returns:
+    conditioned             - conditioned intensities of each profile, None for all of the
+                                profiles if conditioner is None (list(numpy.array))
+"""
+    if conditioner is None or len(raw_datas) == 0:
+        return [None for _ in raw_datas]
+    _, intensities, weights = stackProfiles(raw_datas)
+    conditioned = conditioner.condition(intensities, weights=weights)
+    return [conditioned[i, :raw_data.dtBinAndIntensity.shape[1]] for i, raw_data in enumerate(raw_datas)]
+
+
+def fitR2(rawandfitdata):
+    """
+GaussFit.fitR2
+
+Computes the coefficient of determination (R^2) of a gaussian fit over the whole profile
+
+Input(s):
+    rawandfitdata           - dtbins, raw intensities, and fitted intensities (see
+                                GaussFit.rawandfitdata) (numpy.array)
+
+Returns:
+    r2                      - R^2 of the fit, None if the raw intensities are constant (float)
+"""
+    ss_tot = sum((rawandfitdata[1] - mean(rawandfitdata[1]))**2)
+    if not ss_tot > 0:
+        return None
+    return float(1. - sum((rawandfitdata[1] - rawandfitdata[2])**2) / ss_tot)
+
+
+def isPoorFit(tier, r2):
+    """
+GaussFit.isPoorFit
+
+Determines whether a drift time comes from a failed or low quality gaussian fit (R^2 below
+globals.FIGURE_MIN_R2)
+
+Input(s):
+    tier                    - tier of the drift time estimator that produced the drift time (string)
+    r2                      - R^2 of the gaussian fit (float)
+
+Returns:
+    poor                    - whether the fit failed or is low quality (bool)
+"""
+    return tier == "failed" or r2 is None or not r2 >= globals.FIGURE_MIN_R2
+
+
+def wantsFigure(policy, tier, r2):
+    """
+GaussFit.wantsFigure
+
+Determines whether a figure should be generated for a gaussian fit under a figure policy
+
+Input(s):
+    policy                  - figure policy, one of FigureRenderer.FIGURE_POLICIES (or True/False,
+                                see FigureRenderer.checkFigurePolicy) (string or bool)
+    tier                    - tier of the drift time estimator that produced the drift time (string)
+    r2                      - R^2 of the gaussian fit (float)
+
+Returns:
+    wanted                  - whether to generate the figure (bool)
+"""
+    policy = checkFigurePolicy(policy)
+    if policy == "failed":
+        return isPoorFit(tier, r2)
+    return policy == "all"
 
 
 class GaussFit:
 
-    def __init__(self, raw_data, smooth=False, gen_fig=True):
+    def __init__(self, raw_data, smooth=False, gen_fig=True, estimator=None, conditioner=None, conditioned=None):
         """
 GaussFit.__init__
 
@@ -28,42 +139,58 @@ function to determine an accurate drift time
 Input(s):
     raw_data    - the object containing the raw data (RawData)
     [smooth     - use Savitsky-Golay filter to remove high frequency variation from the data
-                    optional, default=True]
-    [gen_fig    - whether to generate the gaussian fit figure. optional, default = True]
+                    (with the default ProfileConditioner settings) optional, default=False]
+    [gen_fig    - whether to generate the gaussian fit figure, True/"all", False/"none", or
+                    "failed" to only generate it if the fit failed or is low quality (see
+                    isPoorFit). optional, default = True]
+    [estimator  - drift time estimator, "fit" to always fit the gaussian function or "tiered" to
+                    use closed form moment estimates when they are good enough (see BatchGaussFit),
+                    None to use globals.GAUSS_ESTIMATOR. optional, default = None]
+    [conditioner - conditions the data before it is fit (smoothing, baseline subtraction,
+                    normalization), overrides smooth (ProfileConditioner). optional, default = None]
+    [conditioned - intensities that have already been conditioned with conditioner (i.e. for a
+                    whole stack of profiles at once with conditionProfiles), so they are not
+                    conditioned again (numpy.array). optional, default = None]
 """
-        # generate the initial parameters
-        self.initparams = (amax(raw_data.dtBinAndIntensity[1]),
-                           sum(raw_data.dtBinAndIntensity[0] *
-                                raw_data.dtBinAndIntensity[1]) /
-                                sum(raw_data.dtBinAndIntensity[1]),
-                           globals.INIT_GAUSS_SIGMA)
-        # set fit failed flag
-        fitFailed = False
+        # condition the raw data (i.e. Savitsky-Golay smoothing) before it is fit, the RawData
+        # object itself is left as it is
+        if conditioner is None and smooth:
+            conditioner = ProfileConditioner()
+        self.conditioner = conditioner
+        self.dtbins = raw_data.dtBinAndIntensity[0]
+        if conditioned is not None:
+            self.intensities = array(conditioned, dtype=float)
+        elif conditioner is not None:
+            self.intensities = conditioner.condition(raw_data.dtBinAndIntensity[1])
+        else:
+            self.intensities = array(raw_data.dtBinAndIntensity[1], dtype=float)
+        # generate the initial parameters, estimated in closed form from the points around the apex
+        self.initparams = tuple(seedParams(self.dtbins[None, :], self.intensities[None, :])[0])
+        # set fit failed flag, doFit sets it if the fit does not converge
+        self.fit_failed = False
+        # which tier produced the drift time ("moment", "fit", or "failed"), set by doFit
+        self.estimator = estimator
+        self.tier = None
         # make internal copies of the specified mass and data filename
         self.mass = raw_data.specifiedMass
         self.filename = raw_data.ppFileName
-        # fit the distribution on raw_data
-        # perform smoothing of raw data using Savitsky-Golay filter
-        self.smooth = smooth
-        if self.smooth:
-            raw_data.dtBinAndIntensity[1] = savgol_filter(raw_data.dtBinAndIntensity[1],
-                                                            globals.SG_SMOOTH_WINDOW,
-                                                            globals.SG_SMOOTH_ORDER)
         # fit the data
         self.doFit(raw_data)
-        if not fitFailed:
+        if not self.fit_failed:
             self.opt_mean = self.optparams[1]
         # create an array with the raw dtbin and intensity values
         # and fitted intensity values
-        self.rawandfitdata = array([raw_data.dtBinAndIntensity[0],
-                                            raw_data.dtBinAndIntensity[1],
-                                            raw_data.dtBinAndIntensity[1]])
-        self.rawandfitdata[2] = self.gaussFunc(raw_data.dtBinAndIntensity[0],
+        self.rawandfitdata = array([self.dtbins,
+                                    self.intensities,
+                                    self.intensities])
+        self.rawandfitdata[2] = self.gaussFunc(self.dtbins,
                                                 self.optparams[0],
                                                 self.optparams[1],
                                                 self.optparams[2])
+        # R^2 of the gaussian fit over the whole profile
+        self.r2 = fitR2(self.rawandfitdata)
         # generate a figure of the gaussian fit if requested
-        if gen_fig:
+        if wantsFigure(gen_fig, self.tier, self.r2):
             self.saveGaussFitFig(self.filename, raw_data)
 
     def gaussFunc(self,x, A, mu, sigma):
@@ -87,69 +214,51 @@ Returns:
         """
 GaussFit.doFit
 
-Fits dt histogram with Gaussian function using curve_fit from scipy.optimize. A
-try/except clause is used to catch an exception that arises when a sufficiently
-good fit is not reached within a maximum number of optimization steps,
-specifically within 1000 steps. Stores the optimized mu parameter for easy
-reference by other objects:
+Fits dt histogram with Gaussian function using the vectorized Levenberg-Marquardt
+fitting in BatchGaussFit (with a stack of just this one profile). If the fit does
+not converge within a maximum number of iterations (globals.LM_MAX_ITER) the
+initial parameters are used instead, GaussFit.fit_failed is set, and GaussFit.covar
+is None. Only the points within a region of interest
+around the peak (globals.GAUSS_ROI_WIDTHS initial sigmas on either side of the
+initial mu) are fit, but GaussFit.rawandfitdata and the figure still cover the whole
+profile. With the "tiered" estimator the fit is skipped entirely if the closed form
+moment estimates are good enough. Stores the optimized mu parameter and the tier that
+produced it for easy reference by other objects:
     GaussFit.opt_mean       - optimized mean dtbin (float)
+    GaussFit.tier           - "moment", "fit", or "failed" (string)
 
 Input(s):
     raw_data                - object containing the dt distribution to be fit with
                                 Gaussian function (GetData)
 """
-        try:
-            self.optparams,self.covar = curve_fit(self.gaussFunc,
-                                                    raw_data.dtBinAndIntensity[0],
-                                                    raw_data.dtBinAndIntensity[1],
-                                                    p0=self.initparams,
-                                                    maxfev=globals.CURVE_FIT_MAXFEV)
-        except RuntimeError:
+        fit = BatchGaussFit(self.dtbins,
+                            self.intensities[None, :],
+                            init_params=[self.initparams],
+                            estimator=self.estimator)
+        self.tier = str(fit.tiers[0])
+        if fit.converged[0]:
+            self.optparams, self.covar = fit.optParams[0], fit.covars[0]
+        else:
             # if fit was not achieved..
             self.fit_failed = True
             self.opt_mean = self.initparams[1]
             self.optparams = self.initparams
+            self.covar = None
             print("failed to fit gaussian for mass", self.mass, "in", self.filename)
 
     def saveGaussFitFig(self, figure_file_name, raw_data):
         """
 GaussFit.saveGaussFitFig
 
-Outputs a Figure showing the CCS calibration curve fitted to the CCS
-calibration data
+Queues a Figure showing the raw data and the fitted gaussian function to be
+rendered in the background by the shared FigureRenderer
 
 Input(s):
     figure_file_name        - choose a filename to save the figure under (string)
     raw_data                - object containing the dt distribution to be fit with
                                 Gaussian function (RawData)
 """
-        if self.smooth:
-            d_label = "raw data\n(smoothed)"
-        else:
-            d_label = "raw data"
-        plt.plot(self.rawandfitdata[0],
-                self.rawandfitdata[1],
-                color='blue',
-                ls='--',
-                marker='o',
-                ms=5,
-                mec='blue',
-                mfc='blue',
-                label=d_label)
-        plt.plot(self.rawandfitdata[0],
-                self.rawandfitdata[2],
-                color='black',
-                ls='-',
-                label="gaussian fit")
-        plt.legend(loc="best")
-        plt.ticklabel_format(style='sci', axis='y', scilimits=(0, 0))
-        plt.xlabel("dt bin")
-        plt.ylabel("intensity")
-        title = split(splitext(figure_file_name)[0])[1] + "\nmass: " + str(self.mass)
-        plt.title(title)
-        fname = splitext(figure_file_name)[0] + "_mass-" + str(int(self.mass)) + ".png"
-        plt.savefig(fname, bbox_inches='tight', dpi=500)
-        plt.close()
+        queueGaussFitFig(figure_file_name, self.mass, self.rawandfitdata, conditioner=self.conditioner)
 
     def getDriftTime(self, dtbin_to_dt=globals.DEFAULT_DTBIN_TO_DT):
         """
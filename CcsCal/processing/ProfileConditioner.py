@@ -0,0 +1,134 @@
+"""
+    CcsCal/processing/ProfileConditioner.py
+    Dylan H. Ross
+        description:
+            Conditions stacks of drift time profiles before they are fit: Savitsky-Golay smoothing (with the
+            window and polynomial order from the input file), baseline subtraction, and normalization. Every
+            step operates on the whole 2D stack at once (along the dtbin axis), rather than on one profile at a
+            time.
+"""
+
+
+from CcsCal import globals
+
+
+from numpy import arange, array, full, nan, nanmax, nanpercentile, sum, unique, where
+from scipy.signal import savgol_filter
+
+
+def describeSettings(settings, detailed=False):
+    """
+ProfileConditioner.describeSettings
+
+Describes the conditioning steps that a set of conditioning settings (see ProfileConditioner.settings) applies
+to the drift time profiles (i.e. for figure labels and the report)
+
+Input(s):
+    settings            - conditioning settings from ProfileConditioner.settings, None for no conditioning (list)
+    [detailed           - whether to include the parameters of each step (bool), optional default=False]
+
+Returns:
+    steps               - descriptions of the conditioning steps, empty if the profiles are not conditioned
+                            (list(string))
+"""
+    if settings is None:
+        return []
+    window, order, baseline_percentile, normalize = settings
+    steps = []
+    if window > 0:
+        steps.append("smoothed" + (" (Savitsky-Golay window {}, order {})".format(window, order) if detailed else ""))
+    if baseline_percentile is not None:
+        steps.append("baseline subtracted" +
+                     (" (percentile {:g} of the intensities)".format(baseline_percentile) if detailed else ""))
+    if normalize:
+        steps.append("normalized")
+    return steps
+
+
+class ProfileConditioner:
+
+    def __init__(self, window=globals.SG_SMOOTH_WINDOW, order=globals.SG_SMOOTH_ORDER,
+                 baseline=globals.CONDITION_BASELINE, normalize=globals.CONDITION_NORMALIZE):
+        """
+ProfileConditioner.__init__
+
+Initializes a new ProfileConditioner object with the settings for conditioning drift time profiles
+
+Input(s):
+    [window             - Savitsky-Golay filter window (sgw in the input file), 0 for no smoothing (int),
+                            optional default=globals.SG_SMOOTH_WINDOW]
+    [order              - Savitsky-Golay filter polynomial order (sgp in the input file) (int), optional
+                            default=globals.SG_SMOOTH_ORDER]
+    [baseline           - whether to subtract a baseline (globals.CONDITION_BASELINE_PERCENTILE percentile of
+                            the intensities) from each profile (bool), optional
+                            default=globals.CONDITION_BASELINE]
+    [normalize          - whether to normalize each profile to a maximum intensity of 1 (bool), optional
+                            default=globals.CONDITION_NORMALIZE]
+"""
+        if window > 0 and order >= window:
+            raise ValueError("ProfileConditioner: __init__: Savitsky-Golay polynomial order ({}) ".format(order) +
+                             "must be less than the window ({})".format(window))
+        self.window = int(window)
+        self.order = int(order)
+        self.baseline = baseline
+        self.normalize = normalize
+
+    def settings(self):
+        """
+ProfileConditioner.settings
+
+Describes the conditioning settings (i.e. for the FitCache keys)
+
+Input(s):
+    none
+
+Returns:
+    settings            - window, order, baseline percentile (or None), and normalize (list)
+"""
+        return [self.window, self.order, globals.CONDITION_BASELINE_PERCENTILE if self.baseline else None,
+                self.normalize]
+
+    def condition(self, intensities, weights=None):
+        """
+ProfileConditioner.condition
+
+Conditions a stack of drift time profiles. Profiles in a stack with padding (see BatchGaussFit.stackProfiles)
+are grouped by their number of dtbins and each group is smoothed in a single call so that the padding does
+not leak into the ends of the profiles. Profiles with fewer dtbins than the filter window are not smoothed.
+
+Input(s):
+    intensities         - intensities with shape (n_rows, n_dtbins), or (n_dtbins,) for a single profile
+                            (numpy.array)
+    [weights            - weight of each point with shape (n_rows, n_dtbins), 0 for padding at the end of a
+                            profile (numpy.array), optional default=None]
+
+Returns:
+    conditioned         - conditioned intensities with the same shape as intensities, padding is left as it
+                            is (numpy.array)
+"""
+        intensities = array(intensities, dtype=float)
+        shape = intensities.shape
+        conditioned = intensities.reshape(-1, shape[-1]).copy()
+        if weights is None:
+            lengths = full(conditioned.shape[0], shape[-1])
+        else:
+            lengths = sum(array(weights).reshape(conditioned.shape) > 0, axis=1)
+        if self.window > 0:
+            for length in unique(lengths):
+                if length < self.window:
+                    continue
+                rows = where(lengths == length)[0]
+                conditioned[rows, :length] = savgol_filter(conditioned[rows, :length], self.window, self.order,
+                                                           axis=-1)
+        if self.baseline or self.normalize:
+            # the padding is ignored when computing the baseline and maximum of each profile
+            rows = where(lengths > 0)[0]
+            padded = arange(shape[-1])[None, :] >= lengths[rows, None]
+            valid = where(padded, nan, conditioned[rows])
+            if self.baseline:
+                valid -= nanpercentile(valid, globals.CONDITION_BASELINE_PERCENTILE, axis=1)[:, None]
+            if self.normalize:
+                apex = nanmax(valid, axis=1)[:, None]
+                valid = where(apex > 0, valid / where(apex > 0, apex, 1.), valid)
+            conditioned[rows] = where(padded, conditioned[rows], valid)
+        return conditioned.reshape(shape)
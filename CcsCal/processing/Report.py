@@ -6,13 +6,16 @@
 """
 
 
+from CcsCal.processing.ProfileConditioner import describeSettings
+
+
 import time
 import os
 
 
 class Report():
 
-    def __init__ (self, report_file_name):
+    def __init__ (self, report_file_name, conditioner=None):
         """
 Report.__init__
 
@@ -21,41 +24,52 @@ calibration and analyte drift times and CCS values
 
 Input(s):
     report_file_name    - path to the report file to generate (str)
+    [optional] conditioner  - conditioner the drift time profiles are conditioned with, None if
+                                they are not conditioned (ProfileConditioner)
 """
         self.report_file_name = report_file_name
         self.report_file = open(self.report_file_name, "w")
-        self.writeHeader()
+        self.writeHeader(conditioner=conditioner)
 
 
-    def writeHeader(self):
+    def writeHeader(self, conditioner=None):
         """
 Report.writeHeader
 
-Writes a header for report file with the name of the report file and the date it
-was generated
+Writes a header for report file with the name of the report file, the date it
+was generated, and how the drift time profiles were conditioned before they were fit
 
 Input(s):
-    none
+    [optional] conditioner  - conditioner the drift time profiles are conditioned with, None if
+                                they are not conditioned (ProfileConditioner)
 """
         self.wLn(os.path.split(os.path.splitext(self.report_file_name)[0])[1])
         self.wLn("Generated by CcsCal on " + time.strftime("%c"))
+        steps = describeSettings(None if conditioner is None else conditioner.settings(), detailed=True)
+        self.wLn("Drift time profile conditioning: " + (", ".join(steps) if steps else "none"))
         self.wLn("====================================================")
         self.wLn()
         self.wLn()
 
 
-    def writeCalibrationReport(self, ccs_calibration_object):
+    def writeCalibrationReport(self, ccs_calibration_object, bootstrap=None, sweep=None):
         """
 Report.writeCalibrationReport
 
 Writes a full report on how the CCS calibration went. This includes:
     - A table of m/z values and their extracted drift times
     - The fit parameters for the CCS calibration curve
+    - Confidence intervals of the fit parameters and calibrant CCS (if provided)
+    - The residual CCS of the calibrants for a sweep of EDC parameters (if provided)
 
 Input(s):
     ccs_calibration_object      - The CcsCalibration object containing all of the
                                     relevant information about the calibration
                                     (CcsCalibration)
+    [optional] bootstrap        - confidence intervals from resampling the calibrants
+                                    (CalibrationBootstrap)
+    [optional] sweep            - residual statistics for a grid of EDC parameters
+                                    (CalibrationSweep)
 """
         self.wLn("+-----------------+")
         self.wLn("| CCS CALIBRATION |")
@@ -63,48 +77,121 @@ Input(s):
         self.wLn()
         self.wLn("CCS calibrants extracted drift times:")
         self.writeDriftTimeTable(ccs_calibration_object.calMasses,\
-                                 ccs_calibration_object.calDriftTimes)
+                                 ccs_calibration_object.calDriftTimes,\
+                                 getattr(ccs_calibration_object, "calTiers", None))
         self.wLn()
         self.wLn("Optimized calibration curve fit parameters:")
         self.wLn("\tcorrected ccs = A * ((corrected drift time) + t0) ** B")
         self.wLn("\t\tA = " + str(ccs_calibration_object.optparams[0]))
         self.wLn("\t\tt0 = " + str(ccs_calibration_object.optparams[1]))
         self.wLn("\t\tB = " + str(ccs_calibration_object.optparams[2]))
+        self.wLn("\tEDC = " + str(ccs_calibration_object.edc))
         self.wLn()
+        if sweep is not None:
+            self.writeEdcSweep(sweep)
+        if bootstrap is not None:
+            self.writeParameterIntervals(bootstrap)
 
         self.wLn("Calibrant CCS, calculated vs. literature:")
         self.writeCcsComparisonTable(ccs_calibration_object.calMasses,\
                                      ccs_calibration_object.calLitCcs,\
-                                     ccs_calibration_object.calCalcCcs)
+                                     ccs_calibration_object.calCalcCcs,
+                                     None if bootstrap is None else bootstrap.calCcsIntervals)
         self.wLn()
 
 
-    def writeDriftTimeTable(self, masses, drift_times):
+    def writeDriftTimeTable(self, masses, drift_times, tiers=None):
         """
 Report.writeDriftTimeTable
 
-Writes a table of m/z values and their drift times separated by tabs with
-the following format:
+Writes a table of m/z values and their drift times (and which tier of the drift time
+estimator produced each, if provided) separated by tabs with the following format:
 
-    m/z         drift time (ms)
-    ---------------------------
-    mz 1        dt 1
-    mz 2        dt 2
-    ...             ...
+    m/z         drift time (ms)     tier
+    ------------------------------------
+    mz 1        dt 1                tier 1
+    mz 2        dt 2                tier 2
+    ...             ...             ...
 
 Input(s):
     masses                      - m/z values (list)
     drift_times                 - drift time values (list)
+    [optional] tiers            - drift time estimator tiers (list)
 """
-        self.wLn("m/z\t\tdrift time (ms)")
-        self.wLn("---------------------------")
+        if tiers is None:
+            self.wLn("m/z\t\tdrift time (ms)")
+            self.wLn("---------------------------")
+        else:
+            self.wLn("m/z\t\tdrift time (ms)     tier")
+            self.wLn("------------------------------------")
         for n in range (len(masses)):
             #outstr = str(round(masses[n], 3)) + "\t\t" + str(round(drift_times[n], 3))
-            self.wLn("{: 10.4f}    {: 5.2f}".format(masses[n], drift_times[n]))
+            if tiers is None:
+                self.wLn("{: 10.4f}    {: 5.2f}".format(masses[n], drift_times[n]))
+            else:
+                self.wLn("{: 10.4f}    {: 5.2f}               {:s}".format(masses[n], drift_times[n], tiers[n]))
+        self.wLn()
+
+
+    def writeParameterIntervals(self, bootstrap):
+        """
+Report.writeParameterIntervals
+
+Writes the confidence intervals of the calibration curve fit parameters from resampling
+the calibrants with the following format:
+
+    Calibration curve fit parameter 95% intervals (bootstrap, 2000 of 2000 resamples):
+            A = [lower, upper]
+            t0 = [lower, upper]
+            B = [lower, upper]
+
+Input(s):
+    bootstrap                   - confidence intervals from resampling the calibrants
+                                    (CalibrationBootstrap)
+"""
+        self.wLn("Calibration curve fit parameter {:g}% intervals ({:s}, {:d} of {:d} resamples):".format(
+                    100. * bootstrap.confidence, bootstrap.method, bootstrap.nUsed, bootstrap.params.shape[0]))
+        for name, (lower, upper) in zip(["A", "t0", "B"], bootstrap.paramIntervals):
+            self.wLn("\t\t" + name + " = [" + str(lower) + ", " + str(upper) + "]")
+        self.wLn()
+
+
+    def writeEdcSweep(self, sweep):
+        """
+Report.writeEdcSweep
+
+Writes a table of the residual ccs of the calibrants for each EDC parameter in a sweep
+(using the best seed for each EDC parameter), with the best setting marked by a *, in
+the following format:
+
+    EDC parameter sweep (best by rms residual ccs):
+    EDC         rms resid (%)       mean |resid| (%)    max |resid| (%)
+    -------------------------------------------------------------------
+    edc 1       rms 1               mean 1              max 1
+    edc 2       rms 2               mean 2              max 2           *
+    ...         ...                 ...                 ...
+
+Input(s):
+    sweep                       - fitted parameters and residual statistics for a grid
+                                    of EDC parameters (CalibrationSweep)
+"""
+        self.wLn("EDC parameter sweep (best by " + sweep.criterion + " residual ccs):")
+        self.wLn("EDC         rms resid (%)       mean |resid| (%)    max |resid| (%)")
+        self.wLn("-------------------------------------------------------------------")
+        for n, seed in enumerate(sweep.bestSeeds()):
+            if seed < 0:
+                self.wLn("{: 6.4f}      fit failed".format(sweep.edcs[n]))
+                continue
+            line = "{: 6.4f}      {: 8.4f}            {: 8.4f}            {: 8.4f}".format(
+                        sweep.edcs[n], sweep.rmsResidual[n][seed], sweep.meanResidual[n][seed],
+                        sweep.maxResidual[n][seed])
+            if sweep.bestIndex is not None and sweep.bestIndex == (n, seed):
+                line += "        *"
+            self.wLn(line)
         self.wLn()
 
 
-    def writeCcsComparisonTable(self, masses, literature_ccs, calculated_ccs):
+    def writeCcsComparisonTable(self, masses, literature_ccs, calculated_ccs, ccs_intervals=None):
         """
 Report.writeCcsComparisonTable
 
@@ -121,64 +208,113 @@ Input(s):
     masses                      - m/z values (list)
     literature_ccs              - ccs literature values (list)
     calculated_ccs              - calculated ccs values (list)
+    [optional] ccs_intervals    - lower and upper bounds of the confidence intervals of
+                                    the calculated ccs values, adds a column (list)
 """
-        self.wLn("m/z        lit ccs (Ang^2)     calc ccs (Ang^2)      residual ccs (Ang^2, %)")
-        self.wLn("----------------------------------------------------------------------------")
+        if ccs_intervals is None:
+            self.wLn("m/z        lit ccs (Ang^2)     calc ccs (Ang^2)      residual ccs (Ang^2, %)")
+            self.wLn("----------------------------------------------------------------------------")
+        else:
+            self.wLn("m/z        lit ccs (Ang^2)     calc ccs (Ang^2)      residual ccs (Ang^2, %)     " +
+                     "calc ccs interval (Ang^2)")
+            self.wLn("----------------------------------------------------------------------------" +
+                     "-----------------------------")
         for n in range (len(masses)):
-            self.wLn("{: 10.4f}   {: 6.3f}             {: 6.3f}             {: 6.3f}    {: 6.3f}".format(\
+            line = "{: 10.4f}   {: 6.3f}             {: 6.3f}             {: 6.3f}    {: 6.3f}".format(\
                         masses[n], \
                         literature_ccs[n], \
                         calculated_ccs[n], \
                         (literature_ccs[n] - calculated_ccs[n]), \
-                        (100.0 *(literature_ccs[n] - calculated_ccs[n]) / (literature_ccs[n]))))
+                        (100.0 *(literature_ccs[n] - calculated_ccs[n]) / (literature_ccs[n])))
+            if ccs_intervals is not None:
+                line += "      [{:.3f}, {:.3f}]".format(ccs_intervals[n][0], ccs_intervals[n][1])
+            self.wLn(line)
         self.wLn()
 
 
-    def writeCompoundDataTableHeader(self):
+    def writeCompoundDataTableHeader(self, intervals=False):
         """
 Report.writeCompoundDataTableHeader
 
 Writes the header for a table displaying the extracted drift time and calibrated
-CCS for the datafile/mass pairs with the following format:
+CCS for the datafile/mass pairs (and which tier of the drift time estimator produced
+each drift time, marked with "(cached)" if it was loaded from the FitCache) with the
+following format:
 
-    data file name      m/z     drift time (ms)     ccs (Ang^2)
-    -----------------------------------------------------------
-    data_file_1.txt     mz 1        dt 1            ccs 1
-    data_file_1.txt     mz 1        dt 1            ccs 1
-    ...                 ...         ...             ...
+    data file name      m/z     drift time (ms)     ccs (Ang^2)     tier
+    --------------------------------------------------------------------
+    data_file_1.txt     mz 1        dt 1            ccs 1           tier 1
+    data_file_1.txt     mz 1        dt 1            ccs 1           tier 1
+    ...                 ...         ...             ...             ...
 
 Input(s):
-    none
+    [optional] intervals        - add a column for the confidence intervals of the ccs
+                                    values (bool)
 """
         self.wLn("+---------------+")
         self.wLn("| COMPOUND DATA |")
         self.wLn("+---------------+")
         self.wLn()
         self.wLn("Compounds extracted drift times and calibrated CCS:")
-        self.wLn("data file name                     m/z       drift time (ms)     ccs (Ang^2)")
-        self.wLn("----------------------------------------------------------------------------")
+        if intervals:
+            self.wLn("data file name                     m/z       drift time (ms)     ccs (Ang^2)     tier" +
+                     "            ccs interval (Ang^2)")
+            self.wLn("-----------------------------------------------------------------------------------------" +
+                     "--------------------------------")
+        else:
+            self.wLn("data file name                     m/z       drift time (ms)     ccs (Ang^2)     tier")
+            self.wLn("-----------------------------------------------------------------------------------------")
 
 
-    def writeCompoundDataTableLine(self, data_file_name, mz, dt, ccs):
+    def writeCompoundDataTableLine(self, data_file_name, mz, dt, ccs, tier=None, cached=False, ccs_interval=None):
         """
 Report.writeCompoundDataTableLine
 
 Writes a single line for a table displaying the extracted drift time and calibrated
 CCS for the datafile/mass pairs with the following format:
 
-    data file name      m/z     drift time (ms)     ccs (Ang^2)
-    -----------------------------------------------------------
-    data_file_1.txt     mz 1        dt 1            ccs 1
-    data_file_1.txt     mz 1        dt 1            ccs 1
-    ...                 ...         ...             ...
+    data file name      m/z     drift time (ms)     ccs (Ang^2)     tier
+    --------------------------------------------------------------------
+    data_file_1.txt     mz 1        dt 1            ccs 1           tier 1
+    data_file_1.txt     mz 1        dt 1            ccs 1           tier 1
+    ...                 ...         ...             ...             ...
 
 Input(s):
     data_file_name              - name of the data file (string)
     mz                          - mass to charge of compound (float)
     dt                          - extracted drift time of the compound (float)
     ccs                         - calculated ccs value (float)
+    [optional] tier             - tier of the drift time estimator that produced the
+                                    drift time ("moment", "fit", or "failed") (string)
+    [optional] cached           - whether the drift time was loaded from the FitCache (bool)
+    [optional] ccs_interval     - lower and upper bounds of the confidence interval of
+                                    the ccs value (tuple(float, float))
+"""
+        tier = (tier if tier else "-") + (" (cached)" if cached else "")
+        if ccs_interval is not None:
+            tier = "{:15s} [{:.3f}, {:.3f}]".format(tier, ccs_interval[0], ccs_interval[1])
+        self.wLn("{:32s} {: 9.4f}      {: 6.3f}         {: 6.3f}        {:s}".format(data_file_name, mz, dt, ccs,
+                                                                                     tier))
+
+
+    def writeCompoundDataTableErrorLine(self, data_file_name, mz, error):
+        """
+Report.writeCompoundDataTableErrorLine
+
+Writes a single line for a table displaying the extracted drift time and calibrated
+CCS for the datafile/mass pairs, for a pair where the drift time could not be
+extracted, in place of the drift time and ccs:
+
+    data file name      m/z     drift time (ms)     ccs (Ang^2)     tier
+    --------------------------------------------------------------------
+    data_file_1.txt     mz 1    FAILED: error
+
+Input(s):
+    data_file_name              - name of the data file (string)
+    mz                          - mass to charge of compound (float)
+    error                       - description of the error (string)
 """
-        self.wLn("{:32s} {: 9.4f}      {: 6.3f}         {: 6.3f}".format(data_file_name, mz, dt, ccs))
+        self.wLn("{:32s} {: 9.4f}      FAILED: {:s}".format(data_file_name, mz, error))
 
 
     def wLn(self, *args):
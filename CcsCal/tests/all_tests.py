@@ -7,6 +7,9 @@
 
 
 from CcsCal.tests import (input_parsing,
+                          raw_data,
+                          batch_processing,
+                          gauss_fitting,
                           external_data,
                           ccscal_main)
 
@@ -41,5 +44,8 @@ all_tests.run
         no
 """
     run_subtest(input_parsing, "ParseInputFile")
+    run_subtest(raw_data, "RawData drift time data extraction")
+    run_subtest(gauss_fitting, "GaussFit and BatchGaussFit gaussian fitting")
+    run_subtest(batch_processing, "BatchProcessor drift time extraction")
     run_subtest(ccscal_main, "CcsCal main execution")
     run_subtest(external_data, "CcsCalibrationExt with an external data source")
@@ -0,0 +1,141 @@
+"""
+    Tests for extracting drift times for batches of data file/mass pairs (BatchProcessor) using the synthetic raw
+    data file from the raw_data tests
+
+    2018/03/21
+    Dylan H. Ross
+"""
+
+
+from CcsCal.processing.BatchProcessor import BatchProcessor
+from CcsCal.processing.FitCache import FitCache
+from CcsCal.tests.raw_data import (make_synthetic_data, SYNTH_DATA_PATH, SYNTH_INDEX_PATH, SYNTH_MASSES, MASS_WINDOW,
+                                   TEST_PATH, CACHE_DIR, DEFAULT_CACHE_DIR)
+
+
+from os import remove, stat, utime
+from os.path import isfile, isdir, split
+from shutil import rmtree
+from numpy import zeros
+
+
+# the synthetic data file name (without the directory)
+SYNTH_DATA_FILE = split(SYNTH_DATA_PATH)[1]
+
+
+def test_ordered_results(jobs):
+    """
+batch_processing.test_ordered_results
+    description:
+        processes the synthetic masses (plus a data file that does not exist) and checks that the results come back
+        in the same order as the input, with the expected drift times, and that the missing data file only causes
+        an error for its own result
+    parameters:
+        jobs (int) -- number of worker processes
+    returns:
+        passed (bool) - test passed
+"""
+    data_files = [SYNTH_DATA_FILE] * len(SYNTH_MASSES)
+    masses = list(SYNTH_MASSES)
+    data_files.insert(2, "IM_does_not_exist.txt")
+    masses.insert(2, 500.)
+    batch = BatchProcessor(data_files, TEST_PATH, masses, MASS_WINDOW, jobs=jobs, gen_fig=False,
+                           cache=False)
+    results = list(batch.results())
+    if [(r.dataFileName, r.mass) for r in results] != list(zip(data_files, masses)):
+        print("\t\tError: results are not in the same order as the input")
+        return False
+    for result in results:
+        if result.dataFileName == "IM_does_not_exist.txt":
+            if result.error is None:
+                print("\t\tError: no error for a data file that does not exist")
+                return False
+        elif result.error is not None:
+            print("\t\tError: unexpected error for mass {:.4f}:".format(result.mass), result.error)
+            return False
+        elif result.tier != "fit":
+            print("\t\tError: unexpected drift time estimator tier for mass {:.4f}:".format(result.mass), result.tier)
+            return False
+        elif abs(result.driftTime / 0.11 - (20. + result.mass / 10.)) > 0.5:
+            print("\t\tError: unexpected drift time for mass {:.4f}".format(result.mass))
+            return False
+    return True
+
+
+def test_fit_cache():
+    """
+batch_processing.test_fit_cache
+    description:
+        processes the synthetic masses twice with the FitCache and checks that the second time all of the results
+        are loaded from the cache with the same drift times, that the entries are not used once the data file has
+        changed (a different modification time), and that the least recently used entries are evicted when the
+        cache grows too large
+    parameters:
+        no
+    returns:
+        passed (bool) - test passed
+"""
+    data_files = [SYNTH_DATA_FILE] * len(SYNTH_MASSES)
+    first = list(BatchProcessor(data_files, TEST_PATH, SYNTH_MASSES, MASS_WINDOW, jobs=1, gen_fig=False).results())
+    second = list(BatchProcessor(data_files, TEST_PATH, SYNTH_MASSES, MASS_WINDOW, jobs=2, gen_fig=False).results())
+    if any([r.cached for r in first]) or not all([r.cached for r in second]):
+        print("\t\tError: results were not loaded from the cache as expected")
+        return False
+    if [r.driftTime for r in first] != [r.driftTime for r in second] or \
+            [r.tier for r in first] != [r.tier for r in second]:
+        print("\t\tError: cached results do not match the original results")
+        return False
+    st = stat(SYNTH_DATA_PATH)
+    utime(SYNTH_DATA_PATH, (st.st_atime, st.st_mtime + 10.))
+    third = list(BatchProcessor(data_files, TEST_PATH, SYNTH_MASSES, MASS_WINDOW, jobs=1, gen_fig=False).results())
+    if any([r.cached for r in third]):
+        print("\t\tError: cached results were used after the data file changed")
+        return False
+    # a cache that only has room for two entries
+    fit_cache = FitCache(cache_dir=CACHE_DIR, max_size=15000)
+    keys = [fit_cache.key(SYNTH_DATA_PATH, mass, MASS_WINDOW) for mass in SYNTH_MASSES[:3]]
+    for i, key in enumerate(keys):
+        fit_cache.store(SYNTH_DATA_PATH, key, 1., "fit", 0.99, zeros((3, 200)))
+        entry_path = fit_cache.entryPath(SYNTH_DATA_PATH, key)
+        # make sure the entries are used in order (even with a coarse file system timestamp resolution)
+        utime(entry_path, (1000000000 + i, 1000000000 + i))
+    if [fit_cache.load(SYNTH_DATA_PATH, key) is not None for key in keys] != [False, True, True]:
+        print("\t\tError: FitCache did not evict the least recently used entry")
+        return False
+    return True
+
+
+# *the primary method for running all of the tests*
+def run():
+    """
+batch_processing.run
+    description:
+        runs all of the (currently implemented) individual tests
+    parameters:
+        no
+    returns:
+        passed_all (bool) - all tests passed
+"""
+    make_synthetic_data()
+    try:
+        print("\t(1 of 3) processing a batch in a single process...")
+        assert test_ordered_results(1)
+        print("\t...PASS")
+
+        print("\t(2 of 3) processing a batch with multiple worker processes...")
+        assert test_ordered_results(2)
+        print("\t...PASS")
+
+        print("\t(3 of 3) loading results from the fit cache...")
+        assert test_fit_cache()
+        print("\t...PASS")
+    finally:
+        for path in [SYNTH_DATA_PATH, SYNTH_INDEX_PATH]:
+            if isfile(path):
+                remove(path)
+        for cache_dir in [CACHE_DIR, DEFAULT_CACHE_DIR]:
+            if isdir(cache_dir):
+                rmtree(cache_dir)
+
+    # if everything passed return True for success
+    return True
@@ -7,11 +7,18 @@
 """
 
 
-from CcsCal.processing.CcsCalibration import CcsCalibrationExt
+from CcsCal.processing.CcsCalibration import CcsCalibrationExt, calibrationSettings, loadCalibration
+from CcsCal.processing.CalibrationBootstrap import CalibrationBootstrap
+from CcsCal.processing.BatchCalCurveFit import seedCalCurve
+from CcsCal.processing.CalibrationRegistry import CalibrationRegistry
+from CcsCal.processing.ExternalConversion import calibrateFromCsv, convertFeatureCsv
+from CcsCal.processing.FigureRenderer import getRenderer
 
 
-from numpy import genfromtxt, abs, mean
+from numpy import genfromtxt, abs, mean, array, sqrt, dot, zeros, isfinite, all, any, allclose, nanmin
 from os import remove
+from datetime import datetime, timedelta
+from scipy.optimize import curve_fit
 from os.path import isfile
 
 
@@ -148,6 +155,9 @@ external_data.test_cal_curve_figure
     # initialize the CcsCalibrationExt object
     cce = CcsCalibrationExt(*ext_data)
     cce.saveCalCurveFig(figure_file_name="CcsCal/tests/files/test_cal_curve_figure.png")
+    # the figure is rendered in the background, wait for it to be written
+    for error in getRenderer().drain():
+        print("\t\tError:", error)
     # if no errors, check that the image exists then delete it and return True
     if isfile("CcsCal/tests/files/test_cal_curve_figure.png"):
         remove("CcsCal/tests/files/test_cal_curve_figure.png")
@@ -158,6 +168,329 @@ external_data.test_cal_curve_figure
         return False
 
 
+def test_bulk_cal_ccs():
+    """
+external_data.test_bulk_cal_ccs
+    description:
+        initialize the object normally, then tests that getting calibrated CCS for all of the test compounds at
+        once with getCalibratedCcsBulk matches getCalibratedCcs, and that the propagated uncertainties match
+        propagating the covariance of the fitted parameters through a finite difference gradient one compound
+        at a time
+    parameters:
+        no
+    returns:
+        passed (bool) - test passed
+"""
+    # load the external dataset
+    ext_data = genfromtxt(EXTDATA1_PATH, delimiter=",", unpack=True)
+    # initialize the CcsCalibrationExt object
+    cce = CcsCalibrationExt(*ext_data)
+    # load the compound dataset
+    cmpd_data = genfromtxt(EXTDATA2_PATH, delimiter=",", unpack=True)
+    ccs, ccs_err = cce.getCalibratedCcsBulk(cmpd_data[0], cmpd_data[1])
+    if not all(isfinite(ccs_err)) or not all(ccs_err > 0):
+        print("\t\tError: getCalibratedCcsBulk did not propagate the uncertainties")
+        return False
+    optparams = array(cce.optparams, dtype=float)
+    for i in range(len(cmpd_data[0])):
+        if percent_diff(ccs[i], cce.getCalibratedCcs(cmpd_data[0][i], cmpd_data[1][i])) > 1e-9:
+            print("\t\tError: compound with m/z", cmpd_data[0][i], "bulk calibrated CCS does not match")
+            return False
+        grad = zeros(3)
+        for k in range(3):
+            step = 1e-6 * max(abs(optparams[k]), 1.)
+            cce.optparams = optparams.copy()
+            cce.optparams[k] += step
+            grad[k] = (cce.getCalibratedCcs(cmpd_data[0][i], cmpd_data[1][i]) - ccs[i]) / step
+        cce.optparams = optparams
+        if percent_diff(ccs_err[i], sqrt(dot(grad, dot(cce.covar, grad)))) > 0.1:
+            print("\t\tError: compound with m/z", cmpd_data[0][i], "calibrated CCS uncertainty does not match")
+            return False
+    return True
+
+
+def test_save_load_calibration():
+    """
+external_data.test_save_load_calibration
+    description:
+        initialize the object normally, saves the calibration as JSON and as npz, then tests that the calibrations
+        loaded back from them give the same calibrated CCS (and uncertainties) for the test compounds, and that
+        they are rejected if the settings they were saved with have changed (the edc)
+    parameters:
+        no
+    returns:
+        passed (bool) - test passed
+"""
+    # load the external dataset
+    ext_data = genfromtxt(EXTDATA1_PATH, delimiter=",", unpack=True)
+    # initialize the CcsCalibrationExt object
+    cce = CcsCalibrationExt(*ext_data)
+    # load the compound dataset
+    cmpd_data = genfromtxt(EXTDATA2_PATH, delimiter=",", unpack=True)
+    ccs, ccs_err = cce.getCalibratedCcsBulk(cmpd_data[0], cmpd_data[1])
+    settings = calibrationSettings(0.05, 1.35, cal_masses=ext_data[0], cal_lit_ccs=ext_data[2])
+    changed = calibrationSettings(0.05, 1.40, cal_masses=ext_data[0], cal_lit_ccs=ext_data[2])
+    for file_name in ["CcsCal/tests/files/test_calibration.json", "CcsCal/tests/files/test_calibration.npz"]:
+        cce.saveCalibration(file_name, settings=settings)
+        loaded = loadCalibration(file_name, settings=settings)
+        try:
+            loadCalibration(file_name, settings=changed)
+            rejected = False
+        except ValueError:
+            rejected = True
+        remove(file_name)
+        if not rejected:
+            print("\t\tError: calibration loaded from", file_name, "was not rejected after the edc changed")
+            return False
+        loaded_ccs, loaded_ccs_err = loaded.getCalibratedCcsBulk(cmpd_data[0], cmpd_data[1])
+        if any(abs(loaded_ccs - ccs) > 1e-9) or any(abs(loaded_ccs_err - ccs_err) > 1e-9):
+            print("\t\tError: calibration loaded from", file_name, "does not give the same calibrated CCS")
+            return False
+        if any(abs(loaded.calCalcCcs - cce.calCalcCcs) > 1e-9):
+            print("\t\tError: calibration loaded from", file_name, "does not have the same calibrants")
+            return False
+    return True
+
+
+def test_calibration_bootstrap():
+    """
+external_data.test_calibration_bootstrap
+    description:
+        initialize the object normally, then computes bootstrap and jackknife intervals of the calibration curve
+        parameters and calibrated CCS, and tests that all of the resamples were refit, that the intervals contain
+        the fitted values, and that the parameter intervals are about as wide as the ones implied by the
+        covariance of the fitted parameters
+    parameters:
+        no
+    returns:
+        passed (bool) - test passed
+"""
+    # load the external dataset
+    ext_data = genfromtxt(EXTDATA1_PATH, delimiter=",", unpack=True)
+    # initialize the CcsCalibrationExt object
+    cce = CcsCalibrationExt(*ext_data)
+    # load the compound dataset
+    cmpd_data = genfromtxt(EXTDATA2_PATH, delimiter=",", unpack=True)
+    ccs = cce.getCalibratedCcsBulk(cmpd_data[0], cmpd_data[1])[0]
+    # widths of the normal 95% intervals from the covariance of the fitted parameters
+    widths = 2. * 1.96 * sqrt(array([cce.covar[i][i] for i in range(3)]))
+    for method, n_resamples in [("bootstrap", 500), ("jackknife", len(ext_data[0]))]:
+        bootstrap = CalibrationBootstrap(cce, method=method, n_resamples=500)
+        if bootstrap.nUsed != n_resamples:
+            print("\t\tError:", method, "refit", bootstrap.nUsed, "of", n_resamples, "resamples")
+            return False
+        lower, upper = bootstrap.paramIntervals.T
+        if any(lower > cce.optparams) or any(upper < cce.optparams):
+            print("\t\tError:", method, "parameter intervals do not contain the fitted parameters")
+            return False
+        if any((upper - lower) > 3. * widths) or any((upper - lower) < widths / 3.):
+            print("\t\tError:", method, "parameter intervals are not consistent with the covariance")
+            return False
+        lower, upper = bootstrap.ccsIntervals(cmpd_data[0], cmpd_data[1]).T
+        if any(lower > ccs) or any(upper < ccs):
+            print("\t\tError:", method, "calibrated CCS intervals do not contain the calibrated CCS")
+            return False
+    return True
+
+
+def test_edc_sweep():
+    """
+external_data.test_edc_sweep
+    description:
+        initialize the object normally, then sweeps a grid of EDC parameters (with two different initial
+        parameters) that includes the EDC parameter of the calibration, and tests that the grid point with the
+        same EDC parameter reproduces the calibration, that the best grid point has the lowest residual CCS, and
+        that applying the best setting updates the calibration
+    parameters:
+        no
+    returns:
+        passed (bool) - test passed
+"""
+    # load the external dataset
+    ext_data = genfromtxt(EXTDATA1_PATH, delimiter=",", unpack=True)
+    # initialize the CcsCalibrationExt object
+    cce = CcsCalibrationExt(*ext_data)
+    rms = sqrt(mean((100. * (cce.calLitCcs - cce.calCalcCcs) / cce.calLitCcs)**2))
+    edcs = [1.05, 1.15, 1.25, 1.35, 1.45, 1.55, 1.65]
+    sweep = cce.sweepEdc(edcs, seeds=[(500., 0., 0.5), cce.optparams], apply=False)
+    if not sweep.converged.all():
+        print("\t\tError: not all of the grid points converged")
+        return False
+    # the grid point with the same EDC parameter as the calibration should give the same fit
+    for seed in range(2):
+        if not allclose(sweep.params[3][seed], cce.optparams, rtol=1e-3):
+            print("\t\tError: fitted parameters at EDC = 1.35", sweep.params[3][seed], "do not match",
+                  cce.optparams)
+            return False
+        if abs(sweep.rmsResidual[3][seed] - rms) > 1e-3:
+            print("\t\tError: rms residual at EDC = 1.35", sweep.rmsResidual[3][seed], "does not match", rms)
+            return False
+    if sweep.rmsResidual[sweep.bestIndex] != nanmin(sweep.rmsResidual):
+        print("\t\tError: the best grid point does not have the lowest rms residual")
+        return False
+    sweep.apply()
+    if cce.edc != sweep.bestEdc or cce.fit_failed:
+        print("\t\tError: the best setting was not applied to the calibration")
+        return False
+    if not allclose(cce.calCalcCcs, cce.getCalibratedCcs(cce.calMasses, cce.calDriftTimes)):
+        print("\t\tError: calibrant calculated CCS were not updated")
+        return False
+    return True
+
+
+def test_linearized_seed():
+    """
+external_data.test_linearized_seed
+    description:
+        initialize the object normally, then tests that the linearized estimate of the calibration curve
+        parameters is close to the fitted parameters, that the analytic Jacobian of the calibration curve matches
+        finite differences, and that a fit starting from the estimate converges in a few function evaluations
+    parameters:
+        no
+    returns:
+        passed (bool) - test passed
+"""
+    # load the external dataset
+    ext_data = genfromtxt(EXTDATA1_PATH, delimiter=",", unpack=True)
+    # initialize the CcsCalibrationExt object
+    cce = CcsCalibrationExt(*ext_data)
+    seed = seedCalCurve(cce.correctedDt, cce.correctedLitCcs)[0]
+    if abs(seed[0] / cce.optparams[0] - 1.) > 0.01 or abs(seed[1] - cce.optparams[1]) > 0.01 or \
+            abs(seed[2] / cce.optparams[2] - 1.) > 0.01:
+        print("\t\tError: linearized estimate", seed, "is not close to the fitted parameters", cce.optparams)
+        return False
+    # compare the analytic Jacobian to central differences
+    jac = cce.baseCalCurveJac(cce.correctedDt, *seed)
+    for i in range(3):
+        step = zeros(3)
+        step[i] = 1e-6 * abs(seed[i])
+        fd = (cce.baseCalCurve(cce.correctedDt, *(seed + step)) -
+              cce.baseCalCurve(cce.correctedDt, *(seed - step))) / (2. * step[i])
+        if not allclose(jac[:, i], fd, rtol=1e-5):
+            print("\t\tError: analytic Jacobian does not match finite differences for parameter", i)
+            return False
+    nfev = curve_fit(cce.baseCalCurve, cce.correctedDt, cce.correctedLitCcs, p0=seed, jac=cce.baseCalCurveJac,
+                     full_output=True)[2]["nfev"]
+    if nfev > 10:
+        print("\t\tError: fit starting from the linearized estimate took", nfev, "function evaluations")
+        return False
+    return True
+
+
+def test_calibration_registry():
+    """
+external_data.test_calibration_registry
+    description:
+        makes two calibrations an hour apart (the second with drift times that have drifted by 2%), adds them to a
+        CalibrationRegistry out of order, and tests that the nearest calibration is found for times in between
+        and outside of them, that an interpolated calibration has the average parameters halfway between them
+        (and the covariance of the nearest calibration), and that the bulk conversion of samples acquired at
+        different times (as numbers, datetimes, or numpy.datetime64) matches converting them with the
+        calibration for each time
+    parameters:
+        no
+    returns:
+        passed (bool) - test passed
+"""
+    # load the external dataset
+    ext_data = genfromtxt(EXTDATA1_PATH, delimiter=",", unpack=True)
+    cce_0 = CcsCalibrationExt(*ext_data)
+    cce_1 = CcsCalibrationExt(ext_data[0], 1.02 * ext_data[1], ext_data[2])
+    registry = CalibrationRegistry([(3600., cce_1), (0., cce_0)])
+    if registry.timestamps != [0., 3600.]:
+        print("\t\tError: timestamps are not sorted:", registry.timestamps)
+        return False
+    for timestamp, expected in [(-60., cce_0), (0., cce_0), (1000., cce_0), (3000., cce_1), (7200., cce_1)]:
+        if registry.calibrationAt(timestamp) is not expected:
+            print("\t\tError: wrong calibration for time", timestamp)
+            return False
+    halfway = registry.calibrationAt(1800., interpolate=True)
+    if not allclose(halfway.optparams, (array(cce_0.optparams) + array(cce_1.optparams)) / 2.):
+        print("\t\tError: interpolated parameters", halfway.optparams, "are not the average of the neighbors")
+        return False
+    if not allclose(halfway.covar, cce_0.covar):
+        print("\t\tError: interpolated calibration does not have the covariance of the nearest calibration")
+        return False
+    # load the compound dataset, and acquire every compound at each time
+    cmpd_data = genfromtxt(EXTDATA2_PATH, delimiter=",", unpack=True)
+    times = array([-60., 0., 1800., 3600., 7200.])
+    ccs, ccs_err = registry.getCalibratedCcsBulk(times[:, None], cmpd_data[0][None, :], cmpd_data[1][None, :])
+    for i, calibration in enumerate([cce_0, cce_0, halfway, cce_1, cce_1]):
+        expected, expected_err = calibration.getCalibratedCcsBulk(cmpd_data[0], cmpd_data[1])
+        if not allclose(ccs[i], expected) or not allclose(ccs_err[i], expected_err):
+            print("\t\tError: bulk calibrated CCS do not match the calibration for time", times[i])
+            return False
+    # the same times as datetimes (in an object array) and as numpy.datetime64, relative to a start time
+    start = datetime(2026, 1, 1, 8, 0, 0)
+    registry = CalibrationRegistry([(start + timedelta(seconds=3600.), cce_1), (start, cce_0)])
+    datetimes = array([start + timedelta(seconds=t) for t in times], dtype=object)
+    for stamps in [datetimes, datetimes.astype("datetime64[us]")]:
+        dt_ccs, dt_ccs_err = registry.getCalibratedCcsBulk(stamps[:, None], cmpd_data[0][None, :],
+                                                           cmpd_data[1][None, :])
+        if not allclose(dt_ccs, ccs) or not allclose(dt_ccs_err, ccs_err):
+            print("\t\tError: bulk calibrated CCS for", stamps.dtype, "timestamps do not match numeric timestamps")
+            return False
+    return True
+
+
+def test_feature_table_conversion():
+    """
+external_data.test_feature_table_conversion
+    description:
+        fits a calibration to the external calibrant CSV, then streams a feature table (the compound dataset with
+        a header and a row without numeric values added) through it a few rows at a time, and tests that the
+        calibration matches the one from the CcsCalibrationExt object and that every row is written with the
+        same calibrated CCS as a bulk conversion of the whole table, then tests that a feature table without a
+        header whose first row has an empty drift time is not mistaken for having a header
+    parameters:
+        no
+    returns:
+        passed (bool) - test passed
+"""
+    # load the external dataset
+    ext_data = genfromtxt(EXTDATA1_PATH, delimiter=",", unpack=True)
+    cce = CcsCalibrationExt(*ext_data)
+    calibration = calibrateFromCsv(EXTDATA1_PATH)
+    if not allclose(calibration.optparams, cce.optparams):
+        print("\t\tError: calibration from CSV", calibration.optparams, "does not match", cce.optparams)
+        return False
+    # write a feature table with a header, a blank line, and a row without numeric values
+    feature_file, output_file = "CcsCal/tests/files/test_features.csv", "CcsCal/tests/files/test_features_ccs.csv"
+    with open(EXTDATA2_PATH, "r") as f:
+        rows = [line.strip() for line in f if line.strip()]
+    with open(feature_file, "w") as f:
+        f.write("\n".join(["mz,dt,ccs"] + rows + ["", "unknown,,"]) + "\n")
+    n_rows, n_failed = convertFeatureCsv(calibration, feature_file, output_file, chunk_rows=4)
+    with open(output_file, "r") as f:
+        lines = [line.strip() for line in f]
+    remove(feature_file)
+    remove(output_file)
+    if n_rows != len(rows) + 1 or n_failed != 1 or len(lines) != len(rows) + 2:
+        print("\t\tError: wrote", n_rows, "rows (" + str(n_failed), "failed) and", len(lines), "lines")
+        return False
+    if lines[0] != "mz,dt,ccs,ccs,ccs_err" or lines[-1] != "unknown,,,nan,nan":
+        print("\t\tError: header or row without numeric values was not written correctly")
+        return False
+    cmpd_data = genfromtxt(EXTDATA2_PATH, delimiter=",", unpack=True)
+    expected = cce.getCalibratedCcsBulk(cmpd_data[0], cmpd_data[1])[0]
+    ccs = array([float(line.split(",")[3]) for line in lines[1:-1]])
+    if any(abs(ccs - expected) > 1e-3):
+        print("\t\tError: streamed calibrated CCS do not match the bulk conversion")
+        return False
+    # no header, and the first row is missing its drift time
+    with open(feature_file, "w") as f:
+        f.write("\n".join([rows[0].split(",")[0] + ",,"] + rows) + "\n")
+    n_rows, n_failed = convertFeatureCsv(calibration, feature_file, output_file, chunk_rows=4)
+    with open(output_file, "r") as f:
+        lines = [line.strip() for line in f]
+    remove(feature_file)
+    remove(output_file)
+    if n_rows != len(rows) + 1 or n_failed != 1 or lines[0] != rows[0].split(",")[0] + ",,,nan,nan":
+        print("\t\tError: first row with an empty drift time was not written as a row of data")
+        return False
+    return True
+
+
 # *the primary method for running all of the tests*
 def run():
     """
@@ -169,25 +502,53 @@ external_data.run
     returns:
         passed_all (bool) - all tests passed
 """
-    print("\t(1 of 5) running simple initialization test...")
+    print("\t(1 of 12) running simple initialization test...")
     assert simple_test()
     print("\t...PASS")
 
-    print("\t(2 of 5) running initialization test without automatic curve fitting...")
+    print("\t(2 of 12) running initialization test without automatic curve fitting...")
     assert test_ccs_cal_noauto()
     print("\t...PASS")
 
-    print("\t(3 of 5) running CCS calibration test with known reference compounds...")
+    print("\t(3 of 12) running CCS calibration test with known reference compounds...")
     assert test_get_cal_ccs()
     print("\t...PASS")
 
-    print("\t(4 of 5) testing calibrant CCS calibration residuals...")
+    print("\t(4 of 12) testing calibrant CCS calibration residuals...")
     assert test_get_cal_ccs()
     print("\t...PASS")
 
-    print("\t(5 of 5) testing calibration curve figure generation...")
+    print("\t(5 of 12) testing calibration curve figure generation...")
     assert test_cal_curve_figure()
     print("\t...PASS")
 
+    print("\t(6 of 12) testing bulk CCS calibration with propagated uncertainties...")
+    assert test_bulk_cal_ccs()
+    print("\t...PASS")
+
+    print("\t(7 of 12) testing saving and loading calibrations...")
+    assert test_save_load_calibration()
+    print("\t...PASS")
+
+    print("\t(8 of 12) testing bootstrap and jackknife intervals of the calibration...")
+    assert test_calibration_bootstrap()
+    print("\t...PASS")
+
+    print("\t(9 of 12) testing a sweep of EDC parameters...")
+    assert test_edc_sweep()
+    print("\t...PASS")
+
+    print("\t(10 of 12) testing the linearized estimate of the calibration curve parameters...")
+    assert test_linearized_seed()
+    print("\t...PASS")
+
+    print("\t(11 of 12) testing a registry of calibrations at different times...")
+    assert test_calibration_registry()
+    print("\t...PASS")
+
+    print("\t(12 of 12) testing streaming conversion of an external feature table...")
+    assert test_feature_table_conversion()
+    print("\t...PASS")
+
     # if everything passed return True for success
     return True
@@ -0,0 +1,487 @@
+"""
+    Tests for fitting drift time profiles with gaussian functions (GaussFit, BatchGaussFit) using synthetic
+    profiles with known parameters
+
+    2018/03/28
+    Dylan H. Ross
+"""
+
+
+from CcsCal.processing.BatchGaussFit import BatchGaussFit, stackProfiles, gaussFunc, gaussJac, seedParams, roiSlice
+from CcsCal.processing.BatchLeastSquares import batchLevenbergMarquardt, finiteDifferenceJacobian
+from CcsCal.processing.GaussFit import GaussFit, conditionProfiles, isPoorFit
+from CcsCal.processing.FigureRenderer import FigureRenderer, checkFigurePolicy, getRenderer, renderGaussFitFig
+from CcsCal.processing.ContactSheet import ContactSheet
+from CcsCal.processing.ProfileConditioner import ProfileConditioner, describeSettings
+
+
+from numpy import arange, array, abs, all, any, exp, full, nan, sqrt, broadcast_to, where
+from numpy.random import RandomState
+from scipy.optimize import curve_fit
+from scipy.signal import savgol_filter
+from os import remove
+from os.path import isfile
+
+
+# dtbins of the synthetic profiles
+DTBINS = arange(1., 201.)
+# path to the test files
+TEST_PATH = "CcsCal/tests/files/"
+
+
+class SyntheticRawData:
+    """
+gauss_fitting.SyntheticRawData
+    description:
+        stands in for a RawData object, with just the attributes that GaussFit uses
+"""
+
+    def __init__(self, dtbins, intensities, mass):
+        self.dtBinAndIntensity = array([dtbins, intensities])
+        self.specifiedMass = mass
+        self.ppFileName = "synthetic.txt"
+
+
+def make_profiles(n_profiles, noise=5., seed=1234, sigmas=(2., 8.)):
+    """
+gauss_fitting.make_profiles
+    description:
+        generates a stack of noisy gaussian profiles with random parameters
+    parameters:
+        n_profiles (int) -- number of profiles
+        [noise (float) -- standard deviation of the noise added to the profiles]
+        [seed (int) -- random seed]
+        [sigmas (tuple(float, float)) -- range of sigma parameters]
+    returns:
+        params (numpy.array) -- amplitude, mu, and sigma of each profile
+        profiles (numpy.array) -- intensities of each profile
+"""
+    rs = RandomState(seed)
+    params = array([rs.uniform(200., 1000., n_profiles),
+                    rs.uniform(30., 150., n_profiles),
+                    rs.uniform(sigmas[0], sigmas[1], n_profiles)]).T
+    profiles = params[:, 0:1] * exp(-(DTBINS - params[:, 1:2])**2 / (2. * params[:, 2:3]**2))
+    return params, profiles + rs.normal(0., noise, profiles.shape)
+
+
+def test_batch_fit():
+    """
+gauss_fitting.test_batch_fit
+    description:
+        fits a stack of noisy synthetic profiles all at once, then checks that every fit converged, that the
+        fitted mu parameters are close to the true values (within 3 standard errors from the covariance), and
+        that the parameters and covariance match those from scipy.optimize.curve_fit
+    parameters:
+        no
+    returns:
+        passed (bool) - test passed
+"""
+    params, profiles = make_profiles(50)
+    # fit the whole profiles, the same as curve_fit
+    fit = BatchGaussFit(DTBINS, profiles, roi_widths=0.)
+    if not all(fit.converged):
+        print("\t\tError: not all of the fits converged")
+        return False
+    if not all(abs(fit.optParams[:, 1] - params[:, 1]) < 3. * sqrt(fit.covars[:, 1, 1])):
+        print("\t\tError: fitted mu parameters are not close to the true values")
+        return False
+    gauss = lambda x, A, mu, sigma: A * exp(-(x - mu)**2 / (2. * sigma**2))
+    for i in range(len(profiles)):
+        opt, covar = curve_fit(gauss, DTBINS, profiles[i], p0=fit.initParams[i])
+        if abs(opt[1] - fit.optParams[i, 1]) > 1e-4 or abs(covar[1, 1] - fit.covars[i, 1, 1]) > 1e-3 * covar[1, 1]:
+            print("\t\tError: fit", i, "does not match scipy.optimize.curve_fit")
+            return False
+    return True
+
+
+def test_jacobian():
+    """
+gauss_fitting.test_jacobian
+    description:
+        checks that the analytic Jacobian of the gaussian function matches a finite difference Jacobian
+    parameters:
+        no
+    returns:
+        passed (bool) - test passed
+"""
+    params = array([[500., 50., 3.], [100., 120.5, 0.8], [2000., 75.2, 12.]])
+    dtbins = broadcast_to(DTBINS, (len(params), len(DTBINS)))
+    analytic = gaussJac(dtbins, params)
+    numeric = finiteDifferenceJacobian(gaussFunc, dtbins, params)
+    if not all(abs(analytic - numeric) <= 1e-5 * params[:, 0:1, None] + 1e-4 * abs(analytic)):
+        print("\t\tError: analytic Jacobian does not match the finite difference Jacobian")
+        return False
+    return True
+
+
+def test_stalled_fit():
+    """
+gauss_fitting.test_stalled_fit
+    description:
+        fits two rows with batchLevenbergMarquardt using a model that cannot be evaluated anywhere that the second
+        row could step to from its initial parameters, and checks that the first row converges while the second
+        row is flagged as stalled and not converged
+    parameters:
+        no
+    returns:
+        passed (bool) - test passed
+"""
+    x = arange(1., 11.)
+    # a line through the origin, that cannot be evaluated for slopes below 2 (other than the initial slope of 1)
+    model = lambda xs, ps: where((ps[:, :1] < 2.) & (ps[:, :1] != 1.), nan, ps[:, :1] * xs)
+    y = array([4. * x, -1.e6 * x])
+    _, _, converged, stalled = batchLevenbergMarquardt(model, x, y, array([[3.], [1.]]),
+                                                       jac=lambda xs, ps: xs[:, :, None])
+    if not converged[0] or stalled[0] or converged[1] or not stalled[1]:
+        print("\t\tError: stalled fit was not flagged (converged: {}, stalled: {})".format(converged, stalled))
+        return False
+    return True
+
+
+def test_seeding():
+    """
+gauss_fitting.test_seeding
+    description:
+        checks that the initial parameters estimated in closed form are close to the true parameters, for both
+        regular and narrow peaks, and that the fits of narrow peaks converge to the true mu parameters
+    parameters:
+        no
+    returns:
+        passed (bool) - test passed
+"""
+    for sigmas in [(2., 8.), (0.8, 1.5)]:
+        params, profiles = make_profiles(50, sigmas=sigmas)
+        seeds = seedParams(broadcast_to(DTBINS, profiles.shape), profiles)
+        if not all(abs(seeds[:, 1] - params[:, 1]) < 0.5) or not all(abs(seeds[:, 2] / params[:, 2] - 1.) < 0.3):
+            print("\t\tError: initial parameters are not close to the true parameters for sigmas", sigmas)
+            return False
+        fit = BatchGaussFit(DTBINS, profiles)
+        if not all(fit.converged) or not all(abs(fit.optParams[:, 1] - params[:, 1]) < 0.5):
+            print("\t\tError: fits did not converge to the true parameters for sigmas", sigmas)
+            return False
+    return True
+
+
+def test_padded_stack():
+    """
+gauss_fitting.test_padded_stack
+    description:
+        stacks profiles with different numbers of dtbins (the shorter ones are padded with points that have a
+        weight of 0) and checks that fitting the stack gives the same results as fitting each profile by itself
+    parameters:
+        no
+    returns:
+        passed (bool) - test passed
+"""
+    _, profiles = make_profiles(3)
+    raw_datas = [SyntheticRawData(DTBINS[:n], profile[:n], 100.) for n, profile in zip([200, 180, 160], profiles)]
+    dtbins, intensities, weights = stackProfiles(raw_datas)
+    stacked = BatchGaussFit(dtbins, intensities, weights=weights)
+    for i, raw_data in enumerate(raw_datas):
+        single = BatchGaussFit(*raw_data.dtBinAndIntensity)
+        if abs(single.optParams[0, 1] - stacked.optParams[i, 1]) > 1e-6:
+            print("\t\tError: fit of padded profile", i, "does not match the fit of the profile by itself")
+            return False
+    return True
+
+
+def test_roi():
+    """
+gauss_fitting.test_roi
+    description:
+        checks that the region of interest around each peak is much narrower than the whole profile (including for
+        peaks close to the edges), that fitting only the region of interest gives nearly the same results as
+        fitting the whole profile, and that GaussFit still covers the whole profile in rawandfitdata
+    parameters:
+        no
+    returns:
+        passed (bool) - test passed
+"""
+    params, profiles = make_profiles(20)
+    params[:2, 1] = [3., 197.]
+    profiles[:2] = params[:2, 0:1] * exp(-(DTBINS - params[:2, 1:2])**2 / (2. * params[:2, 2:3]**2))
+    dtbins = broadcast_to(DTBINS, profiles.shape)
+    init_params = seedParams(dtbins, profiles)
+    roi_dtbins, _, roi_weights = roiSlice(dtbins, profiles, dtbins * 0. + 1., init_params, widths=5.)
+    if roi_dtbins.shape[1] >= len(DTBINS) / 2 or \
+            not all(abs(roi_dtbins - params[:, 1:2])[roi_weights > 0] <= 5. * init_params[:, 2].max() + 2.):
+        print("\t\tError: unexpected region of interest")
+        return False
+    roi = BatchGaussFit(DTBINS, profiles, roi_widths=5.)
+    full = BatchGaussFit(DTBINS, profiles, roi_widths=0.)
+    if not all(roi.converged) or not all(abs(roi.optParams[:, 1] - full.optParams[:, 1]) < 0.01):
+        print("\t\tError: fits of the region of interest do not match fits of the whole profiles")
+        return False
+    gauss_fit = GaussFit(SyntheticRawData(DTBINS, profiles[5], 100.), gen_fig=False)
+    if gauss_fit.rawandfitdata.shape != (3, len(DTBINS)):
+        print("\t\tError: GaussFit.rawandfitdata does not cover the whole profile")
+        return False
+    return True
+
+
+def test_tiered_estimator():
+    """
+gauss_fitting.test_tiered_estimator
+    description:
+        uses the tiered estimator on a stack of clean profiles and profiles with shoulders, then checks that the
+        clean profiles use the moment estimates (with mu parameters close to the true values), that the profiles
+        with shoulders are escalated to the gaussian fit, and that an unknown estimator is rejected
+    parameters:
+        no
+    returns:
+        passed (bool) - test passed
+"""
+    params, profiles = make_profiles(20)
+    # add shoulders to the first 5 profiles
+    profiles[:5] += 0.6 * params[:5, 0:1] * exp(-(DTBINS - params[:5, 1:2] - 3. * params[:5, 2:3])**2 /
+                                                 (2. * params[:5, 2:3]**2))
+    fit = BatchGaussFit(DTBINS, profiles, estimator="tiered")
+    if any(fit.tiers[:5] == "moment") or not all(fit.tiers[5:] == "moment"):
+        print("\t\tError: unexpected tiers from the tiered estimator:", fit.tiers)
+        return False
+    if not all(abs(fit.optParams[5:, 1] - params[5:, 1]) < 0.5):
+        print("\t\tError: moment estimates of mu are not close to the true values")
+        return False
+    if not all(BatchGaussFit(DTBINS, profiles, estimator="fit").tiers == "fit"):
+        print("\t\tError: the fit estimator did not fit all of the profiles")
+        return False
+    gauss_fit = GaussFit(SyntheticRawData(DTBINS, profiles[10], 100.), gen_fig=False, estimator="tiered")
+    if gauss_fit.tier != "moment" or abs(gauss_fit.getDriftTime(dtbin_to_dt=1.) - params[10, 1]) > 0.5:
+        print("\t\tError: unexpected tier or drift time from GaussFit with the tiered estimator")
+        return False
+    try:
+        BatchGaussFit(DTBINS, profiles, estimator="guess")
+        print("\t\tError: an unknown estimator was not rejected")
+        return False
+    except ValueError:
+        return True
+
+
+def test_gauss_fit():
+    """
+gauss_fitting.test_gauss_fit
+    description:
+        fits single synthetic profiles with GaussFit and checks the drift times, then checks that a profile
+        that cannot be fit (all nan) is flagged as failed with no covariance
+    parameters:
+        no
+    returns:
+        passed (bool) - test passed
+"""
+    params, profiles = make_profiles(5)
+    for (_, mu, _), profile in zip(params, profiles):
+        gauss_fit = GaussFit(SyntheticRawData(DTBINS, profile, 100.), gen_fig=False)
+        if abs(gauss_fit.getDriftTime(dtbin_to_dt=1.) - mu) > 0.5:
+            print("\t\tError: unexpected drift time from GaussFit")
+            return False
+        if gauss_fit.fit_failed or gauss_fit.covar is None:
+            print("\t\tError: GaussFit flagged a good fit as failed")
+            return False
+    gauss_fit = GaussFit(SyntheticRawData(DTBINS, full(len(DTBINS), nan), 100.), gen_fig=False)
+    if not gauss_fit.fit_failed or gauss_fit.covar is not None or gauss_fit.tier != "failed":
+        print("\t\tError: GaussFit did not flag a failed fit")
+        return False
+    return True
+
+
+def test_figure_rendering():
+    """
+gauss_fitting.test_figure_rendering
+    description:
+        queues gaussian fit figures to be rendered in the background (from GaussFit through the shared renderer,
+        and directly to a separate renderer with several worker threads), checks that they have all been written
+        once the renderers are drained, and that an error rendering a figure is collected rather than raised
+    parameters:
+        no
+    returns:
+        passed (bool) - test passed
+"""
+    params, profiles = make_profiles(4)
+    raw_data = SyntheticRawData(DTBINS, profiles[0], params[0, 1])
+    raw_data.ppFileName = TEST_PATH + "IM_figure.txt"
+    gauss_fit = GaussFit(raw_data)
+    file_names = [TEST_PATH + "IM_figure_mass-" + str(int(params[0, 1])) + ".png"]
+    renderer = FigureRenderer(jobs=3)
+    for i in range(1, len(profiles)):
+        file_names.append(TEST_PATH + "IM_figure_" + str(i) + ".png")
+        renderer.submit(renderGaussFitFig, file_names[-1], gauss_fit.rawandfitdata, str(i), "raw data", dpi=50)
+    renderer.submit(renderGaussFitFig, TEST_PATH + "does/not/exist.png", gauss_fit.rawandfitdata, "", "", dpi=50)
+    errors = getRenderer().drain() + renderer.drain()
+    renderer.shutdown()
+    passed = True
+    for file_name in file_names:
+        if isfile(file_name):
+            remove(file_name)
+        else:
+            print("\t\tError: figure", file_name, "was not written")
+            passed = False
+    if len(errors) != 1 or "does/not/exist.png" not in errors[0]:
+        print("\t\tError: unexpected errors rendering figures:", errors)
+        passed = False
+    return passed
+
+
+def test_figure_policy():
+    """
+gauss_fitting.test_figure_policy
+    description:
+        with the "failed" figure policy, checks that GaussFit only generates a figure for a low quality fit (a
+        profile that is just noise) and not for a clean peak, then adds both fits to a ContactSheet and checks
+        that the sheet has a thumbnail for each of them with only the low quality fit flagged
+    parameters:
+        no
+    returns:
+        passed (bool) - test passed
+"""
+    params, profiles = make_profiles(1)
+    noise = 50. + RandomState(4321).normal(0., 5., len(DTBINS))
+    passed = True
+    try:
+        checkFigurePolicy("some")
+        print("\t\tError: checkFigurePolicy accepted an unknown policy")
+        passed = False
+    except ValueError:
+        pass
+    if checkFigurePolicy(True) != "all" or checkFigurePolicy(False) != "none":
+        print("\t\tError: checkFigurePolicy did not accept True/False in place of all/none")
+        passed = False
+    sheet = ContactSheet(TEST_PATH + "contact_sheet.html")
+    for name, profile, poor in [("IM_clean", profiles[0], False), ("IM_noise", noise, True)]:
+        raw_data = SyntheticRawData(DTBINS, profile, params[0, 1])
+        raw_data.ppFileName = TEST_PATH + name + ".txt"
+        gauss_fit = GaussFit(raw_data, gen_fig="failed")
+        getRenderer().drain()
+        file_name = TEST_PATH + name + "_mass-" + str(int(params[0, 1])) + ".png"
+        if isPoorFit(gauss_fit.tier, gauss_fit.r2) != poor:
+            print("\t\tError:", name, "R^2 =", gauss_fit.r2, "tier =", gauss_fit.tier)
+            passed = False
+        if isfile(file_name):
+            remove(file_name)
+            if not poor:
+                print("\t\tError: a figure was generated for", name)
+                passed = False
+        elif poor:
+            print("\t\tError: a figure was not generated for", name)
+            passed = False
+        sheet.add(name, gauss_fit.mass, gauss_fit.rawandfitdata, drift_time=gauss_fit.getDriftTime(),
+                  tier=gauss_fit.tier, r2=gauss_fit.r2, flagged=isPoorFit(gauss_fit.tier, gauss_fit.r2))
+    sheet.write()
+    with open(sheet.sheetFileName, "r") as f:
+        html = f.read()
+    remove(sheet.sheetFileName)
+    if html.count("<svg ") != 2 or html.count('class="card flagged"') != 1 or sheet.nFlagged != 1:
+        print("\t\tError: the contact sheet does not have the expected thumbnails")
+        passed = False
+    return passed
+
+
+def test_conditioning():
+    """
+gauss_fitting.test_conditioning
+    description:
+        conditions a stack of profiles with different numbers of dtbins (padded) with a ProfileConditioner and
+        checks that the smoothing matches smoothing each profile by itself, that the padding is left alone, that
+        baseline subtraction and normalization give each profile a low percentile of 0 and a maximum of 1, that
+        fitting the conditioned stack with BatchGaussFit still finds the right mu parameters, and that
+        conditioning the profiles of RawData objects as a stack (conditionProfiles) then fitting them with
+        GaussFit gives the same conditioned profiles without modifying the RawData objects, and that only the
+        conditioning steps that are applied are described (i.e. for the figure labels)
+    parameters:
+        no
+    returns:
+        passed (bool) - test passed
+"""
+    params, profiles = make_profiles(4)
+    profiles += 50.
+    lengths = [200, 180, 180, 160]
+    raw_datas = [SyntheticRawData(DTBINS[:n], profile[:n], 100.) for n, profile in zip(lengths, profiles)]
+    dtbins, intensities, weights = stackProfiles(raw_datas)
+    smoothed = ProfileConditioner(window=9, order=3).condition(intensities, weights=weights)
+    for i, n in enumerate(lengths):
+        if any(abs(smoothed[i, :n] - savgol_filter(profiles[i, :n], 9, 3)) > 1e-9) or any(smoothed[i, n:] != 0.):
+            print("\t\tError: smoothing of padded profile", i, "does not match smoothing the profile by itself")
+            return False
+    conditioner = ProfileConditioner(window=9, order=3, baseline=True, normalize=True)
+    conditioned = conditioner.condition(intensities, weights=weights)
+    for i, n in enumerate(lengths):
+        if abs(conditioned[i, :n].max() - 1.) > 1e-9 or abs(conditioned[i, :n].min()) > 0.1:
+            print("\t\tError: profile", i, "was not baseline subtracted and normalized")
+            return False
+    fit = BatchGaussFit(dtbins, intensities, weights=weights, conditioner=conditioner)
+    if any(abs(fit.optParams[:, 1] - params[:, 1]) > 0.5):
+        print("\t\tError: fitting the conditioned profiles did not find the right mu parameters")
+        return False
+    for i, (raw_data, c) in enumerate(zip(raw_datas, conditionProfiles(raw_datas, conditioner))):
+        gauss_fit = GaussFit(raw_data, gen_fig=False, conditioner=conditioner, conditioned=c)
+        n = lengths[i]
+        if any(abs(gauss_fit.rawandfitdata[1] - conditioned[i, :n]) > 1e-9):
+            print("\t\tError: conditioned profile", i, "from conditionProfiles does not match the stack")
+            return False
+        if any(raw_data.dtBinAndIntensity[1] != profiles[i, :n]):
+            print("\t\tError: GaussFit modified the intensities of RawData object", i)
+            return False
+    if describeSettings(conditioner.settings()) != ["smoothed", "baseline subtracted", "normalized"] or \
+            describeSettings(ProfileConditioner(window=0, normalize=True).settings()) != ["normalized"] or \
+            describeSettings(None) != []:
+        print("\t\tError: the conditioning steps are not described correctly")
+        return False
+    return True
+
+
+# *the primary method for running all of the tests*
+def run():
+    """
+gauss_fitting.run
+    description:
+        runs all of the (currently implemented) individual tests
+    parameters:
+        no
+    returns:
+        passed_all (bool) - all tests passed
+"""
+    print("\t(1 of 11) fitting a stack of profiles with BatchGaussFit...")
+    assert test_batch_fit()
+    print("\t...PASS")
+
+    print("\t(2 of 11) analytic Jacobian of the gaussian function...")
+    assert test_jacobian()
+    print("\t...PASS")
+
+    print("\t(3 of 11) flagging fits that stall...")
+    assert test_stalled_fit()
+    print("\t...PASS")
+
+    print("\t(4 of 11) estimating initial parameters in closed form...")
+    assert test_seeding()
+    print("\t...PASS")
+
+    print("\t(5 of 11) fitting a stack of profiles with different numbers of dtbins...")
+    assert test_padded_stack()
+    print("\t...PASS")
+
+    print("\t(6 of 11) fitting only the region of interest around each peak...")
+    assert test_roi()
+    print("\t...PASS")
+
+    print("\t(7 of 11) estimating drift times with the tiered estimator...")
+    assert test_tiered_estimator()
+    print("\t...PASS")
+
+    print("\t(8 of 11) fitting single profiles with GaussFit...")
+    assert test_gauss_fit()
+    print("\t...PASS")
+
+    print("\t(9 of 11) rendering figures in the background...")
+    assert test_figure_rendering()
+    print("\t...PASS")
+
+    print("\t(10 of 11) generating figures for low quality fits and writing a contact sheet...")
+    assert test_figure_policy()
+    print("\t...PASS")
+
+    print("\t(11 of 11) conditioning stacks of profiles with ProfileConditioner...")
+    assert test_conditioning()
+    print("\t...PASS")
+
+    # if everything passed return True for success
+    return True
@@ -15,6 +15,8 @@ TEST_INPUT_01 = TEST_PATH + "test_input_file_01.txt"
 TEST_INPUT_02 = TEST_PATH + "test_input_file_02.txt"
 TEST_INPUT_03 = TEST_PATH + "test_input_file_03.txt"
 TEST_INPUT_04 = TEST_PATH + "test_input_file_04.txt"
+TEST_INPUT_06 = TEST_PATH + "test_input_file_06.txt"
+TEST_INPUT_07 = TEST_PATH + "test_input_file_07.txt"
 
 
 def test_shuffled_parameters(print_params=False):
@@ -145,6 +147,47 @@ input_parsing.test_terse_input
     return True
 
 
+def test_saved_calibration_input():
+    """
+input_parsing.test_saved_calibration_input
+    description:
+        tests input file that references a saved calibration (cal) instead of the calibration curve file,
+        calibration data file, and calibrant list, and one that also has the calibration data file but not the
+        calibration curve file
+
+        *uses test input files 6 and 7*
+    parameters:
+        no
+    returns:
+        pass (bool) - result of test
+"""
+    # initialize a ParseInput object with test file 06
+    Pif = ParseInputFile(TEST_INPUT_06)
+    # test the parameters
+    if Pif.calibrationFile != "dummy_calibration.json":
+        print("\t\tError: calibration file does not match reference")
+        return False
+    if Pif.calCurveFileName is not None or Pif.calDataFile is not None:
+        print("\t\tError: omitted calibration curve file name and calibration data file should be None")
+        return False
+    if Pif.calibrantData.shape != (2, 0):
+        print("\t\tError: there should not be any calibrants")
+        return False
+    if Pif.compoundDataDir != "dummy/" or Pif.compoundMasses != [195.0877, 304.0866]:
+        print("\t\tError: compound parameters do not match reference")
+        return False
+    # initialize a ParseInput object with test file 07, which only omits the calibration curve file
+    Pif = ParseInputFile(TEST_INPUT_07)
+    if Pif.calCurveFileName is not None:
+        print("\t\tError: omitted calibration curve file name should be None")
+        return False
+    if Pif.calDataFile != "dummy_calibrants.txt" or Pif.calibrationFile != "dummy_calibration.json":
+        print("\t\tError: calibration data file or calibration file does not match reference")
+        return False
+    # if nothing fails return True
+    return True
+
+
 # *the primary method for running all of the tests*
 def run():
     """
@@ -156,13 +199,17 @@ input_parsing.run
     returns:
         passed_all (bool) - all tests passed
 """
-    print("\t(1 of 2) testing input file with shuffled parameters...")
+    print("\t(1 of 3) testing input file with shuffled parameters...")
     assert test_shuffled_parameters()
     print("\t...PASS")
 
-    print("\t(2 of 2) testing terse input file...")
+    print("\t(2 of 3) testing terse input file...")
     assert test_terse_input()
     print("\t...PASS")
 
+    print("\t(3 of 3) testing input file with a saved calibration...")
+    assert test_saved_calibration_input()
+    print("\t...PASS")
+
     # if everything passed return True for success
     return True
@@ -0,0 +1,493 @@
+"""
+    Tests for extracting drift time data from raw data files (RawData, MultiMassExtractor, IMMatrix) using a small
+    synthetic raw data file that is generated at the start of the tests and removed at the end
+
+    2018/03/14
+    Dylan H. Ross
+"""
+
+
+from CcsCal.input.RawData import RawData, MultiMassExtractor
+from CcsCal.input.DataCache import DataCache
+from CcsCal.input.IMMatrix import IMMatrix
+from CcsCal.input.MzIndex import MzIndex
+from CcsCal.input.PreProcessTxt import preProcessTxt
+from CcsCal.input.TextParser import BACKENDS, parseText, parseLines
+from CcsCal.input.ParallelParse import parallelParseText
+from CcsCal.input.CompressedFile import OPENERS
+
+
+from numpy import array, arange, exp, abs, any, argsort, allclose, genfromtxt
+from numpy.random import RandomState
+from os import remove
+from os.path import isfile, isdir
+from shutil import rmtree
+from time import sleep
+
+
+# path to the test files
+TEST_PATH = "CcsCal/tests/files/"
+# path to the synthetic raw data file
+SYNTH_DATA_PATH = TEST_PATH + "IM_synthetic.txt"
+# path to a copy of the synthetic raw data file with its rows shuffled
+SYNTH_UNSORTED_PATH = TEST_PATH + "IM_synthetic_unsorted.txt"
+# path to the sidecar index file for the shuffled copy of the synthetic raw data file
+SYNTH_UNSORTED_INDEX_PATH = SYNTH_UNSORTED_PATH + ".mzidx.npz"
+# path to the sidecar index file for the synthetic raw data file
+SYNTH_INDEX_PATH = SYNTH_DATA_PATH + ".mzidx.npz"
+# paths to compressed copies of the synthetic raw data file
+SYNTH_COMPRESSED_PATHS = [SYNTH_DATA_PATH + extension for extension in OPENERS]
+# masses of the synthetic peaks
+SYNTH_MASSES = [161.0926, 232.13, 303.167, 374.204, 445.241]
+# mass window to use for extractions
+MASS_WINDOW = 0.05
+# directory for the DataCache used in testing, and the default DataCache directory for the test files
+CACHE_DIR = TEST_PATH + ".test_cache"
+DEFAULT_CACHE_DIR = TEST_PATH + ".ccscal_cache"
+
+
+def make_synthetic_data():
+    """
+raw_data.make_synthetic_data
+    description:
+        generates a small raw data file sorted by m/z with a gaussian drift time distribution for each of
+        SYNTH_MASSES (centered at dtbin = 20 + mass / 10) on top of randomly distributed noise
+    parameters:
+        no
+    returns:
+        no
+"""
+    rs = RandomState(1234)
+    rows = []
+    for mz, dtbin, intensity in zip(rs.uniform(100., 500., 5000), rs.randint(1, 201, 5000), rs.uniform(0., 5., 5000)):
+        rows.append((mz, dtbin, intensity))
+    dtbins = arange(1, 201)
+    for mass in SYNTH_MASSES:
+        intensities = 1000. * exp(-(dtbins - (20. + mass / 10.))**2 / (2. * 3.**2))
+        for dtbin, intensity in zip(dtbins, intensities):
+            if intensity > 1.:
+                rows.append((mass + rs.normal(0., 0.005), dtbin, intensity))
+    rows = array(rows)
+    rows = rows[argsort(rows[:, 0], kind="mergesort")]
+    with open(SYNTH_DATA_PATH, "w") as f:
+        for mz, dtbin, intensity in rows:
+            f.write("{:.4f} {:d} {:.1f}\n".format(mz, int(dtbin), intensity))
+
+
+def test_raw_data():
+    """
+raw_data.test_raw_data
+    description:
+        extracts the data for each of the synthetic masses with RawData (no pre-processing) and checks that
+        the most intense dtbin is where it is expected to be
+    parameters:
+        no
+    returns:
+        passed (bool) - test passed
+"""
+    for mass in SYNTH_MASSES:
+        rd = RawData(SYNTH_DATA_PATH, mass, MASS_WINDOW, pp=False)
+        apex = rd.dtBinAndIntensity[0][rd.dtBinAndIntensity[1].argmax()]
+        if abs(apex - (20. + mass / 10.)) > 1.:
+            print("\t\tError: unexpected apex dtbin ({:.0f}) for mass {:.4f}".format(apex, mass))
+            return False
+    return True
+
+
+def test_pre_processing():
+    """
+raw_data.test_pre_processing
+    description:
+        extracts the data for each of the synthetic masses (and for a mass outside of the range of the data)
+        with and without pre-processing and checks that the dtbin and intensity values are the same
+    parameters:
+        no
+    returns:
+        passed (bool) - test passed
+"""
+    for mass in SYNTH_MASSES + [999.]:
+        ref = RawData(SYNTH_DATA_PATH, mass, MASS_WINDOW, pp=False)
+        rd = RawData(SYNTH_DATA_PATH, mass, MASS_WINDOW, pp=True)
+        if not allclose(ref.dtBinAndIntensity, rd.dtBinAndIntensity):
+            print("\t\tError: pre-processed data does not match data for mass {:.4f}".format(mass))
+            return False
+    return True
+
+
+def test_text_parsers():
+    """
+raw_data.test_text_parsers
+    description:
+        parses the synthetic data with each of the available TextParser backends and checks that the results are
+        the same as genfromtxt, both for the entire file and for a few lines of it
+    parameters:
+        no
+    returns:
+        passed (bool) - test passed
+"""
+    ref = genfromtxt(SYNTH_DATA_PATH, unpack=True)
+    with open(SYNTH_DATA_PATH, "rb") as f:
+        lines = f.readlines()[:10]
+    for backend in BACKENDS:
+        for chunk_size in [1000, 10000000]:
+            data = parseText(SYNTH_DATA_PATH, backend=backend, chunk_size=chunk_size)
+            if data.shape != ref.shape or not allclose(data, ref):
+                print("\t\tError: data parsed with", backend, "backend does not match genfromtxt")
+                return False
+        if not allclose(parseLines(lines, backend=backend), ref[:, :10].T) or \
+                parseLines(lines[:1], backend=backend).shape != (1, 3):
+            print("\t\tError: lines parsed with", backend, "backend do not match genfromtxt")
+            return False
+    return True
+
+
+def test_parallel_parse():
+    """
+raw_data.test_parallel_parse
+    description:
+        parses the synthetic data using multiple worker processes and checks that the result is the same as parsing
+        it in a single process, both for the entire file and when keeping only the rows within some mass windows
+    parameters:
+        no
+    returns:
+        passed (bool) - test passed
+"""
+    ref = genfromtxt(SYNTH_DATA_PATH, unpack=True)
+    mass_windows = [(mass - MASS_WINDOW, mass + MASS_WINDOW) for mass in SYNTH_MASSES[1:3]]
+    for jobs in [2, 3]:
+        data = parallelParseText(SYNTH_DATA_PATH, jobs=jobs)
+        if data.shape != ref.shape or not allclose(data, ref):
+            print("\t\tError: data parsed with", jobs, "worker processes does not match")
+            return False
+        ref_pp = preProcessTxt(SYNTH_DATA_PATH, mass_windows)
+        data = parallelParseText(SYNTH_DATA_PATH, jobs=jobs, mass_windows=mass_windows)
+        if data.shape != ref_pp.shape or not allclose(data, ref_pp):
+            print("\t\tError: pre-processed data parsed with", jobs, "worker processes does not match")
+            return False
+    return True
+
+
+def test_compressed_input():
+    """
+raw_data.test_compressed_input
+    description:
+        writes compressed copies of the synthetic data (with each supported compression) then checks that parsing
+        and pre-processing them gives the same results as for the uncompressed file, and that RawData extracts the
+        same drift time data from them
+    parameters:
+        no
+    returns:
+        passed (bool) - test passed
+"""
+    ref = genfromtxt(SYNTH_DATA_PATH, unpack=True)
+    mass_windows = [(mass - MASS_WINDOW, mass + MASS_WINDOW) for mass in SYNTH_MASSES[1:3]]
+    ref_pp = preProcessTxt(SYNTH_DATA_PATH, mass_windows)
+    ref_rd = RawData(SYNTH_DATA_PATH, SYNTH_MASSES[2], MASS_WINDOW, cache=False)
+    with open(SYNTH_DATA_PATH, "rb") as f:
+        content = f.read()
+    for path, extension in zip(SYNTH_COMPRESSED_PATHS, OPENERS):
+        if extension == ".zst":
+            # the zstd reader cannot write, so compress the file directly (zstandard is installed if .zst is supported)
+            from zstandard import ZstdCompressor
+            with open(path, "wb") as f:
+                f.write(ZstdCompressor().compress(content))
+        else:
+            with OPENERS[extension](path, "wb") as f:
+                f.write(content)
+        for backend in BACKENDS:
+            data = parseText(path, backend=backend, chunk_size=1000)
+            if data.shape != ref.shape or not allclose(data, ref):
+                print("\t\tError: compressed data", path, "parsed with", backend, "backend does not match")
+                return False
+        data = preProcessTxt(path, mass_windows, chunk_size=1000)
+        if data.shape != ref_pp.shape or not allclose(data, ref_pp):
+            print("\t\tError: pre-processed compressed data", path, "does not match")
+            return False
+        rd = RawData(path, SYNTH_MASSES[2], MASS_WINDOW, cache=False)
+        if not allclose(rd.dtBinAndIntensity, ref_rd.dtBinAndIntensity):
+            print("\t\tError: drift time data extracted from compressed data", path, "does not match")
+            return False
+    return True
+
+
+def test_multi_mass_extractor():
+    """
+raw_data.test_multi_mass_extractor
+    description:
+        extracts the data for all of the synthetic masses with a MultiMassExtractor (with and without
+        pre-processing) and checks that the
+        dtbin and intensity values are the same as those extracted by individual RawData objects
+    parameters:
+        no
+    returns:
+        passed (bool) - test passed
+"""
+    for pp in [True, False]:
+        mme = MultiMassExtractor(SYNTH_DATA_PATH, SYNTH_MASSES, MASS_WINDOW, pp=pp)
+        if len(mme) != len(SYNTH_MASSES):
+            print("\t\tError: MultiMassExtractor has the wrong number of extracted masses")
+            return False
+        for mass, rd in zip(SYNTH_MASSES, mme):
+            ref = RawData(SYNTH_DATA_PATH, mass, MASS_WINDOW, pp=False)
+            if not allclose(ref.dtBinAndIntensity, rd.dtBinAndIntensity):
+                print("\t\tError: MultiMassExtractor data does not match RawData for mass {:.4f}".format(mass))
+                return False
+    return True
+
+
+def test_dtbin_sizing():
+    """
+raw_data.test_dtbin_sizing
+    description:
+        checks that data with dtbins beyond the configured number of dtbins is extracted without errors and
+        that the number of dtbins in the extracted data grows to include all of them
+    parameters:
+        no
+    returns:
+        passed (bool) - test passed
+"""
+    data = array([[100.00, 100.01, 100.02, 100.50],
+                  [    10,    250,    250,     20],
+                  [   1.0,    2.0,    3.0,    4.0]])
+    rd = RawData(SYNTH_DATA_PATH, 100.01, MASS_WINDOW, data=data, n_dtbins=200)
+    if rd.dtBinAndIntensity.shape != (2, 250):
+        print("\t\tError: extracted data has the wrong shape", rd.dtBinAndIntensity.shape)
+        return False
+    if rd.dtBinAndIntensity[1][249] != 5.0 or rd.dtBinAndIntensity[1][9] != 1.0 or rd.dtBinAndIntensity[1][19] != 0.:
+        print("\t\tError: extracted intensities do not match the expected values")
+        return False
+    return True
+
+
+def test_unsorted_input():
+    """
+raw_data.test_unsorted_input
+    description:
+        extracts the data for all of the synthetic masses from a copy of the synthetic data with its rows shuffled
+        and a few rows with dtbins less than 1 added (with RawData and a MultiMassExtractor, with and without
+        pre-processing, and with an IMMatrix) and checks that the dtbin and intensity values are the same as for
+        the sorted data, that the MzIndex of the shuffled file is marked as unsorted, and that building an
+        IMMatrix for the shuffled file (through the DataCache) first does not affect pre-processing it with
+        RawData afterwards
+    parameters:
+        no
+    returns:
+        passed (bool) - test passed
+"""
+    data = genfromtxt(SYNTH_DATA_PATH)
+    bad_dtbins = array([[mass, dtbin, 100.] for mass in SYNTH_MASSES for dtbin in [0, -3]])
+    shuffled = array(list(data) + list(bad_dtbins))[RandomState(4321).permutation(len(data) + len(bad_dtbins))]
+    with open(SYNTH_UNSORTED_PATH, "w") as f:
+        for mz, dtbin, intensity in shuffled:
+            f.write("{:.4f} {:d} {:.1f}\n".format(mz, int(dtbin), intensity))
+    for mass in SYNTH_MASSES:
+        ref = RawData(SYNTH_DATA_PATH, mass, MASS_WINDOW, pp=False, cache=False)
+        rd = RawData(SYNTH_DATA_PATH, mass, MASS_WINDOW, data=shuffled.T)
+        if not allclose(ref.dtBinAndIntensity, rd.dtBinAndIntensity):
+            print("\t\tError: data extracted from shuffled rows does not match for mass {:.4f}".format(mass))
+            return False
+    if MzIndex(SYNTH_UNSORTED_PATH).sorted or not MzIndex(SYNTH_DATA_PATH).sorted:
+        print("\t\tError: MzIndex did not detect whether the file is sorted by m/z")
+        return False
+    for pp in [True, False]:
+        mme = MultiMassExtractor(SYNTH_UNSORTED_PATH, SYNTH_MASSES, MASS_WINDOW, pp=pp, cache=False)
+        for mass, rd in zip(SYNTH_MASSES, mme):
+            ref = RawData(SYNTH_DATA_PATH, mass, MASS_WINDOW, pp=False, cache=False)
+            if not allclose(ref.dtBinAndIntensity, rd.dtBinAndIntensity):
+                print("\t\tError: data extracted from unsorted file (pp={}) does not match for ".format(pp) +
+                      "mass {:.4f}".format(mass))
+                return False
+    # the IMMatrix stores the columns in the default DataCache, which RawData then pre-processes from
+    imm = IMMatrix(SYNTH_UNSORTED_PATH, cache=True)
+    for mass in SYNTH_MASSES:
+        ref = RawData(SYNTH_DATA_PATH, mass, MASS_WINDOW, pp=False, cache=False)
+        for rd in [RawData(imm, mass, MASS_WINDOW), RawData(SYNTH_UNSORTED_PATH, mass, MASS_WINDOW, pp=True)]:
+            if not allclose(ref.dtBinAndIntensity, rd.dtBinAndIntensity):
+                print("\t\tError: data extracted from unsorted file with an IMMatrix (and then pre-processed " +
+                      "from the DataCache) does not match for mass {:.4f}".format(mass))
+                return False
+    return True
+
+
+def test_im_matrix():
+    """
+raw_data.test_im_matrix
+    description:
+        loads the synthetic data into an IMMatrix and checks that the data extracted from it for each of the
+        synthetic masses (using RawData and MultiMassExtractor) matches the data extracted from the file
+    parameters:
+        no
+    returns:
+        passed (bool) - test passed
+"""
+    imm = IMMatrix(SYNTH_DATA_PATH, cache=False)
+    mme = MultiMassExtractor(imm, SYNTH_MASSES, MASS_WINDOW)
+    for mass, mme_rd in zip(SYNTH_MASSES, mme):
+        ref = RawData(SYNTH_DATA_PATH, mass, MASS_WINDOW, pp=False, cache=False)
+        rd = RawData(imm, mass, MASS_WINDOW)
+        if not (allclose(ref.dtBinAndIntensity, rd.dtBinAndIntensity) and
+                allclose(ref.dtBinAndIntensity, mme_rd.dtBinAndIntensity)):
+            print("\t\tError: IMMatrix data does not match RawData for mass {:.4f}".format(mass))
+            return False
+    return True
+
+
+def test_mz_index():
+    """
+raw_data.test_mz_index
+    description:
+        builds an MzIndex for the synthetic data (with a small stride so that there are many index entries) and
+        checks that pre-processing with the index gives the same data as pre-processing without it, that the
+        index is loaded back from its sidecar file (named after the whole data file name), and that building the
+        index in small chunks gives the same entries as going through the file one line at a time
+    parameters:
+        no
+    returns:
+        passed (bool) - test passed
+"""
+    index = MzIndex(SYNTH_DATA_PATH, stride=50)
+    if not isfile(SYNTH_INDEX_PATH):
+        print("\t\tError: MzIndex sidecar file was not written")
+        return False
+    mass_windows = [[(mass - MASS_WINDOW, mass + MASS_WINDOW)] for mass in SYNTH_MASSES] + \
+                   [[(150., 160.), (303., 304.)], [(50., 60.)], [(499., 600.)]]
+    for windows in mass_windows:
+        for chunk_size in [100, 10000]:
+            ref = preProcessTxt(SYNTH_DATA_PATH, windows, chunk_size=chunk_size)
+            data = preProcessTxt(SYNTH_DATA_PATH, windows, chunk_size=chunk_size, index=index)
+            if ref.shape != data.shape or not allclose(ref, data):
+                print("\t\tError: pre-processed data using MzIndex does not match for mass windows", windows)
+                return False
+    if not MzIndex(SYNTH_DATA_PATH, stride=50).loadSidecar():
+        print("\t\tError: MzIndex could not be loaded from its sidecar file")
+        return False
+    mz, offsets, offset = [], [], 0
+    with open(SYNTH_DATA_PATH, "rb") as f:
+        for n, line in enumerate(f):
+            if n % 50 == 0:
+                mz.append(float(line.split()[0]))
+                offsets.append(offset)
+            offset += len(line)
+    for chunk_size in [7, 100, 10000]:
+        index.build(chunk_size=chunk_size)
+        if not allclose(index.mz, mz) or list(index.offsets) != offsets or not index.sorted:
+            print("\t\tError: MzIndex built in chunks of", chunk_size, "bytes does not match the line by line index")
+            return False
+    return True
+
+
+def test_data_cache():
+    """
+raw_data.test_data_cache
+    description:
+        stores the synthetic data in a DataCache and checks that it is loaded back (memory-mapped) with the same
+        values (with exactly the same intensities), that the cache entry is invalidated when the source file
+        changes, and that the least recently used entry is evicted when the cache grows larger than its maximum
+        size
+    parameters:
+        no
+    returns:
+        passed (bool) - test passed
+"""
+    parse = lambda filename: genfromtxt(filename, unpack=True)
+    ref = parse(SYNTH_DATA_PATH)
+    dc = DataCache(cache_dir=CACHE_DIR)
+    if dc.load(SYNTH_DATA_PATH) is not None:
+        print("\t\tError: DataCache loaded data that was never stored")
+        return False
+    dc.loadOrParse(SYNTH_DATA_PATH, parse)
+    data = dc.load(SYNTH_DATA_PATH)
+    if data is None:
+        print("\t\tError: DataCache did not load stored data")
+        return False
+    if not (allclose(data[0], ref[0]) and allclose(data[1], ref[1]) and allclose(data[2], ref[2])):
+        print("\t\tError: data loaded from DataCache does not match parsed data")
+        return False
+    if data[2].dtype != ref[2].dtype or any(data[2] != ref[2]):
+        print("\t\tError: intensities loaded from DataCache are not the same as the parsed intensities")
+        return False
+    # change the source file, the cache entry should be invalidated
+    sleep(0.01)
+    with open(SYNTH_DATA_PATH, "a") as f:
+        f.write("999.0000 1 1.0\n")
+    if dc.load(SYNTH_DATA_PATH) is not None:
+        print("\t\tError: DataCache loaded data for a source file that has changed")
+        return False
+    # store entries for two files in a cache that only has room for one of them
+    dc.store(SYNTH_DATA_PATH, parse(SYNTH_DATA_PATH))
+    # each row takes up 18 bytes (float64 + int16 + float64)
+    dc.maxSize = int(1.5 * len(ref[0]) * 18)
+    dc.store(TEST_PATH + "external_data1.csv", ref)
+    if dc.load(SYNTH_DATA_PATH) is not None or dc.load(TEST_PATH + "external_data1.csv") is None:
+        print("\t\tError: DataCache did not evict the least recently used entry")
+        return False
+    return True
+
+
+# *the primary method for running all of the tests*
+def run():
+    """
+raw_data.run
+    description:
+        runs all of the (currently implemented) individual tests
+    parameters:
+        no
+    returns:
+        passed_all (bool) - all tests passed
+"""
+    make_synthetic_data()
+    try:
+        print("\t(1 of 11) extracting data with RawData (no pre-processing)...")
+        assert test_raw_data()
+        print("\t...PASS")
+
+        print("\t(2 of 11) extracting data with more than the configured number of dtbins...")
+        assert test_dtbin_sizing()
+        print("\t...PASS")
+
+        print("\t(3 of 11) extracting data with pre-processing...")
+        assert test_pre_processing()
+        print("\t...PASS")
+
+        print("\t(4 of 11) parsing data with each of the TextParser backends...")
+        assert test_text_parsers()
+        print("\t...PASS")
+
+        print("\t(5 of 11) parsing data with multiple worker processes...")
+        assert test_parallel_parse()
+        print("\t...PASS")
+
+        print("\t(6 of 11) parsing and pre-processing compressed data...")
+        assert test_compressed_input()
+        print("\t...PASS")
+
+        print("\t(7 of 11) extracting data with MultiMassExtractor...")
+        assert test_multi_mass_extractor()
+        print("\t...PASS")
+
+        print("\t(8 of 11) extracting data with IMMatrix...")
+        assert test_im_matrix()
+        print("\t...PASS")
+
+        print("\t(9 of 11) pre-processing data using MzIndex...")
+        assert test_mz_index()
+        print("\t...PASS")
+
+        print("\t(10 of 11) storing and loading data with DataCache...")
+        assert test_data_cache()
+        print("\t...PASS")
+
+        print("\t(11 of 11) extracting data from unsorted data with invalid dtbins...")
+        assert test_unsorted_input()
+        print("\t...PASS")
+    finally:
+        for path in [SYNTH_DATA_PATH, SYNTH_UNSORTED_PATH, SYNTH_INDEX_PATH, SYNTH_UNSORTED_INDEX_PATH] + \
+                SYNTH_COMPRESSED_PATHS:
+            if isfile(path):
+                remove(path)
+        for cache_dir in [CACHE_DIR, DEFAULT_CACHE_DIR]:
+            if isdir(cache_dir):
+                rmtree(cache_dir)
+
+    # if everything passed return True for success
+    return True
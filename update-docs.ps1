@@ -19,6 +19,22 @@ py -m pydoc -w CcsCal
         
         py -m pydoc -w CcsCal.input.RawData
 
+        py -m pydoc -w CcsCal.input.PreProcessTxt
+
+        py -m pydoc -w CcsCal.input.DataCache
+
+        py -m pydoc -w CcsCal.input.MzIndex
+
+        py -m pydoc -w CcsCal.input.IMMatrix
+
+        py -m pydoc -w CcsCal.input.TextParser
+
+        py -m pydoc -w CcsCal.input.ParserBenchmark
+
+        py -m pydoc -w CcsCal.input.ParallelParse
+
+        py -m pydoc -w CcsCal.input.CompressedFile
+
         py -m pydoc -w CcsCal.input.ExcelIO
 
     py -m pydoc -w CcsCal.metabolism
@@ -30,16 +46,46 @@ py -m pydoc -w CcsCal
     py -m pydoc -w CcsCal.processing
     
         py -m pydoc -w CcsCal.processing.GaussFit
+
+        py -m pydoc -w CcsCal.processing.BatchGaussFit
+
+        py -m pydoc -w CcsCal.processing.BatchLeastSquares
         
         py -m pydoc -w CcsCal.processing.CcsCalibration
         
         py -m pydoc -w CcsCal.processing.Report
+
+        py -m pydoc -w CcsCal.processing.BatchProcessor
+
+        py -m pydoc -w CcsCal.processing.FigureRenderer
+
+        py -m pydoc -w CcsCal.processing.ContactSheet
+
+        py -m pydoc -w CcsCal.processing.FitCache
+
+        py -m pydoc -w CcsCal.processing.ProfileConditioner
+
+        py -m pydoc -w CcsCal.processing.BatchCalCurveFit
+
+        py -m pydoc -w CcsCal.processing.CalibrationBootstrap
+
+        py -m pydoc -w CcsCal.processing.CalibrationSweep
+
+        py -m pydoc -w CcsCal.processing.CalibrationRegistry
+
+        py -m pydoc -w CcsCal.processing.ExternalConversion
         
     py -m pydoc -w CcsCal.tests
         
         py -m pydoc -w CcsCal.tests.all_tests
         
         py -m pydoc -w CcsCal.tests.input_parsing
+
+        py -m pydoc -w CcsCal.tests.raw_data
+
+        py -m pydoc -w CcsCal.tests.batch_processing
+
+        py -m pydoc -w CcsCal.tests.gauss_fitting
         
         py -m pydoc -w CcsCal.tests.external_data
 